@@ -0,0 +1,114 @@
+'''Cached reader of the layer assignment spreadsheet
+
+Only the status and folder id columns are read. The sheet's Drive version is
+checked first and the columns are read again only when it has changed, so
+an unchanged sheet costs one small Drive request. The completed folder ids
+are kept in data/outputs/temp/assignment_sheet.json between runs.
+
+The sheet client and version lookup can be passed in, so a local stand-in
+can replace gspread and Drive.
+'''
+import os
+import json
+from itertools import izip_longest
+from time import strftime
+import instrumentation
+
+
+SHEET_KEY = '1tX3mlUZ3nWIoTKxjiKlYG9U3njIRnJHF956wzS428qw'
+WORKSHEET = 'sheet.csv'
+CREDENTIALS_JSON = r'CenterlineSchema-c1b9c8e23e52.json'
+SHEET_CACHE = 'data/outputs/temp/assignment_sheet.json'
+# gspread columns are numbered from 1
+STATUS_COLUMN = 2
+FOLDER_ID_COLUMN = 4
+
+
+def get_sheet_client(credentials_json=CREDENTIALS_JSON):
+    '''Authorized gspread client; the sheet must be shared with the credentials' email'''
+    import gspread
+    from oauth2client.service_account import ServiceAccountCredentials
+    scope = ['https://spreadsheets.google.com/feeds']
+    credentials = ServiceAccountCredentials.from_json_keyfile_name(credentials_json, scope)
+    return gspread.authorize(credentials)
+
+
+def get_sheet_version(sheet_key):
+    import drive_loader
+    return drive_loader.get_file_version(sheet_key)['version']
+
+
+class AssignmentSheet(object):
+
+    def __init__(self, sheet_key=SHEET_KEY, worksheet=WORKSHEET, cache_path=SHEET_CACHE,
+                 sheet_client=None, version_source=get_sheet_version):
+        self.sheet_key = sheet_key
+        self.worksheet = worksheet
+        self.cache_path = cache_path
+        self.sheet_client = sheet_client
+        self.version_source = version_source
+        self.version = None
+        self._completed_ids = None
+        # Whether the version was checked by this process
+        self._checked = False
+        if os.path.exists(cache_path):
+            with open(cache_path, 'r') as json_file:
+                cached = json.load(json_file)
+            if cached.get('sheet_key') == sheet_key and cached.get('worksheet') == worksheet:
+                self.version = cached['version']
+                self._completed_ids = frozenset(cached['completed_ids'])
+
+    def save(self):
+        directory = os.path.dirname(self.cache_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(self.cache_path, 'w') as f_out:
+            f_out.write(json.dumps({'sheet_key': self.sheet_key,
+                                    'worksheet': self.worksheet,
+                                    'version': self.version,
+                                    'completed_ids': sorted(self._completed_ids),
+                                    'upload_time_local': strftime("%Y_%m_%d %H:%M:%S")},
+                                   sort_keys=True, indent=4))
+
+    @instrumentation.timed('sheet.read_columns')
+    def read_completed_ids(self):
+        '''Read the status and folder id columns and return the ids of rows marked done'''
+        if self.sheet_client is None:
+            self.sheet_client = get_sheet_client()
+        worksheet = self.sheet_client.open_by_key(self.sheet_key).worksheet(self.worksheet)
+        statuses = worksheet.col_values(STATUS_COLUMN)
+        folder_ids = worksheet.col_values(FOLDER_ID_COLUMN)
+        return frozenset(folder_id for status, folder_id in izip_longest(statuses, folder_ids, fillvalue='')
+                         if folder_id and 'done' in status.lower())
+
+    def completed_ids(self, refresh=False):
+        '''Folder ids of completed layers, read again only when the sheet has changed
+
+        The first call in a process checks the sheet version; later calls use
+        the ids already held unless refresh is set.
+        '''
+        if self._checked and not refresh:
+            return self._completed_ids
+        version = self.version_source(self.sheet_key)
+        if self._completed_ids is None or version != self.version:
+            self._completed_ids = self.read_completed_ids()
+            self.version = version
+            self.save()
+        else:
+            instrumentation.count('sheet.unchanged')
+        self._checked = True
+        return self._completed_ids
+
+    def is_completed(self, folder_id):
+        return folder_id in self.completed_ids()
+
+
+_sheet = None
+
+
+def get_assignment_sheet():
+    '''Assignment sheet shared by the process, loaded on first use'''
+    global _sheet
+    if _sheet is None:
+        _sheet = AssignmentSheet()
+    return _sheet
@@ -0,0 +1,83 @@
+'''One editing doc per category with a delimited section per layer element
+
+Each section starts with a marker line naming the output xml and element:
+
+    ##### SGID10.WATER.Lakes.xml | abstract #####
+
+Editors change the text between markers and leave the markers alone. A sync
+exports the doc once and compares each section with the hash recorded when it
+was uploaded or last applied, so only changed sections are written to xml.
+'''
+import os
+import re
+import json
+from collections import OrderedDict
+from time import strftime
+from text_store import text_key
+
+
+CATEGORY_DOC_PROPERTY = 'metaCategoryDoc'
+CATEGORY_DOC_SUFFIX = '_metadata'
+CATEGORY_DOC_CACHE = 'data/outputs/temp/category_docs.json'
+SECTION_MARKER = '##### {} | {} #####'
+SECTION_PATTERN = re.compile(r'^#####\s*(\S+\.xml)\s*\|\s*(\w+)\s*#####\s*$', re.MULTILINE)
+
+
+def is_category_doc(drive_file):
+    return CATEGORY_DOC_PROPERTY in (drive_file.get('properties') or {})
+
+
+def build_doc_text(sections):
+    '''Doc body for [(xml name, element name, text)]'''
+    lines = []
+    for xml_name, element_name, text in sections:
+        lines.append(SECTION_MARKER.format(xml_name, element_name))
+        lines.append((text or '').strip())
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def parse_doc_text(text):
+    '''OrderedDict of (xml name, element name) -> section text'''
+    sections = OrderedDict()
+    markers = list(SECTION_PATTERN.finditer(text))
+    for i, marker in enumerate(markers):
+        end = markers[i + 1].start() if i + 1 < len(markers) else len(text)
+        sections[(marker.group(1), marker.group(2))] = text[marker.end():end].strip()
+    return sections
+
+
+def _section_name(xml_name, element_name):
+    return '{}|{}'.format(xml_name, element_name)
+
+
+class CategoryDocCache(object):
+    '''Hash of every section of each category doc as last uploaded or applied'''
+
+    def __init__(self, json_path=CATEGORY_DOC_CACHE):
+        self.json_path = json_path
+        # doc id -> {'category', 'sections': {'xml name|element': text key}}
+        self.docs = {}
+        if os.path.exists(json_path):
+            with open(json_path, 'r') as json_file:
+                self.docs = json.load(json_file)['docs']
+
+    def save(self):
+        directory = os.path.dirname(self.json_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(self.json_path, 'w') as f_out:
+            f_out.write(json.dumps({'docs': self.docs, 'upload_time_local': strftime("%Y_%m_%d %H:%M:%S")},
+                                   sort_keys=True, indent=4))
+
+    def changed_sections(self, doc_id, sections):
+        '''[(xml name, element name, text)] of sections that differ from the recorded hashes'''
+        recorded = self.docs.get(doc_id, {}).get('sections', {})
+        return [(xml_name, element_name, text) for (xml_name, element_name), text in sections.items()
+                if recorded.get(_section_name(xml_name, element_name)) != text_key(text)]
+
+    def record(self, doc_id, category, sections):
+        '''Remember sections, from parse_doc_text, as the doc's current content'''
+        self.docs[doc_id] = {'category': category,
+                             'sections': dict((_section_name(xml_name, element_name), text_key(text))
+                                              for (xml_name, element_name), text in sections.items())}
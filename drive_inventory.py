@@ -0,0 +1,82 @@
+'''Local inventory of the element docs on Drive and the output xml each one edits
+'''
+import os
+import json
+import threading
+from time import strftime, mktime, strptime
+
+
+INVENTORY_JSON = 'data/outputs/temp/drive_inventory.json'
+SAVED_FORMAT = "%Y_%m_%d %H:%M:%S"
+
+
+class FileInventory(object):
+    '''file_id -> record of name, modifiedTime, xml path and the modifiedTime last applied'''
+
+    def __init__(self, json_path=INVENTORY_JSON):
+        self.json_path = json_path
+        self.files = {}
+        # Local time the inventory was last saved, None when never saved
+        self.saved = None
+        self._lock = threading.Lock()
+        if os.path.exists(json_path):
+            with open(json_path, 'r') as json_file:
+                inventory = json.load(json_file)
+            self.files = inventory['files']
+            self.saved = inventory.get('saved')
+
+    def __len__(self):
+        return len(self.files)
+
+    def __contains__(self, file_id):
+        return file_id in self.files
+
+    def get(self, file_id):
+        return self.files.get(file_id)
+
+    def record(self, drive_file, xml_path=None):
+        '''Add or refresh a listed or changed doc'''
+        with self._lock:
+            record = self.files.setdefault(drive_file['id'], {})
+            record['name'] = drive_file['name']
+            if drive_file.get('modifiedTime'):
+                record['modifiedTime'] = drive_file['modifiedTime']
+            if xml_path:
+                record['xml_path'] = xml_path
+            return record
+
+    def mark_applied(self, file_id, modified_time):
+        '''Remember the modifiedTime the doc had after its text was applied and it was marked'''
+        with self._lock:
+            record = self.files.setdefault(file_id, {})
+            record['applied'] = modified_time
+            if modified_time:
+                record['modifiedTime'] = modified_time
+
+    def is_applied(self, drive_file):
+        '''True when this version of the doc was already applied, e.g. the change from our own mark'''
+        record = self.files.get(drive_file['id'])
+        return record is not None and record.get('applied') == drive_file.get('modifiedTime')
+
+    def remove(self, file_id):
+        with self._lock:
+            self.files.pop(file_id, None)
+
+    def saved_seconds_ago(self, now):
+        '''Seconds between the last save and now, an epoch time, or None'''
+        if self.saved is None:
+            return None
+        return now - mktime(strptime(self.saved, SAVED_FORMAT))
+
+    def xml_paths(self):
+        return set(r['xml_path'] for r in self.files.values() if r.get('xml_path'))
+
+    def save(self):
+        directory = os.path.dirname(self.json_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with self._lock:
+            self.saved = strftime(SAVED_FORMAT)
+            content = json.dumps({'files': self.files, 'saved': self.saved}, sort_keys=True, indent=4)
+        with open(self.json_path, 'w') as f_out:
+            f_out.write(content)
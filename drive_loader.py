@@ -8,6 +8,11 @@ from oauth2client.file import Storage
 import os
 import io
 import time
+import Queue
+import random
+import threading
+import instrumentation
+from functools import wraps
 
 # try:
 #     import argparse
@@ -40,6 +45,319 @@ SERVICE = None
 TEMP_FOLDER = '0B3wvsjTJuTRQLTU1N1BndjdTWGc'
 
 
+# Drive batch requests accept at most 100 calls
+BATCH_SIZE = 100
+
+
+class DriveFile(object):
+    '''Compact file record from a listing that reads like the Drive resource dict'''
+
+    __slots__ = ('id', 'name', 'modifiedTime', 'parents', 'properties')
+
+    def __init__(self, resource):
+        for field in DriveFile.__slots__:
+            setattr(self, field, resource.get(field))
+
+    def __getitem__(self, field):
+        value = getattr(self, field, None) if field in DriveFile.__slots__ else None
+        if value is None:
+            raise KeyError(field)
+        return value
+
+    def __contains__(self, field):
+        return field in DriveFile.__slots__ and getattr(self, field) is not None
+
+    def get(self, field, default=None):
+        value = getattr(self, field, None) if field in DriveFile.__slots__ else None
+        return default if value is None else value
+
+    def to_dict(self):
+        return dict((field, getattr(self, field)) for field in DriveFile.__slots__ if getattr(self, field) is not None)
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+
+# Page services of the prefetch workers, by the caller's service; each is used by one worker at a time
+_page_services = {}
+_page_services_lock = threading.Lock()
+
+
+def _checkout_page_service(service):
+    '''An idle page service built earlier for this caller's service, or a new one'''
+    with _page_services_lock:
+        idle = _page_services.get(service)
+        if idle:
+            return idle.pop()
+    return setup_drive_service()
+
+
+def _return_page_service(service, page_service):
+    with _page_services_lock:
+        _page_services.setdefault(service, []).append(page_service)
+
+
+def _iter_pages(list_page, items_key, service=None, prefetch=True):
+    '''Yield the items of each page as it arrives
+
+    list_page(service, page_token) requests one page. With prefetch the pages
+    are requested by a worker thread on its own service, since httplib2
+    connections are not thread safe, so the next page downloads while the
+    current one is consumed. That service is taken on the calling thread, where
+    an expired token can still run the interactive authorization. A caller
+    that passes its service gets page services kept for it and reused by its
+    later listings, so a warm caller authorizes and builds discovery once; a
+    caller without one gets a new page service per listing.
+    '''
+    if not prefetch:
+        if not service:
+            service = setup_drive_service()
+        page_token = None
+        while True:
+            with instrumentation.stage('drive.list_page'):
+                response = list_page(service, page_token)
+            for item in response.get(items_key, []):
+                yield item
+            page_token = response.get('nextPageToken', None)
+            if page_token is None:
+                return
+
+    page_service = _checkout_page_service(service) if service else setup_drive_service()
+    pages = Queue.Queue(maxsize=1)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                pages.put(item, timeout=1)
+                return True
+            except Queue.Full:
+                continue
+        return False
+
+    def fetch_pages():
+        try:
+            page_token = None
+            while True:
+                with instrumentation.stage('drive.list_page'):
+                    response = list_page(page_service, page_token)
+                if not put(response):
+                    return
+                page_token = response.get('nextPageToken', None)
+                if page_token is None:
+                    break
+        except Exception as e:
+            put(e)
+            return
+        finally:
+            # Back to the pool only once this worker is done with it
+            if service:
+                _return_page_service(service, page_service)
+        put(None)
+
+    worker = threading.Thread(target=fetch_pages, name='drive-pages')
+    worker.daemon = True
+    worker.start()
+    try:
+        while True:
+            response = pages.get()
+            if response is None:
+                return
+            if isinstance(response, Exception):
+                raise response
+            for item in response.get(items_key, []):
+                yield item
+    finally:
+        # Lets the worker exit when the caller stops iterating early
+        stopped.set()
+
+
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded')
+
+
+def is_rate_limited(error):
+    '''True for a 429, or a 403 whose reason is a rate limit rather than a permission'''
+    if not isinstance(error, errors.HttpError):
+        return False
+    if error.resp.status == 429:
+        return True
+    return error.resp.status == 403 and any(reason in (error.content or '') for reason in RATE_LIMIT_REASONS)
+
+
+class AdaptiveLimiter(object):
+    '''Limit on concurrent Drive calls tuned by additive increase, multiplicative decrease
+
+    The limit rises by increase after each window of healthy calls, a window
+    being as many calls as the current limit. Only calls that finish with the
+    limit fully in use count, so a limit the callers do not fill is not raised.
+    It is multiplied by decrease on a rate-limit response; at most once per
+    cooldown, so one burst of 403s cuts it once. Calls slower than
+    latency_target hold the limit where it is.
+    Rate-limited calls are retried with exponential backoff.
+    '''
+
+    def __init__(self, initial=4, minimum=1, maximum=32, increase=1.0, decrease=0.5, latency_target=5.0,
+                 cooldown=2.0, retries=5, name='drive'):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_target = latency_target
+        self.cooldown = cooldown
+        self.retries = retries
+        self.name = name
+        self.in_flight = 0
+        self.completed = 0
+        self.rate_limited = 0
+        self._healthy = 0
+        self._last_decrease = 0.0
+        self._started = None
+        self._condition = threading.Condition()
+
+    def _record_gauges(self):
+        instrumentation.gauge(self.name + '.concurrency_limit', int(self.limit))
+        instrumentation.gauge(self.name + '.in_flight', self.in_flight)
+        instrumentation.gauge(self.name + '.qps', self.qps())
+
+    def acquire(self):
+        with self._condition:
+            if self._started is None:
+                self._started = time.time()
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, seconds, rate_limited=False):
+        with self._condition:
+            self.in_flight -= 1
+            now = time.time()
+            if rate_limited:
+                self.rate_limited += 1
+                self._healthy = 0
+                if now - self._last_decrease >= self.cooldown:
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                    self._last_decrease = now
+            else:
+                self.completed += 1
+                # Saturated: this call and the others in flight filled the limit
+                if seconds <= self.latency_target and self.in_flight + 1 >= int(self.limit):
+                    self._healthy += 1
+                    if self._healthy >= int(self.limit):
+                        self.limit = min(self.maximum, self.limit + self.increase)
+                        self._healthy = 0
+            self._record_gauges()
+            self._condition.notify_all()
+
+    def call(self, func, *args, **kwargs):
+        '''Call func within the limit, retrying rate-limited calls with backoff'''
+        for attempt in range(self.retries + 1):
+            self.acquire()
+            start = time.time()
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                limited = is_rate_limited(e)
+                self.release(time.time() - start, rate_limited=limited)
+                if not limited or attempt == self.retries:
+                    raise
+                instrumentation.count(self.name + '.rate_limited')
+                time.sleep(min(2 ** attempt, 32) + random.random())
+                continue
+            self.release(time.time() - start)
+            return result
+
+    def qps(self):
+        if self._started is None:
+            return 0.0
+        elapsed = time.time() - self._started
+        return self.completed / elapsed if elapsed > 0 else 0.0
+
+    def summary(self):
+        '''Current limit and achieved calls per second, also recorded as gauges for the run report'''
+        with self._condition:
+            self._record_gauges()
+            return {'limit': int(self.limit), 'completed': self.completed, 'rate_limited': self.rate_limited,
+                    'qps': self.qps()}
+
+
+_limiter = None
+_held = threading.local()
+
+
+def enable_adaptive(limiter=None):
+    '''Route Drive calls decorated with adaptive through limiter, a new AdaptiveLimiter by default'''
+    global _limiter
+    _limiter = limiter if limiter is not None else AdaptiveLimiter()
+    return _limiter
+
+
+def get_limiter():
+    '''Limiter set by enable_adaptive, or None'''
+    return _limiter
+
+
+def adaptive(func):
+    '''Run func within the shared limiter once enabled; Drive calls it makes share its slot'''
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        limiter = _limiter
+        if limiter is None or getattr(_held, 'slot', False):
+            return func(*args, **kwargs)
+        _held.slot = True
+        try:
+            return limiter.call(func, *args, **kwargs)
+        finally:
+            _held.slot = False
+    return wrapper
+
+
+def map_threads(func, items, workers):
+    '''Call func on each item from up to workers threads, returning the results in item order
+
+    The first exception raised is raised again once every item has been tried.
+    '''
+    items = list(items)
+    results = [None] * len(items)
+    failures = []
+    work = Queue.Queue()
+    for i, item in enumerate(items):
+        work.put((i, item))
+
+    def run():
+        while True:
+            try:
+                i, item = work.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = func(item)
+            except Exception as e:
+                failures.append(e)
+
+    threads = [threading.Thread(target=run, name='drive-{}'.format(i)) for i in range(min(workers, len(items)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if failures:
+        raise failures[0]
+    return results
+
+
+def _iter_files(query, fields, service=None, prefetch=True):
+    '''Yield a DriveFile for each file matching query'''
+    def list_page(page_service, page_token):
+        return page_service.files().list(q=query,
+                                         spaces='drive',
+                                         fields='nextPageToken, files({})'.format(fields),
+                                         pageToken=page_token).execute()
+    for resource in _iter_pages(list_page, 'files', service, prefetch):
+        yield DriveFile(resource)
+
+
+@instrumentation.timed('drive.get_credentials')
 def get_credentials():
     """Gets valid user credentials from storage.
 
@@ -69,35 +387,38 @@ def get_credentials():
     return credentials
 
 
-def get_file_comments(file_id, service=SERVICE):
-    if not service:
-        service = setup_drive_service()
-    page_token = None
-    file_comments = []
-    while True:
-        response = service.comments().list(fileId=file_id,
-                                           includeDeleted='false',
-                                           fields='comments(author(emailAddress),content,id,replies(content))',
-                                           pageToken=page_token).execute()
-        file_comments.append(response['comments'])
-        page_token = response.get('nextPageToken', None)
-        if page_token is None:
-            break
-    return file_comments
+def iter_file_comments(file_id, service=SERVICE, start_modified_time=None, prefetch=False):
+    def list_page(page_service, page_token):
+        return page_service.comments().list(fileId=file_id,
+                                            includeDeleted='false',
+                                            startModifiedTime=start_modified_time,
+                                            fields='nextPageToken, comments(author(emailAddress),content,id,modifiedTime,replies(content))',
+                                            pageToken=page_token).execute()
+    return _iter_pages(list_page, 'comments', service, prefetch)
+
+
+@instrumentation.timed('drive.get_file_comments')
+def get_file_comments(file_id, service=SERVICE, start_modified_time=None):
+    return list(iter_file_comments(file_id, service, start_modified_time))
     # for comment in file_comments['comments']:
     #     if comment['content'] == '#completed':
     #         print comment
 
 
-def add_file_to_folders(file_id, parents, service=SERVICE):
+@adaptive
+@instrumentation.timed('drive.add_file_to_folders')
+def add_file_to_folders(file_id, parents, service=SERVICE, body=None):
+    '''Add parents to the file, applying any other metadata in body with the same request'''
     if not service:
         service = setup_drive_service()
     drive_file = service.files().update(fileId=file_id,
                                         addParents=','.join(parents),
+                                        body=body or {},
                                         fields='name').execute()
     # print drive_file
 
 
+@instrumentation.timed('drive.remove_file_from_folders')
 def remove_file_from_folders(file_id, parents, service=SERVICE):
     if not service:
         service = setup_drive_service()
@@ -107,6 +428,7 @@ def remove_file_from_folders(file_id, parents, service=SERVICE):
     return drive_file
 
 
+@instrumentation.timed('drive.setup_drive_service')
 def setup_drive_service():
     # get auth
     credentials = get_credentials()
@@ -116,6 +438,7 @@ def setup_drive_service():
     return service
 
 
+@instrumentation.timed('drive.get_file_id_by_name_and_directory')
 def get_file_id_by_name_and_directory(name, parent_id, service=SERVICE):
     if not service:
         service = setup_drive_service()
@@ -129,6 +452,7 @@ def get_file_id_by_name_and_directory(name, parent_id, service=SERVICE):
         return None
 
 
+@instrumentation.timed('drive.get_subfolder_ids')
 def get_subfolder_ids(parent_id, service=SERVICE):
     if not service:
         service = setup_drive_service()
@@ -142,66 +466,38 @@ def get_subfolder_ids(parent_id, service=SERVICE):
         return None
 
 
-def get_files_directly_in_directory(parent_id, service=SERVICE):
-    if not service:
-        service = setup_drive_service()
-    page_token = None
-    files = []
-    while True:
-        response = service.files().list(q="mimeType != 'application/vnd.google-apps.folder' and '{}' in parents".format(parent_id),
-                                        spaces='drive',
-                                        fields='nextPageToken, files(id, name)',
-                                        pageToken=page_token).execute()
-        files.extend(response.get('files', []))
+def iter_files_directly_in_directory(parent_id, service=SERVICE, prefetch=True):
+    query = "mimeType != 'application/vnd.google-apps.folder' and '{}' in parents".format(parent_id)
+    return _iter_files(query, 'id, name', service, prefetch)
 
-        page_token = response.get('nextPageToken', None)
-        if page_token is None:
-            break
 
-    return files
+@instrumentation.timed('drive.get_files_directly_in_directory')
+def get_files_directly_in_directory(parent_id, service=SERVICE):
+    return list(iter_files_directly_in_directory(parent_id, service, prefetch=False))
 
 
-def get_abstracts_in_directory(parent_id, service=SERVICE):
-    if not service:
-        service = setup_drive_service()
-    page_token = None
-    files = []
-    while True:
-        response = service.files().list(q="mimeType != 'application/vnd.google-apps.folder' and '{}' in parents and name contains 'abstract'".format(parent_id),
-                                        spaces='drive',
-                                        fields='nextPageToken, files(id, name, parents)',
-                                        pageToken=page_token).execute()
-        files.extend(response.get('files', []))
+def iter_abstracts_in_directory(parent_id, service=SERVICE, prefetch=True):
+    query = "mimeType != 'application/vnd.google-apps.folder' and '{}' in parents and name contains 'abstract'".format(parent_id)
+    return _iter_files(query, 'id, name, parents', service, prefetch)
 
-        page_token = response.get('nextPageToken', None)
-        if page_token is None:
-            break
 
-    return files
+@instrumentation.timed('drive.get_abstracts_in_directory')
+def get_abstracts_in_directory(parent_id, service=SERVICE):
+    return list(iter_abstracts_in_directory(parent_id, service, prefetch=False))
 
 
-def get_docs_for_category(category_name, parent_id, service=SERVICE):
-    if not service:
-        service = setup_drive_service()
-    page_token = None
-    files = []
+def iter_docs_for_category(category_name, parent_id, service=SERVICE, prefetch=True):
     query = "mimeType != 'application/vnd.google-apps.folder' and '{}' in parents and name contains '{}'".format(parent_id,
                                                                                                              category_name)
-    print query
-    while True:
-        response = service.files().list(q=query,
-                                        spaces='drive',
-                                        fields='nextPageToken, files(id, name, parents)',
-                                        pageToken=page_token).execute()
-        files.extend(response.get('files', []))
+    return _iter_files(query, 'id, name, parents', service, prefetch)
 
-        page_token = response.get('nextPageToken', None)
-        if page_token is None:
-            break
 
-    return files
+@instrumentation.timed('drive.get_docs_for_category')
+def get_docs_for_category(category_name, parent_id, service=SERVICE):
+    return list(iter_docs_for_category(category_name, parent_id, service, prefetch=False))
 
 
+@instrumentation.timed('drive.get_feature_folder_info')
 def get_feature_folder_info(folder_id, service=SERVICE):
     if not service:
         service = setup_drive_service()
@@ -211,25 +507,17 @@ def get_feature_folder_info(folder_id, service=SERVICE):
     return response
 
 
-def get_gisi_not_updated_in_directory(parent_id, service=SERVICE):
-    if not service:
-        service = setup_drive_service()
-    page_token = None
-    files = []
-    while True:
-        response = service.files().list(q="mimeType != 'application/vnd.google-apps.folder' and '%s' in parents and not properties has { key='metaGisiUpdated' and value='true'}" % parent_id,
-                                        spaces='drive',
-                                        fields='nextPageToken, files(id, name)',
-                                        pageToken=page_token).execute()
-        files.extend(response.get('files', []))
+def iter_gisi_not_updated_in_directory(parent_id, service=SERVICE, prefetch=True):
+    query = "mimeType != 'application/vnd.google-apps.folder' and '%s' in parents and not properties has { key='metaGisiUpdated' and value='true'}" % parent_id
+    return _iter_files(query, 'id, name', service, prefetch)
 
-        page_token = response.get('nextPageToken', None)
-        if page_token is None:
-            break
 
-    return files
+@instrumentation.timed('drive.get_gisi_not_updated_in_directory')
+def get_gisi_not_updated_in_directory(parent_id, service=SERVICE):
+    return list(iter_gisi_not_updated_in_directory(parent_id, service, prefetch=False))
 
 
+@instrumentation.timed('drive.create_drive_file')
 def create_drive_file(name, parent_ids, media_body, service):
 
     file_metadata = {'name': name,
@@ -265,6 +553,8 @@ def create_drive_file(name, parent_ids, media_body, service):
     return response.get('id')
 
 
+@adaptive
+@instrumentation.timed('drive.create_drive_folder')
 def create_drive_folder(name, parent_ids, service=SERVICE):
     if not service:
         service = setup_drive_service()
@@ -283,10 +573,31 @@ def create_drive_folder(name, parent_ids, service=SERVICE):
     return response.get('id')
 
 
-def create_google_doc(txt_file_path, parent_id, name):
+@instrumentation.timed('drive.update_doc_content')
+def update_doc_content(file_id, media_body, service=SERVICE):
+    '''Replace the text of an existing doc in place, keeping its comments and properties'''
+    if not service:
+        service = setup_drive_service()
+    return service.files().update(fileId=file_id,
+                                  media_body=media_body,
+                                  fields='id, modifiedTime').execute()
+
+
+@adaptive
+@instrumentation.timed('drive.create_google_doc')
+def create_google_doc(txt_file_path, parent_id, name, update_existing=False):
+    '''Create a doc from text, returning its id
+
+    An existing doc with the same name is left alone, or with update_existing
+    has its content replaced by the text.
+    '''
     service = setup_drive_service()
     existing_file_id = get_file_id_by_name_and_directory(name, parent_id, service)
     if existing_file_id:
+        if update_existing:
+            update_doc_content(existing_file_id,
+                               MediaIoBaseUpload(txt_file_path, mimetype='text/plain', resumable=True),
+                               service)
         return existing_file_id
 
     media_body = MediaIoBaseUpload(txt_file_path,
@@ -298,15 +609,19 @@ def create_google_doc(txt_file_path, parent_id, name):
     return file_id
 
 
-def set_property(file_id, property_dict, service=SERVICE):
+@adaptive
+@instrumentation.timed('drive.set_property')
+def set_property(file_id, property_dict, service=SERVICE, fields='name'):
     if not service:
         service = setup_drive_service()
     file_name = service.files().update(fileId=file_id,
-                                       fields='name',
+                                       fields=fields,
                                        body={'properties': property_dict}).execute()
     return file_name
 
 
+@adaptive
+@instrumentation.timed('drive.get_property')
 def get_property(file_id, property_name, service=SERVICE):
     if not service:
         service = setup_drive_service()
@@ -315,6 +630,16 @@ def get_property(file_id, property_name, service=SERVICE):
     return file_property['properties'][property_name]
 
 
+@adaptive
+@instrumentation.timed('drive.get_file_version')
+def get_file_version(file_id, service=SERVICE):
+    '''Return {'version', 'modifiedTime'}; version increases with every change to the file'''
+    if not service:
+        service = setup_drive_service()
+    return service.files().get(fileId=file_id, fields='version, modifiedTime').execute()
+
+
+@instrumentation.timed('drive.comment_reply')
 def comment_reply(file_id, comment_id, message, service=SERVICE):
     if not service:
         service = setup_drive_service()
@@ -325,25 +650,124 @@ def comment_reply(file_id, comment_id, message, service=SERVICE):
     return reply_id
 
 
+def _execute_batches(requests, service):
+    '''Send requests in batches of BATCH_SIZE and return the indexes of those that failed'''
+    failed = set()
+
+    def callback(request_id, response, exception):
+        if exception is not None:
+            failed.add(int(request_id))
+
+    for i in range(0, len(requests), BATCH_SIZE):
+        batch = service.new_batch_http_request(callback=callback)
+        for j, request in enumerate(requests[i:i + BATCH_SIZE]):
+            # request ids must be unique within a batch
+            batch.add(request, request_id=str(i + j))
+        batch.execute()
+    return failed
+
+
+@instrumentation.timed('drive.batch_set_properties')
+def batch_set_properties(file_ids, property_dict, service=SERVICE):
+    '''Set the same properties on each file in batched requests and return the ids that failed'''
+    if not service:
+        service = setup_drive_service()
+    requests = [service.files().update(fileId=file_id, fields='name', body={'properties': property_dict})
+                for file_id in file_ids]
+    failed = _execute_batches(requests, service)
+    return [file_id for i, file_id in enumerate(file_ids) if i in failed]
+
+
+@instrumentation.timed('drive.batch_comment_replies')
+def batch_comment_replies(replies, message, property_dict=None, service=SERVICE):
+    """Reply to comments and optionally set file properties in batched requests.
+
+    replies is a list of (file_id, comment_id) pairs. Returns the pairs whose
+    reply failed, to be retried on the next run, and the pairs that got their
+    reply but not the properties, which are retried once here and must then
+    only have the properties set again.
+    """
+    if not service:
+        service = setup_drive_service()
+    requests = [service.replies().create(fileId=file_id,
+                                         commentId=comment_id,
+                                         body={'content': message},
+                                         fields='id')
+                for file_id, comment_id in replies]
+    failed = _execute_batches(requests, service)
+    failed_replies = [pair for i, pair in enumerate(replies) if i in failed]
+    replied = [pair for i, pair in enumerate(replies) if i not in failed]
+    failed_properties = []
+    if property_dict and replied:
+        file_ids = [file_id for file_id, comment_id in replied]
+        unset = batch_set_properties(file_ids, property_dict, service)
+        if unset:
+            unset = batch_set_properties(unset, property_dict, service)
+        failed_properties = [pair for pair in replied if pair[0] in unset]
+    return failed_replies, failed_properties
+
+
+def iter_files_updated_after_in_directory(date, parent_id, service=SERVICE, prefetch=True):
+    query = "mimeType != 'application/vnd.google-apps.folder' and '{}' in parents and modifiedTime > '{}'".format(parent_id, date)
+    return _iter_files(query, 'id, name, modifiedTime, parents, properties', service, prefetch)
+
+
+@instrumentation.timed('drive.get_files_updated_after_in_directory')
 def get_files_updated_after_in_directory(date, parent_id, service=SERVICE):
+    return list(iter_files_updated_after_in_directory(date, parent_id, service, prefetch=False))
+
+
+@instrumentation.timed('drive.get_start_page_token')
+def get_start_page_token(service=SERVICE):
     if not service:
         service = setup_drive_service()
-    page_token = None
-    files = []
+    response = service.changes().getStartPageToken().execute()
+    return response['startPageToken']
+
+
+@instrumentation.timed('drive.get_changes')
+def get_changes(page_token, service=SERVICE):
+    """List changes since page_token.
+
+    Returns:
+        (changes, new_start_page_token) where the token is saved for the next call.
+    """
+    if not service:
+        service = setup_drive_service()
+    changes = []
     while True:
-        response = service.files().list(q="mimeType != 'application/vnd.google-apps.folder' and '{}' in parents and modifiedTime > '{}'".format(parent_id, date),
-                                        spaces='drive',
-                                        fields='nextPageToken, files(id, name, modifiedTime)',
-                                        pageToken=page_token).execute()
-        files.extend(response.get('files', []))
+        response = service.changes().list(pageToken=page_token,
+                                          spaces='drive',
+                                          includeRemoved=True,
+                                          fields='nextPageToken, newStartPageToken, changes(fileId, removed, file(id, name, mimeType, modifiedTime, parents, properties, trashed))').execute()
+        changes.extend(response.get('changes', []))
+        if 'newStartPageToken' in response:
+            return changes, response['newStartPageToken']
+        page_token = response['nextPageToken']
+
+
+@instrumentation.timed('drive.watch_changes')
+def watch_changes(page_token, channel_id, address, service=SERVICE, expiration_ms=None):
+    """Ask Drive to POST change notifications for page_token to the https address."""
+    if not service:
+        service = setup_drive_service()
+    body = {'id': channel_id,
+            'type': 'web_hook',
+            'address': address}
+    if expiration_ms:
+        body['expiration'] = expiration_ms
+    return service.changes().watch(pageToken=page_token, body=body).execute()
 
-        page_token = response.get('nextPageToken', None)
-        if page_token is None:
-            break
 
-    return files
+@instrumentation.timed('drive.stop_channel')
+def stop_channel(channel_id, resource_id, service=SERVICE):
+    if not service:
+        service = setup_drive_service()
+    service.channels().stop(body={'id': channel_id, 'resourceId': resource_id}).execute()
 
 
+@adaptive
+@instrumentation.timed('drive.get_doc_as_string')
 def get_doc_as_string(file_id, service=SERVICE):
     if not service:
         service = setup_drive_service()
@@ -355,20 +779,24 @@ def get_doc_as_string(file_id, service=SERVICE):
                                         body=copy_metadata,
                                         fields='id').execute()
     temp_id = copy_request['id']
-    request = service.files().export_media(fileId=temp_id,
-                                           mimeType='text/plain')
-    fh = io.BytesIO()
-    downloader = MediaIoBaseDownload(fh, request)
-    done = False
-    while done is False:
-        status, done = downloader.next_chunk()
-    byte_string = fh.getvalue()
-    text = byte_string.decode("utf-8-sig'")
-    # print text
-    service.files().delete(fileId=temp_id).execute()
+    # The temp copy is deleted even when the export fails, since a retry makes a new copy
+    try:
+        request = service.files().export_media(fileId=temp_id,
+                                               mimeType='text/plain')
+        fh = io.BytesIO()
+        downloader = MediaIoBaseDownload(fh, request)
+        done = False
+        while done is False:
+            status, done = downloader.next_chunk()
+        byte_string = fh.getvalue()
+        text = byte_string.decode("utf-8-sig'")
+        # print text
+    finally:
+        service.files().delete(fileId=temp_id).execute()
     return text
 
 
+@instrumentation.timed('drive.get_doc_as_string_test')
 def get_doc_as_string_test(file_id, service=SERVICE):
     if not service:
         service = setup_drive_service()
@@ -386,24 +814,14 @@ def get_doc_as_string_test(file_id, service=SERVICE):
     return text
 
 
-def get_id_from_meta_src(meta_src_name, meta_src_property, service=SERVICE):
-    if not service:
-        service = setup_drive_service()
-    page_token = None
-    files = []
+def iter_id_from_meta_src(meta_src_name, meta_src_property, service=SERVICE, prefetch=True):
     query = "mimeType != 'application/vnd.google-apps.folder' and not properties has {{ key='{}' and value='{}'}}".format(meta_src_property, meta_src_name)
-    while True:
-        response = service.files().list(q=query,
-                                        spaces='drive',
-                                        fields='nextPageToken, files(id, name)',
-                                        pageToken=page_token).execute()
-        files.extend(response.get('files', []))
+    return _iter_files(query, 'id, name', service, prefetch)
 
-        page_token = response.get('nextPageToken', None)
-        if page_token is None:
-            break
 
-    return files
+@instrumentation.timed('drive.get_id_from_meta_src')
+def get_id_from_meta_src(meta_src_name, meta_src_property, service=SERVICE):
+    return list(iter_id_from_meta_src(meta_src_name, meta_src_property, service, prefetch=False))
 
 
 if __name__ == '__main__':
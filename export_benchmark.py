@@ -0,0 +1,315 @@
+'''Benchmark metadata_export translation stages on synthetic ArcGIS FGDC exports
+'''
+import os
+import sys
+import json
+import shutil
+import hashlib
+import argparse
+import tempfile
+import subprocess
+from time import strftime
+from timeit import default_timer
+import xml.etree.ElementTree as ET
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows
+    resource = None
+
+
+date_time_run = strftime("%Y%m%d_%H%M%S")
+
+
+TEMPLATE_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates')
+BENCHMARK_DIRECTORY = 'data/outputs/benchmarks'
+
+
+# name: (layer count, attribute fields, domain values per field, thumbnail bytes)
+SIZES = {
+    'small': (50, 10, 0, 0),
+    'medium': (20, 150, 10, 20000),
+    'parcels': (5, 2000, 50, 200000)
+}
+
+
+STAGES = [
+    'setup',
+    'write_fields_to_xml',
+    'prettify',
+    'update_digform_elements',
+    'format_titles'
+]
+
+
+def _sub_text(parent, tag, text):
+    element = ET.SubElement(parent, tag)
+    element.text = text
+    return element
+
+
+def create_synthetic_export(xml_path, feature_name, fields, domain_values, thumbnail_bytes):
+    '''Write an ArcGIS FGDC style export with an eainfo section of the requested size
+    '''
+    root = ET.Element('metadata')
+    idinfo = ET.SubElement(root, 'idinfo')
+    citeinfo = ET.SubElement(ET.SubElement(idinfo, 'citation'), 'citeinfo')
+    _sub_text(citeinfo, 'origin', 'Utah AGRC')
+    _sub_text(citeinfo, 'pubdate', '20170101')
+    _sub_text(citeinfo, 'title', feature_name)
+    descript = ET.SubElement(idinfo, 'descript')
+    _sub_text(descript, 'abstract', 'Synthetic abstract for {}. '.format(feature_name) * 20)
+    _sub_text(descript, 'purpose', 'Synthetic purpose for {}.'.format(feature_name))
+    timeperd = ET.SubElement(idinfo, 'timeperd')
+    _sub_text(ET.SubElement(ET.SubElement(timeperd, 'timeinfo'), 'sngdate'), 'caldate', '2016')
+    _sub_text(timeperd, 'current', 'publication date')
+    bounding = ET.SubElement(ET.SubElement(idinfo, 'spdom'), 'bounding')
+    for bound, value in (('westbc', '-114.05'), ('eastbc', '-109.04'), ('northbc', '42.00'), ('southbc', '36.99')):
+        _sub_text(bounding, bound, value)
+    theme = ET.SubElement(ET.SubElement(idinfo, 'keywords'), 'theme')
+    _sub_text(theme, 'themekt', 'None')
+    for keyword in ('SGID', 'Utah', feature_name.split('.')[1].title()):
+        _sub_text(theme, 'themekey', keyword)
+    _sub_text(idinfo, 'accconst', 'None')
+    _sub_text(idinfo, 'useconst', 'None')
+
+    detailed = ET.SubElement(ET.SubElement(root, 'eainfo'), 'detailed')
+    _sub_text(ET.SubElement(detailed, 'enttyp'), 'enttypl', feature_name)
+    for i in range(fields):
+        attr = ET.SubElement(detailed, 'attr')
+        _sub_text(attr, 'attrlabl', 'FIELD_{}'.format(i))
+        _sub_text(attr, 'attrdef', 'Definition of field {} in {}'.format(i, feature_name))
+        _sub_text(attr, 'attrdefs', 'Esri')
+        attrdomv = ET.SubElement(attr, 'attrdomv')
+        for v in range(domain_values):
+            edom = ET.SubElement(attrdomv, 'edom')
+            _sub_text(edom, 'edomv', str(v))
+            _sub_text(edom, 'edomvd', 'Domain value {} of field {}'.format(v, i))
+            _sub_text(edom, 'edomvds', 'Producer defined')
+        if domain_values == 0:
+            _sub_text(attrdomv, 'udom', 'Free text')
+
+    metainfo = ET.SubElement(root, 'metainfo')
+    _sub_text(metainfo, 'metd', '20170101')
+    if thumbnail_bytes:
+        thumbnail = ET.SubElement(ET.SubElement(root, 'Binary'), 'Thumbnail')
+        data = _sub_text(thumbnail, 'Data', ('iVBORw0KGgoAAAANSUhEUgAA' * (thumbnail_bytes // 24 + 1))[:thumbnail_bytes])
+        data.set('EsriPropertyType', 'PictureX')
+
+    ET.ElementTree(root).write(xml_path, encoding='UTF-8')
+
+
+def peak_rss_kb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak = peak // 1024
+    return peak
+
+
+def _timed(results, stage, func, *args):
+    start = default_timer()
+    value = func(*args)
+    results[stage] = results.get(stage, 0.0) + default_timer() - start
+    return value
+
+
+def output_digest(output_directory):
+    '''Hash the canonical form of every output so backends can be compared'''
+    import xml_backend
+    digest = hashlib.sha1()
+    for name in sorted(os.listdir(output_directory)):
+        root = xml_backend.parse(os.path.join(output_directory, name)).getroot()
+        digest.update(xml_backend.canonical(root).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def create_synthetic_sources(size_name, work_directory):
+    layers, fields, domain_values, thumbnail_bytes = SIZES[size_name]
+    source_directory = os.path.join(work_directory, 'data')
+    os.makedirs(os.path.join(source_directory, 'outputs'))
+    for i in range(layers):
+        feature_name = 'SGID10.BENCHMARK.{}Layer{}'.format(size_name.title(), i)
+        xml_path = os.path.join(source_directory, feature_name + '.xml')
+        create_synthetic_export(xml_path, feature_name, fields, domain_values, thumbnail_bytes)
+
+
+def run_size(size_name, work_directory):
+    '''Time each translation stage for the synthetic sources in work_directory
+    '''
+    import metadata_export
+    import xml_backend
+    layers, fields, domain_values, thumbnail_bytes = SIZES[size_name]
+    source_directory = os.path.join(work_directory, 'data')
+    output_directory = os.path.join(source_directory, 'outputs')
+    source_xmls = sorted(os.path.join(source_directory, name)
+                         for name in os.listdir(source_directory) if name.endswith('.xml'))
+    source_bytes = sum(os.path.getsize(xml) for xml in source_xmls)
+
+    empty_template = os.path.join(TEMPLATE_DIRECTORY, 'GISI-metadata-empty-machine.xml')
+    resources = (
+        (metadata_export.FormName.DOWNLOADABLE_GDB, 'ftp://ftp.agrc.utah.gov/benchmark_gdb.zip'),
+        (metadata_export.FormName.DOWNLOADABLE_SHAPEFILE, 'ftp://ftp.agrc.utah.gov/benchmark_shp.zip')
+    )
+
+    seconds = {}
+    translators = []
+    for xml in source_xmls:
+        template_tree = xml_backend.parse(empty_template)
+        translator = _timed(seconds, 'setup', metadata_export.BaseTranslator, xml, resources, template_tree)
+        translator.output_xml = os.path.join(output_directory, os.path.basename(xml))
+        translators.append(translator)
+
+    for translator in translators:
+        _timed(seconds, 'write_fields_to_xml', translator.write_fields_to_xml)
+        _timed(seconds, 'prettify', translator.prettify, translator.template_tree.getroot())
+
+    for translator in translators:
+        _timed(seconds, 'update_digform_elements',
+               metadata_export.update_digform_elements, translator.output_xml, resources)
+
+    current_directory = os.getcwd()
+    stdout = sys.stdout
+    os.chdir(work_directory)
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        _timed(seconds, 'format_titles', metadata_export.format_titles)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+        os.chdir(current_directory)
+
+    stage_results = {}
+    for stage in STAGES:
+        stage_seconds = seconds.get(stage, 0.0)
+        stage_results[stage] = {
+            'seconds': stage_seconds,
+            'layers_per_sec': layers / stage_seconds if stage_seconds else None
+        }
+
+    return {
+        'backend': xml_backend.BACKEND,
+        'output_digest': output_digest(output_directory),
+        'layers': layers,
+        'fields': fields,
+        'domain_values': domain_values,
+        'thumbnail_bytes': thumbnail_bytes,
+        'source_bytes': source_bytes,
+        'stages': stage_results,
+        'peak_rss_kb': peak_rss_kb()
+    }
+
+
+def run_size_isolated(size_name, backend):
+    '''Run one size in a fresh interpreter so peak RSS covers only the timed stages
+    '''
+    work_directory = tempfile.mkdtemp(prefix='export_benchmark_')
+    env = dict(os.environ)
+    env['METADATA_XML_BACKEND'] = backend
+    try:
+        create_synthetic_sources(size_name, work_directory)
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                          '--single', size_name, '--work', work_directory],
+                                         cwd=os.path.dirname(os.path.abspath(__file__)),
+                                         env=env)
+    finally:
+        shutil.rmtree(work_directory)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def print_comparison(old_sizes, new_sizes):
+    for size_name in sorted(new_sizes):
+        if size_name not in old_sizes:
+            continue
+        for stage in STAGES:
+            new = new_sizes[size_name]['stages'][stage]['seconds']
+            old = old_sizes[size_name]['stages'][stage]['seconds']
+            ratio = new / old if old else float('nan')
+            print '  {:<8} {:<24} {:>9.4f}s -> {:>9.4f}s  x{:.2f}'.format(size_name, stage, old, new, ratio)
+
+
+def compare_to_baseline(results, baseline_path):
+    with open(baseline_path, 'r') as baseline_file:
+        baseline = json.load(baseline_file)
+    for backend in sorted(results['backends']):
+        if backend not in baseline['backends']:
+            continue
+        print 'Compared to baseline {} ({}), {} backend'.format(baseline_path, baseline.get('run'), backend)
+        print_comparison(baseline['backends'][backend]['sizes'], results['backends'][backend]['sizes'])
+
+
+def compare_backends(results):
+    '''Print the speedup of each backend over stdlib and whether outputs are equivalent'''
+    if 'stdlib' not in results['backends']:
+        return
+    stdlib_sizes = results['backends']['stdlib']['sizes']
+    for backend in sorted(results['backends']):
+        if backend == 'stdlib':
+            continue
+        sizes = results['backends'][backend]['sizes']
+        print 'stdlib -> {}'.format(backend)
+        print_comparison(stdlib_sizes, sizes)
+        for size_name in sorted(sizes):
+            equivalent = sizes[size_name]['output_digest'] == stdlib_sizes[size_name]['output_digest']
+            print '  {:<8} output equivalent to stdlib: {}'.format(size_name, equivalent)
+            if not equivalent:
+                results['equivalent'] = False
+
+
+def print_results(sizes):
+    for size_name in sorted(sizes):
+        size_result = sizes[size_name]
+        print '{} ({} layers, {} bytes of source xml, peak RSS {} KB)'.format(size_name,
+                                                                             size_result['layers'],
+                                                                             size_result['source_bytes'],
+                                                                             size_result['peak_rss_kb'])
+        for stage in STAGES:
+            stage_result = size_result['stages'][stage]
+            print '  {:<24} {:>9.4f}s {:>10.1f} layers/sec'.format(stage,
+                                                                  stage_result['seconds'],
+                                                                  stage_result['layers_per_sec'] or 0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark metadata_export on synthetic ArcGIS exports')
+    parser.add_argument('--sizes', nargs='+', choices=sorted(SIZES), default=sorted(SIZES),
+                        help='Synthetic export sizes to run')
+    parser.add_argument('--output', action='store', dest='output',
+                        default=os.path.join(BENCHMARK_DIRECTORY, 'export_{}.json'.format(date_time_run)),
+                        help='JSON file to save results to')
+    parser.add_argument('--baseline', action='store', dest='baseline',
+                        help='Previous results JSON to compare against')
+    parser.add_argument('--backends', nargs='+', choices=['lxml', 'stdlib'], default=['lxml'],
+                        help='XML backends to run, give both to compare speed and output equivalence')
+    parser.add_argument('--single', action='store', dest='single', help=argparse.SUPPRESS)
+    parser.add_argument('--work', action='store', dest='work', help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.single:
+        print json.dumps(run_size(args.single, args.work))
+        sys.exit(0)
+
+    results = {'run': date_time_run, 'python': sys.version.split()[0], 'backends': {}, 'equivalent': True}
+    for backend in args.backends:
+        sizes = {}
+        for size_name in args.sizes:
+            sizes[size_name] = run_size_isolated(size_name, backend)
+        # lxml falls back to stdlib when it is not installed
+        backend = sizes[args.sizes[0]]['backend']
+        results['backends'][backend] = {'sizes': sizes}
+        print '{} backend'.format(backend)
+        print_results(sizes)
+
+    compare_backends(results)
+    output_directory = os.path.dirname(args.output)
+    if output_directory and not os.path.exists(output_directory):
+        os.makedirs(output_directory)
+    with open(args.output, 'w') as f_out:
+        f_out.write(json.dumps(results, sort_keys=True, indent=4))
+    print 'Saved', args.output
+
+    if args.baseline:
+        compare_to_baseline(results, args.baseline)
@@ -0,0 +1,172 @@
+'''Catalogue of SGID feature classes indexed by category and name
+
+The catalogue is cached in data/outputs/temp/fc_catalogue.json. Each category
+is listed through its own connection from connections.json and only relisted
+once its listing is older than the TTL, so a refresh lists the stale
+categories instead of the whole SDE.
+'''
+import os
+import json
+from time import time, strftime
+import instrumentation
+
+
+CATALOGUE = 'data/outputs/temp/fc_catalogue.json'
+# Flat listing written by earlier versions of get_features_in_workspace
+LEGACY_FEATURECLASSES = 'data/outputs/temp/fcs.json'
+SGID_WORKSPACE = r'Database Connections\Connection to sgid.agrc.utah.gov.sde'
+TTL_SECONDS = 24 * 60 * 60
+
+
+def get_category(featurename):
+    return featurename.split('.')[1]
+
+
+class FeatureClassCatalogue(object):
+
+    def __init__(self, json_path=CATALOGUE, ttl_seconds=TTL_SECONDS):
+        self.json_path = json_path
+        self.ttl_seconds = ttl_seconds
+        # CATEGORY -> {'listed': epoch seconds, 'featureclasses': [full names]}
+        self.categories = {}
+        self._by_name = {}
+        # Categories relisted by find_listed in this process
+        self._relisted = set()
+
+        if os.path.exists(json_path):
+            with open(json_path, 'r') as json_file:
+                self.categories = json.load(json_file)['categories']
+        elif os.path.exists(LEGACY_FEATURECLASSES):
+            with open(LEGACY_FEATURECLASSES, 'r') as json_file:
+                featureclasses = json.load(json_file)['featureclasses']
+            self._set_listing(featureclasses, os.path.getmtime(LEGACY_FEATURECLASSES))
+        self._index()
+
+    def __len__(self):
+        return len(self._by_name)
+
+    def _index(self):
+        self._by_name = {}
+        for category in self.categories.values():
+            for featurename in category['featureclasses']:
+                self._by_name[featurename.lower()] = featurename
+
+    def _set_listing(self, featureclasses, listed, categories=None):
+        '''Replace the listed categories, dropping any of categories that came back empty'''
+        grouped = {}
+        for featurename in featureclasses:
+            grouped.setdefault(get_category(featurename).upper(), []).append(featurename)
+        for category in categories or []:
+            if category not in grouped:
+                self.categories.pop(category, None)
+        for category, names in grouped.items():
+            self.categories[category] = {'listed': listed, 'featureclasses': sorted(names)}
+
+    def save(self):
+        directory = os.path.dirname(self.json_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(self.json_path, 'w') as f_out:
+            f_out.write(json.dumps({'categories': self.categories,
+                                    'upload_time_local': strftime("%Y_%m_%d %H:%M:%S")},
+                                   sort_keys=True, indent=4))
+
+    def category_names(self):
+        return set(self.categories)
+
+    def in_categories(self, categories):
+        '''Feature class names in any of categories, in catalogue order'''
+        featurenames = []
+        for category in categories:
+            if category.upper() in self.categories:
+                featurenames.extend(self.categories[category.upper()]['featureclasses'])
+        return featurenames
+
+    def find(self, featurename):
+        '''Catalogue spelling of featurename, matched ignoring case, or None'''
+        return self._by_name.get(featurename.lower())
+
+    def find_listed(self, featurename, connections_json='connections.json'):
+        '''Like find, but a miss relists the feature class's category once per process
+
+        Feature classes created since the category was listed are found without
+        waiting for its listing to go stale.
+        '''
+        found = self.find(featurename)
+        category = get_category(featurename).upper()
+        if found is None and category not in self._relisted:
+            self._relisted.add(category)
+            self.refresh([category], connections_json, force=True)
+            found = self.find(featurename)
+        return found
+
+    def resolve(self, featurenames):
+        '''Split featurenames into (catalogue names found, names missing from the catalogue)'''
+        found = []
+        missing = []
+        for featurename in featurenames:
+            name = self.find(featurename)
+            if name is None:
+                missing.append(featurename)
+            else:
+                found.append(name)
+        return found, missing
+
+    def stale_categories(self, categories=None):
+        now = time()
+        categories = [c.upper() for c in categories] if categories else self.categories.keys()
+        return sorted(c for c in categories
+                      if c not in self.categories or now - self.categories[c]['listed'] > self.ttl_seconds)
+
+    @instrumentation.timed('catalogue.refresh')
+    def refresh(self, categories=None, connections_json='connections.json', force=False):
+        '''Relist stale categories through their own connections, returning the categories listed'''
+        import arcpy
+        with open(connections_json, 'r') as json_file:
+            connections = json.load(json_file)
+        connections.pop('upload_time_local', None)
+        if categories is None:
+            categories = connections.keys()
+        categories = [c.upper() for c in categories]
+        if not force:
+            categories = self.stale_categories(categories)
+
+        listed = []
+        for category in categories:
+            connection = connections.get(category)
+            if connection is None:
+                print 'No connection for', category
+                continue
+            arcpy.env.workspace = connection
+            with instrumentation.stage('arcpy.list_featureclasses'):
+                featureclasses = arcpy.ListFeatureClasses('*.{}.*'.format(category)) or []
+            self._set_listing(featureclasses, time(), [category])
+            listed.append(category)
+
+        if listed:
+            self._index()
+            self.save()
+        return listed
+
+    @instrumentation.timed('catalogue.refresh_workspace')
+    def refresh_workspace(self, workspace=SGID_WORKSPACE):
+        '''Relist every feature class in workspace'''
+        import arcpy
+        arcpy.env.workspace = workspace
+        with instrumentation.stage('arcpy.list_featureclasses'):
+            featureclasses = arcpy.ListFeatureClasses() or []
+        self.categories = {}
+        self._set_listing(featureclasses, time())
+        self._index()
+        self.save()
+
+
+_catalogue = None
+
+
+def get_catalogue():
+    '''Catalogue shared by the process, loaded on first use'''
+    global _catalogue
+    if _catalogue is None:
+        _catalogue = FeatureClassCatalogue()
+    return _catalogue
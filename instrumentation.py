@@ -0,0 +1,252 @@
+'''Counters, gauges and latency histograms for Drive API calls and pipeline stages
+
+Disabled by default. Call enable() before a run and write_report() or
+write_prometheus() after it. While disabled, timed functions call straight
+through and stage() returns a shared no-op context manager. profiling.enable()
+sets a hook that runs stage operations under a profiler.
+'''
+import os
+import json
+import threading
+from functools import wraps
+from time import strftime
+from timeit import default_timer
+
+
+ENABLED = False
+
+
+# Upper bounds in seconds for latency buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+_gauges = {}
+_started = None
+# Set by profiling.enable(): called with an operation name, returns a context
+# manager to run the operation under or None
+_profile_hook = None
+
+
+class Histogram(object):
+    '''Latency distribution for one operation'''
+
+    __slots__ = ('bucket_counts', 'count', 'errors', 'total', 'minimum', 'maximum')
+
+    def __init__(self):
+        self.bucket_counts = [0] * len(BUCKETS)
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.minimum = None
+        self.maximum = None
+
+    def observe(self, seconds, error=False):
+        self.count += 1
+        self.total += seconds
+        if error:
+            self.errors += 1
+        if self.minimum is None or seconds < self.minimum:
+            self.minimum = seconds
+        if self.maximum is None or seconds > self.maximum:
+            self.maximum = seconds
+        for i, bound in enumerate(BUCKETS):
+            if seconds <= bound:
+                self.bucket_counts[i] += 1
+                break
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'total_seconds': self.total,
+            'mean_seconds': self.total / self.count if self.count else None,
+            'min_seconds': self.minimum,
+            'max_seconds': self.maximum,
+            'buckets': dict(zip([str(b) for b in BUCKETS], self.bucket_counts))
+        }
+
+
+def enable():
+    global ENABLED, _started
+    ENABLED = True
+    if _started is None:
+        _started = strftime("%Y-%m-%dT%H:%M:%S")
+
+
+def disable():
+    global ENABLED
+    ENABLED = False
+
+
+def reset():
+    global _started
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+        _gauges.clear()
+    _started = None
+
+
+def set_profile_hook(hook):
+    global _profile_hook
+    _profile_hook = hook
+
+
+def count(name, value=1):
+    if not ENABLED:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def gauge(name, value):
+    '''Set the current value of name, e.g. a concurrency limit'''
+    if not ENABLED:
+        return
+    with _lock:
+        _gauges[name] = value
+
+
+def observe(operation, seconds, error=False):
+    if not ENABLED:
+        return
+    with _lock:
+        histogram = _histograms.get(operation)
+        if histogram is None:
+            histogram = _histograms[operation] = Histogram()
+        histogram.observe(seconds, error)
+
+
+def timed(operation):
+    '''Decorator recording the latency of every call under operation'''
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not ENABLED and _profile_hook is None:
+                return func(*args, **kwargs)
+            capture = _profile_hook(operation) if _profile_hook is not None else None
+            if capture is not None:
+                with capture:
+                    return observed(*args, **kwargs)
+            return observed(*args, **kwargs)
+
+        def observed(*args, **kwargs):
+            start = default_timer()
+            try:
+                result = func(*args, **kwargs)
+            except Exception:
+                observe(operation, default_timer() - start, error=True)
+                raise
+            observe(operation, default_timer() - start)
+            return result
+        return wrapper
+    return decorator
+
+
+class _Stage(object):
+
+    __slots__ = ('operation', 'start', 'capture')
+
+    def __init__(self, operation, capture=None):
+        self.operation = operation
+        self.start = None
+        self.capture = capture
+
+    def __enter__(self):
+        if self.capture is not None:
+            self.capture.__enter__()
+        self.start = default_timer()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        observe(self.operation, default_timer() - self.start, error=exc_type is not None)
+        if self.capture is not None:
+            self.capture.__exit__(exc_type, exc_value, traceback)
+        return False
+
+
+class _NullStage(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(operation):
+    '''Context manager recording the latency of a block under operation'''
+    if _profile_hook is not None:
+        capture = _profile_hook(operation)
+        if capture is not None:
+            return _Stage(operation, capture)
+    if not ENABLED:
+        return _NULL_STAGE
+    return _Stage(operation)
+
+
+def report():
+    with _lock:
+        return {
+            'started': _started,
+            'finished': strftime("%Y-%m-%dT%H:%M:%S"),
+            'operations': dict((name, h.to_dict()) for name, h in _histograms.items()),
+            'counters': dict(_counters),
+            'gauges': dict(_gauges)
+        }
+
+
+def write_report(json_path):
+    directory = os.path.dirname(json_path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(json_path, 'w') as f_out:
+        f_out.write(json.dumps(report(), sort_keys=True, indent=4))
+
+
+def _prometheus_name(name):
+    return ''.join(c if c.isalnum() else '_' for c in name)
+
+
+def write_prometheus(text_path, prefix='metadata'):
+    '''Write histograms and counters in Prometheus text exposition format'''
+    lines = []
+    with _lock:
+        histograms = sorted(_histograms.items())
+        counters = sorted(_counters.items())
+        gauges = sorted(_gauges.items())
+    seconds_name = '{}_operation_seconds'.format(prefix)
+    lines.append('# HELP {} Latency of metadata pipeline operations.'.format(seconds_name))
+    lines.append('# TYPE {} histogram'.format(seconds_name))
+    for operation, histogram in histograms:
+        cumulative = 0
+        for bound, bucket_count in zip(BUCKETS, histogram.bucket_counts):
+            cumulative += bucket_count
+            lines.append('{}_bucket{{operation="{}",le="{}"}} {}'.format(seconds_name, operation, bound, cumulative))
+        lines.append('{}_bucket{{operation="{}",le="+Inf"}} {}'.format(seconds_name, operation, histogram.count))
+        lines.append('{}_sum{{operation="{}"}} {}'.format(seconds_name, operation, histogram.total))
+        lines.append('{}_count{{operation="{}"}} {}'.format(seconds_name, operation, histogram.count))
+    errors_name = '{}_operation_errors_total'.format(prefix)
+    lines.append('# TYPE {} counter'.format(errors_name))
+    for operation, histogram in histograms:
+        lines.append('{}{{operation="{}"}} {}'.format(errors_name, operation, histogram.errors))
+    for name, value in counters:
+        counter_name = '{}_{}_total'.format(prefix, _prometheus_name(name))
+        lines.append('# TYPE {} counter'.format(counter_name))
+        lines.append('{} {}'.format(counter_name, value))
+    for name, value in gauges:
+        gauge_name = '{}_{}'.format(prefix, _prometheus_name(name))
+        lines.append('# TYPE {} gauge'.format(gauge_name))
+        lines.append('{} {}'.format(gauge_name, value))
+
+    directory = os.path.dirname(text_path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(text_path, 'w') as f_out:
+        f_out.write('\n'.join(lines) + '\n')
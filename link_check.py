@@ -0,0 +1,276 @@
+'''Check the download and data page links written into GISI output xml
+
+Every digform networkr and onlink url in the output xml is checked once,
+however many layers share it. Worker threads keep one connection per host
+open between requests, each host gets at most a few requests at a time and
+results are cached, so links checked within the TTL are not requested again.
+Dead links are only trusted for the shorter failure TTL, so a host that was
+briefly down is checked again on the next run.
+ftp:// and http(s):// urls may carry a port, so a local stand-in server can
+take the place of the real hosts.
+'''
+import os
+import json
+import Queue
+import ftplib
+import socket
+import httplib
+import argparse
+import threading
+import urllib
+import urlparse
+from time import time, strftime
+import instrumentation
+import xml_backend
+
+
+LINK_CACHE = 'data/outputs/temp/link_cache.json'
+LINK_REPORT = 'data/outputs/reports/links_{}.json'.format(strftime("%Y%m%d_%H%M%S"))
+TTL_SECONDS = 7 * 24 * 60 * 60
+FAILURE_TTL_SECONDS = 60 * 60
+MAX_REDIRECTS = 5
+
+
+def extract_links(xml_files):
+    '''Return {url: [layer names]} for every networkr and onlink in xml_files'''
+    links = {}
+    for xml_path in xml_files:
+        layer = os.path.basename(xml_path).replace('.xml', '')
+        root = xml_backend.parse(xml_path).getroot()
+        for tag in ('networkr', 'onlink'):
+            for e in root.iter(tag):
+                url = (e.text or '').strip()
+                # Template placeholder text is not a link
+                if '://' in url:
+                    layers = links.setdefault(url, [])
+                    if layer not in layers:
+                        layers.append(layer)
+    return links
+
+
+class LinkChecker(object):
+
+    def __init__(self, workers=16, per_host=4, timeout=20, cache_path=LINK_CACHE, ttl_seconds=TTL_SECONDS,
+                 failure_ttl_seconds=FAILURE_TTL_SECONDS):
+        self.workers = workers
+        self.per_host = per_host
+        self.timeout = timeout
+        self.cache_path = cache_path
+        self.ttl_seconds = ttl_seconds
+        self.failure_ttl_seconds = failure_ttl_seconds
+        # url -> {'ok', 'status', 'checked'}
+        self.cache = {}
+        self._host_limits = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path, 'r') as json_file:
+                self.cache = json.load(json_file)
+
+    def save(self):
+        directory = os.path.dirname(self.cache_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(self.cache_path, 'w') as f_out:
+            f_out.write(json.dumps(self.cache, sort_keys=True, indent=4))
+
+    def _host_limit(self, host):
+        with self._lock:
+            if host not in self._host_limits:
+                self._host_limits[host] = threading.Semaphore(self.per_host)
+            return self._host_limits[host]
+
+    def _connections(self):
+        '''Open connections of the current worker thread, keyed by (scheme, host, port)'''
+        if not hasattr(self._local, 'connections'):
+            self._local.connections = {}
+        return self._local.connections
+
+    def _close_connections(self):
+        for connection in self._connections().values():
+            try:
+                if isinstance(connection, ftplib.FTP):
+                    connection.quit()
+                else:
+                    connection.close()
+            except Exception:
+                pass
+        self._local.connections = {}
+
+    def _http_status(self, url):
+        for i in range(MAX_REDIRECTS + 1):
+            parts = urlparse.urlsplit(url)
+            key = (parts.scheme, parts.hostname, parts.port)
+            connections = self._connections()
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+            for attempt in range(2):
+                connection = connections.get(key)
+                if connection is None:
+                    connection_class = httplib.HTTPSConnection if parts.scheme == 'https' else httplib.HTTPConnection
+                    connection = connections[key] = connection_class(parts.hostname, parts.port,
+                                                                     timeout=self.timeout)
+                try:
+                    connection.request('HEAD', path)
+                    response = connection.getresponse()
+                    response.read()
+                    break
+                except (httplib.HTTPException, socket.error):
+                    # The server may have closed a kept-alive connection; reconnect once
+                    connection.close()
+                    del connections[key]
+                    if attempt:
+                        raise
+            if response.status in (301, 302, 303, 307, 308) and response.getheader('location'):
+                url = urlparse.urljoin(url, response.getheader('location'))
+                continue
+            if response.status in (405, 501):
+                # HEAD not allowed; ask for one byte instead
+                connection.request('GET', path, headers={'Range': 'bytes=0-0'})
+                response = connection.getresponse()
+                response.read()
+            return response.status
+        return 'too many redirects'
+
+    def _ftp_status(self, url):
+        parts = urlparse.urlsplit(url)
+        key = ('ftp', parts.hostname, parts.port)
+        connections = self._connections()
+        for attempt in range(2):
+            ftp = connections.get(key)
+            if ftp is None:
+                ftp = ftplib.FTP(timeout=self.timeout)
+                ftp.connect(parts.hostname, parts.port or 21)
+                ftp.login(parts.username or 'anonymous', parts.password or '')
+                ftp.voidcmd('TYPE I')
+                connections[key] = ftp
+            try:
+                path = urllib.unquote(parts.path)
+                if path.endswith('/'):
+                    ftp.cwd(path)
+                    ftp.cwd('/')
+                else:
+                    ftp.size(path)
+                return 200
+            except ftplib.error_perm as e:
+                return str(e)
+            except (ftplib.error_temp, ftplib.error_reply, EOFError, socket.error):
+                # close, not quit, since the server may no longer answer commands
+                try:
+                    connections.pop(key).close()
+                except Exception:
+                    pass
+                if attempt:
+                    raise
+
+    @instrumentation.timed('links.check')
+    def check(self, url):
+        '''Return {'ok', 'status', 'checked'} for one url'''
+        parts = urlparse.urlsplit(url)
+        with self._host_limit(parts.netloc):
+            try:
+                if parts.scheme == 'ftp':
+                    status = self._ftp_status(url)
+                elif parts.scheme in ('http', 'https'):
+                    status = self._http_status(url)
+                else:
+                    status = 'unsupported scheme'
+            except Exception as e:
+                status = '{}: {}'.format(type(e).__name__, e)
+        ok = isinstance(status, int) and status < 400
+        return {'ok': ok, 'status': status, 'checked': time()}
+
+    def is_fresh(self, url):
+        result = self.cache.get(url)
+        if result is None:
+            return False
+        ttl_seconds = self.ttl_seconds if result['ok'] else self.failure_ttl_seconds
+        return time() - result['checked'] < ttl_seconds
+
+    def check_all(self, urls, refresh=False):
+        '''Check urls not checked within the TTL, returning {url: result} for all of them'''
+        pending = [url for url in urls if refresh or not self.is_fresh(url)]
+        instrumentation.count('links.cached', len(urls) - len(pending))
+        work = Queue.Queue()
+        for url in pending:
+            work.put(url)
+
+        def check_urls():
+            try:
+                while True:
+                    try:
+                        url = work.get_nowait()
+                    except Queue.Empty:
+                        return
+                    result = self.check(url)
+                    with self._lock:
+                        self.cache[url] = result
+            finally:
+                self._close_connections()
+
+        threads = [threading.Thread(target=check_urls, name='links-{}'.format(i))
+                   for i in range(min(self.workers, len(pending)))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return dict((url, self.cache[url]) for url in urls)
+
+
+def check_links(xml_files, checker=None, refresh=False, report_path=LINK_REPORT):
+    '''Check every link in xml_files and write the dead ones per layer'''
+    checker = checker if checker is not None else LinkChecker()
+    links = extract_links(xml_files)
+    results = checker.check_all(sorted(links), refresh)
+    checker.save()
+
+    dead = {}
+    for url, result in sorted(results.items()):
+        if not result['ok']:
+            for layer in links[url]:
+                dead.setdefault(layer, []).append({'url': url, 'status': result['status']})
+    report = {'links': len(links),
+              'dead_links': len([r for r in results.values() if not r['ok']]),
+              'layers_with_dead_links': len(dead),
+              'dead': dead}
+    if report_path:
+        directory = os.path.dirname(report_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(report_path, 'w') as f_out:
+            f_out.write(json.dumps(report, sort_keys=True, indent=4))
+    return report
+
+
+if __name__ == '__main__':
+    import metadata_conversion
+    parser = argparse.ArgumentParser(description='Check networkr and onlink urls in output xml')
+    parser.add_argument('--directory', action='store', dest='directory', default='data/outputs',
+                        help='Directory of output xml to check')
+    parser.add_argument('--workers', action='store', dest='workers', type=int, default=16,
+                        help='Concurrent checks')
+    parser.add_argument('--per_host', action='store', dest='per_host', type=int, default=4,
+                        help='Concurrent checks against one host')
+    parser.add_argument('--ttl', action='store', dest='ttl_hours', type=float, default=TTL_SECONDS / 3600,
+                        help='Hours a cached result for a working link is trusted')
+    parser.add_argument('--failure_ttl', action='store', dest='failure_ttl_hours', type=float,
+                        default=FAILURE_TTL_SECONDS / 3600,
+                        help='Hours a cached result for a dead link is trusted')
+    parser.add_argument('--refresh', action='store_true', dest='refresh',
+                        help='Check every link again, ignoring the cache')
+    parser.add_argument('--report', action='store', dest='report', default=LINK_REPORT,
+                        help='Where to write the dead link report')
+
+    args = parser.parse_args()
+    link_checker = LinkChecker(args.workers, args.per_host, ttl_seconds=args.ttl_hours * 3600,
+                               failure_ttl_seconds=args.failure_ttl_hours * 3600)
+    link_report = check_links(metadata_conversion.get_output_xml_files(args.directory), link_checker,
+                              args.refresh, args.report)
+    for layer_name, layer_links in sorted(link_report['dead'].items()):
+        for link in layer_links:
+            print '{}: {} ({})'.format(layer_name, link['url'], link['status'])
+    print 'Links: {}, dead: {}, layers affected: {}'.format(link_report['links'], link_report['dead_links'],
+                                                          link_report['layers_with_dead_links'])
+    print 'Report:', args.report
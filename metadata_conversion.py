@@ -4,21 +4,31 @@ import os
 import re
 import json
 import shutil
+import threading
+from collections import defaultdict
 from ntpath import normpath
-import xml.etree.ElementTree as ET
-from xml.dom import minidom
+import xml_backend
+from xml_backend import ET
 from datetime import datetime
 from time import strftime, clock
-import drive_loader
+import instrumentation
+import profiling
+import sync_journal
+import fc_catalogue
+import category_docs
+from drive_inventory import FileInventory
+from text_store import TextStore, text_key
 import csv
 import argparse
-# import gspread
-from oauth2client.service_account import ServiceAccountCredentials
 
 date_time_run = strftime("%Y%m%d_%H%M%S")
 
 
 LAST_GISI_OUTPUT = 'data/outputs/temp/lastgisi_output.json'
+COMMENT_CACHE = 'data/outputs/temp/comment_cache.json'
+# '<folder id>/<doc name>' -> {'id', 'text_key'} of the last uploaded text
+UPLOAD_CACHE = 'data/outputs/temp/upload_cache.json'
+RUN_REPORT = 'data/outputs/reports/run_{}.json'.format(date_time_run)
 
 
 ABSTRACTS_DRIVE_FOLDER = '0B3wvsjTJuTRQbV9hd1lXSGpTWUE'
@@ -26,55 +36,176 @@ CATEGORIES_FOLDER = '0B3wvsjTJuTRQVHdZaWdNZ19rdUk'
 ALL_FOLDER_ID = '0B3wvsjTJuTRQa1NaV2hLTnZkQm8'
 
 
+WAF_PATH = r'J:\UtahSGID_Vector\UTM12_NAD83\Metadata'
+WAF_EXCLUDED_XMLS = [
+    'SGID10.GEOSCIENCE.Units_MoabSanRafael.xml',
+    'SGID10.GEOSCIENCE.Units_Nephi.xml',
+    'SGID10.GEOSCIENCE.Units_Price.xml',
+    'SGID10.HEALTH.HealthDistricts.xml',
+    'SGID10.HEALTH.HealthDistricts2015.xml',
+    'SGID10.PLANNING.UWC2008CherryStemRoads.xml',
+    'SGID10.PLANNING.WildernessProp_RedRock.xml',
+    'SGID10.PLANNING.WildernessProp_WashingtonCo.xml',
+    'SGID10.CADASTRE.Parcels.xml',
+    'SGID10.CADASTRE.Parcels_LIR.xml',
+    'SGID10.TRANSPORTATION.RoadsODM.xml'
+]
+
+
 SRC_FILE_NAME_PROPERTY = 'metaSrcName'
+# A canonical doc linked to several layers is named for none of them; the
+# element stays last so syncs still read it from the name
+SHARED_DOC_NAME = 'Shared by {} layers_{}'
+SHARED_LAYERS_PROPERTY = 'metaSharedLayers'
 GISI_UPDATED_PROPERTY = 'metaGisiUpdated'
 
 
+COMPLETED_MATCHER = re.compile(r'#(completed|done|complete|finished|lgtm)')
+
+
 DEFUALT_DISCLAIMER = '''There are no constraints or warranties with regard to the use of this dataset. Users are encouraged to attribute content to: State of Utah, SGID.This product is for informational purposes and may not have been prepared for, or be suitable for legal, engineering, or surveying purposes. Users of this information should review or consult the primary data and information sources to ascertain the usability of the information. AGRC provides these data in good faith and shall in no event be liable for any incorrect results, any lost profits and special, indirect or consequential damages to any party, arising out of or in connection with the use or the inability to use the data hereon or the services provided. AGRC provides these data and services as a convenience to the public. Further more, AGRC reserves the right to change or revise published data and/or these services at any time.'''
 
 
-def load_text_to_drive(abstract_text, name, parent_id, suffix='_abstract'):
+def load_text_to_drive(abstract_text, name, parent_id, suffix='_abstract', upload_cache=None):
+    '''Upload text as a doc and return (its id, whether it was uploaded)
+
+    With an upload_cache, an existing doc is updated in place when its text
+    differs from the last upload, and left untouched when it does not.
+    '''
+    import drive_loader
     import StringIO
     if abstract_text is None:
         abstract_text = ' '
+    cache_key = '{}/{}'.format(parent_id, name + suffix)
+    uploaded_key = text_key(abstract_text)
+    if upload_cache is not None:
+        uploaded = upload_cache.get(cache_key)
+        if uploaded is not None and uploaded['text_key'] == uploaded_key:
+            instrumentation.count('upload.docs_unchanged')
+            return uploaded['id'], False
     txt = StringIO.StringIO()
     txt.write(abstract_text.encode('UTF-8'))
-    doc_id = drive_loader.create_google_doc(txt, parent_id, name + suffix)
+    doc_id = drive_loader.create_google_doc(txt, parent_id, name + suffix, update_existing=upload_cache is not None)
     txt.close()
-    return doc_id
+    if upload_cache is not None:
+        with _upload_cache_lock:
+            upload_cache[cache_key] = {'id': doc_id, 'text_key': uploaded_key}
+    return doc_id, True
+
+
+_upload_cache_lock = threading.Lock()
+
+
+def load_upload_cache(json_path=UPLOAD_CACHE):
+    if not os.path.exists(json_path):
+        return {}
+    return load_json(json_path, remove_update=True)
+
+
+def save_upload_cache(upload_cache, json_path=UPLOAD_CACHE):
+    '''Write the cache after each upload, so an interrupted run keeps the docs it already uploaded'''
+    with _upload_cache_lock:
+        save_json(json_path, upload_cache)
 
 
 def get_completed_comment(comments):
-    completed_matcher = re.compile(r'.*(#completed|#done|#complete|#finished|#lgtm)')
     for comment in comments:
         comment_string = comment['content']
-        if completed_matcher.match(comment_string.lower()):
+        if COMPLETED_MATCHER.search(comment_string.lower()):
             return comment['id']
     return None
 
 
 def mark_completed(file_id, comment_id):
+    import drive_loader
     reply_id = drive_loader.comment_reply(file_id, comment_id, '#updated')
     drive_loader.set_property(file_id, {'metaGisiUpdated': 'true'})
 
     return reply_id
 
 
-def mark_updated(file_id, update_time):
-    drive_loader.set_property(file_id, {'metaGisiUpdated': update_time})
+def mark_completed_batch(completed):
+    '''Reply to and mark (file_id, comment_id) pairs in batched requests
+
+    Returns the pairs whose reply failed and the pairs replied to but not marked.
+    '''
+    import drive_loader
+    return drive_loader.batch_comment_replies(completed, '#updated', {'metaGisiUpdated': 'true'})
 
 
+def mark_updated(file_id, update_time, service=None):
+    '''Record the update on the doc and return its new name and modifiedTime'''
+    import drive_loader
+    return drive_loader.set_property(file_id, {'metaGisiUpdated': update_time}, service, fields='name, modifiedTime')
+
+
+def triage_comments(parent_folder=ALL_FOLDER_ID, cache_path=COMMENT_CACHE):
+    '''Find docs with new completed tags and mark them, fetching only new comments
+
+    Only files modified since the last triage are checked, only comments
+    modified since then are fetched, and comment IDs already seen are skipped.
+    Comments whose reply failed are kept in the cache and replied to first on
+    the next triage, since their unchanged docs are not listed again.
+    '''
+    import drive_loader
+    if os.path.exists(cache_path):
+        cache = load_json(cache_path, remove_update=True)
+    else:
+        cache = {'last_triage': None, 'seen': {}}
+    # Docs replied to whose metaGisiUpdated property could not be set
+    unmarked = cache.get('unmarked', [])
+    if unmarked:
+        unmarked = drive_loader.batch_set_properties(unmarked, {'metaGisiUpdated': 'true'})
+    triage_time = datetime.utcnow().isoformat()
+    last_triage = cache['last_triage'] or '1970-01-01T00:00:00'
+    seen = cache['seen']
+
+    # Completed comments whose reply failed on an earlier triage
+    completed = [tuple(pair) for pair in cache.get('unreplied', [])]
+    files_checked = 0
+    for f in drive_loader.iter_files_updated_after_in_directory(last_triage, parent_folder):
+        files_checked += 1
+        file_id = f['id']
+        file_seen = set(seen.get(file_id, []))
+        comments = drive_loader.get_file_comments(file_id, start_modified_time=cache['last_triage'])
+        new_comments = [c for c in comments if c['id'] not in file_seen]
+        comment_id = get_completed_comment(new_comments)
+        if comment_id:
+            print 'Completed: ', f['name']
+            completed.append((file_id, comment_id))
+        file_seen.update(c['id'] for c in new_comments)
+        seen[file_id] = sorted(file_seen)
+
+    failed, failed_properties = mark_completed_batch(completed) if completed else ([], [])
+    for file_id, comment_id in failed:
+        print 'Mark failed: ', file_id, comment_id
+    for file_id, comment_id in failed_properties:
+        # Already replied to, so only the property is set again next triage
+        if file_id not in unmarked:
+            unmarked.append(file_id)
+        print 'Property update failed: ', file_id, comment_id
+
+    cache['last_triage'] = triage_time
+    cache['unmarked'] = unmarked
+    cache['unreplied'] = [list(pair) for pair in failed]
+    save_json(cache_path, cache)
+    print 'Files checked: {}, completed: {}, failed: {}'.format(files_checked, len(completed), len(failed))
+    return [pair for pair in completed if pair not in failed]
+
+
+@instrumentation.timed('xml.update_element')
 def update_xml_element(xml_path, element_text, element_name, only_empty=False):
     element_tree = ET.parse(xml_path)
     root = element_tree.getroot()
     for e in root.iter(element_name):
         if only_empty and not (e is None or e.text.strip() == '' or e.text.strip() == 'None'):
             return
-        e.text = element_text
-    element_tree.write(xml_path, encoding='UTF-8')
+        e.text = xml_backend.clean_text(element_text)
+    xml_backend.write(element_tree, xml_path)
 
 
 def assign_to_folder():
+    import drive_loader
     files = {
         'SGID10.CADASTRE.PLSSPoint_GCDB': '1S_UuAR541scal2ksJBnaXo5GK4vgKMKEAfYw6KMrDxY',
         'SGID10.CADASTRE.PLSSQuarterQuarterSections_GCDB': '1rDq_NbHHJTTyVX54u6y9_hhQFDRgsPCCAigT5H_9O4k',
@@ -99,6 +230,7 @@ def assign_to_folder():
 
 
 def list_updated_files(date, parent_folder=ALL_FOLDER_ID):
+    import drive_loader
     files = drive_loader.get_files_updated_after_in_directory(date, parent_folder)
     # for f in files:
     #     print 'Updated: ', f['name']
@@ -120,32 +252,249 @@ def save_json(json_path, properties):
         f_out.write(json.dumps(properties, sort_keys=True, indent=4))
 
 
-def check_files_and_update(past_update_time, parent_folder=ALL_FOLDER_ID):
+def get_doc_xml_path(drive_file, service=None):
+    '''Return the output xml a doc edits, from listed properties when available'''
+    xml_name = (drive_file.get('properties') or {}).get(SRC_FILE_NAME_PROPERTY)
+    if xml_name is None:
+        import drive_loader
+        xml_name = drive_loader.get_property(drive_file['id'], SRC_FILE_NAME_PROPERTY, service)
+    return os.path.join('data', 'outputs', xml_name)
+
+
+def get_linked_xml_paths(drive_file, xml_path, store=None):
+    '''Output xml files, other than xml_path, of the layers linked to a shared canonical doc'''
+    if store is None:
+        return []
+    paths = [os.path.join('data', 'outputs', name) for name in store.linked_xml_names(drive_file['id'])]
+    return [path for path in paths if path != xml_path]
+
+
+def fetch_doc_update(drive_file, service=None, journal=None, store=None):
+    '''Download a changed doc and return (xml_path, element_name, text)
+
+    With a text store, a doc version listed more than once in a run is downloaded once.
+    '''
+    import drive_loader
+    element_name = drive_file['name'].split('_')[-1]
+    with instrumentation.stage('sync.fetch_doc'):
+        if store is None:
+            new_text = drive_loader.get_doc_as_string(drive_file['id'], service)
+        else:
+            new_text = store.get_text(drive_file, lambda file_id: drive_loader.get_doc_as_string(file_id, service))
+        xml_path = get_doc_xml_path(drive_file, service)
+    if journal is not None:
+        journal.record(sync_journal.FETCHED, drive_file, xml_path)
+    return xml_path, element_name, new_text.replace('&', 'and')
+
+
+def apply_doc_update(drive_file, xml_path, element_name, text, update_time, service=None, journal=None, store=None):
+    '''Write doc text into the xml and mark the doc, returning the marked doc's modifiedTime
+
+    A shared canonical doc is also written into every layer linked to it in the text store.
+    '''
+    update_xml_element(xml_path, text, element_name)
+    for linked_path in get_linked_xml_paths(drive_file, xml_path, store):
+        update_xml_element(linked_path, text, element_name)
+    if store is not None and store.linked_xml_names(drive_file['id']):
+        store.rekey(element_name, text, drive_file['id'])
+    if journal is not None:
+        journal.record(sync_journal.APPLIED, drive_file, xml_path)
+    marked = mark_updated(drive_file['id'], update_time, service)
+    if journal is not None:
+        journal.record(sync_journal.MARKED, drive_file, xml_path, marked.get('modifiedTime'))
+    instrumentation.count('sync.docs_applied')
+    return marked.get('modifiedTime')
+
+
+def apply_category_doc(drive_file, update_time, cache, service=None, journal=None):
+    '''Export a category doc once and write only its changed sections
+
+    Returns (xml paths written, the marked doc's modifiedTime). The paths are kept in the
+    journal, so a doc resumed after a crash still returns the xml it changed.
+    '''
+    xml_paths = []
+    state = journal.state(drive_file) if journal is not None else None
+    if state in (sync_journal.APPLIED, sync_journal.MARKED):
+        xml_paths = list(journal.xml_path(drive_file) or [])
+    if state == sync_journal.MARKED:
+        instrumentation.count('sync.docs_resumed')
+        return xml_paths, None
+    if state != sync_journal.APPLIED:
+        import drive_loader
+        with instrumentation.stage('sync.fetch_doc'):
+            sections = category_docs.parse_doc_text(drive_loader.get_doc_as_string(drive_file['id'], service))
+        if journal is not None:
+            journal.record(sync_journal.FETCHED, drive_file)
+        for xml_name, element_name, text in cache.changed_sections(drive_file['id'], sections):
+            xml_path = os.path.join('data', 'outputs', xml_name)
+            update_xml_element(xml_path, text.replace('&', 'and'), element_name)
+            if xml_path not in xml_paths:
+                xml_paths.append(xml_path)
+            instrumentation.count('sync.sections_applied')
+        cache.record(drive_file['id'], drive_file['properties'][category_docs.CATEGORY_DOC_PROPERTY], sections)
+        if journal is not None:
+            journal.record(sync_journal.APPLIED, drive_file, xml_paths)
+    marked = mark_updated(drive_file['id'], update_time, service)
+    if journal is not None:
+        journal.record(sync_journal.MARKED, drive_file, xml_paths, marked.get('modifiedTime'))
+    instrumentation.count('sync.docs_applied')
+    return xml_paths, marked.get('modifiedTime')
+
+
+def resume_doc(drive_file, update_time, journal, service=None):
+    '''Finish a doc an interrupted run already handled
+
+    Returns its xml path, or None when the doc still needs fetching and applying.
+    '''
+    state = journal.state(drive_file)
+    if state == sync_journal.APPLIED:
+        marked = mark_updated(drive_file['id'], update_time, service)
+        journal.record(sync_journal.MARKED, drive_file, journal.xml_path(drive_file), marked.get('modifiedTime'))
+    elif state != sync_journal.MARKED:
+        return None
+    instrumentation.count('sync.docs_resumed')
+    return journal.xml_path(drive_file)
+
+
+def get_last_update(folder_ids=None):
+    '''Last completed sync time from the journal checkpoint, or the older update_config.json
+
+    With folder_ids, the oldest time any of those folders was last synced.
+    '''
+    last_update = sync_journal.SyncJournal().last_update_for(folder_ids)
+    if last_update is None:
+        last_update = load_json('update_config.json')['last_update']
+    return last_update
+
+
+def finish_xml_update(xml_path):
+    update_xml_element(xml_path, DEFUALT_DISCLAIMER, 'useconst', only_empty=True)
+
+
+@instrumentation.timed('stage.update')
+def check_files_and_update(past_update_time, parent_folder=ALL_FOLDER_ID, folder_ids=None, service=None,
+                           journal=None):
+    '''Apply docs changed after past_update_time, returning the updated xml paths
+
+    With folder_ids, only docs in those layer folders are applied and only those
+    folders' update times advance, so docs of other layers wait for a later run.
+    A service already authorized, such as the sync daemon's, is used for every
+    Drive call. A journal passed in is left open for its owner.
+
+    The new checkpoint is the time taken before listing, so a doc edited while
+    the run is going is listed again by the next run. Docs whose only change
+    since then is this run's own mark are skipped through the inventory.
+    '''
+    import drive_loader
     update_time = datetime.utcnow().isoformat()
-    files = drive_loader.get_files_updated_after_in_directory(past_update_time, parent_folder)
+    own_journal = journal is None
+    if own_journal:
+        journal = sync_journal.SyncJournal()
+    inventory = FileInventory()
+    store = TextStore()
+    category_cache = category_docs.CategoryDocCache()
     xml_paths = []
-    for f in files:
+    # Marking a doc changes its modifiedTime, which can move docs between the pages of a
+    # modifiedTime query, so every page is listed before any doc is applied and marked
+    listed = list(drive_loader.iter_files_updated_after_in_directory(past_update_time, parent_folder, service))
+    for f in listed:
+        instrumentation.count('sync.docs_listed')
+        inventory.record(f)
+        if not in_folders(f, folder_ids):
+            continue
+        if inventory.is_applied(f):
+            # Changed only by the mark of an earlier run
+            continue
+        if folder_ids is not None and journal.is_synced(f, folder_ids):
+            continue
         print 'Updating: ', f['name']
-        file_id = f['id']
-        element_name = f['name'].split('_')[-1]
-        new_text = drive_loader.get_doc_as_string(file_id)
-        xml_name = drive_loader.get_property(file_id, SRC_FILE_NAME_PROPERTY)
-        xml_path = os.path.join('data', 'outputs', xml_name)
+        if category_docs.is_category_doc(f):
+            with profiling.layer(f['name']):
+                category_paths, applied = apply_category_doc(f, update_time, category_cache, service, journal)
+            xml_paths.extend(category_paths)
+            if applied:
+                inventory.mark_applied(f['id'], applied)
+            category_cache.save()
+            continue
+        with profiling.layer(f['name']):
+            xml_path = resume_doc(f, update_time, journal, service)
+            if xml_path is None:
+                xml_path, element_name, new_text = fetch_doc_update(f, service, journal, store)
+                inventory.record(f, xml_path)
+                applied = apply_doc_update(f, xml_path, element_name, new_text, update_time, service, journal,
+                                           store)
+                inventory.mark_applied(f['id'], applied)
         xml_paths.append(xml_path)
-        update_xml_element(xml_path, new_text.replace('&', 'and'), element_name)
-        mark_updated(file_id, update_time)
+        xml_paths.extend(get_linked_xml_paths(f, xml_path, store))
 
     path_set = set(xml_paths)
     for xml in path_set:
-        update_xml_element(xml_path, DEFUALT_DISCLAIMER, 'useconst', only_empty=True)
+        finish_xml_update(xml)
 
-    save_json('update_config.json', {'last_update': datetime.utcnow().isoformat()})
-    return list(set(xml_paths))
+    journal.end_run(update_time, folder_ids)
+    if own_journal:
+        journal.close()
+    inventory.save()
+    store.save()
+    return list(path_set)
 
 
-def load_elements_to_drive(xml_files, elements):
-    category_folders = {}
+def load_elements_to_category_docs(xml_files, elements, upload_cache=None):
+    '''Upload element text of each xml as sections of one doc per category'''
+    import drive_loader
+    cache = category_docs.CategoryDocCache()
+    categories = {}
     for xml_file in xml_files:
+        file_name = os.path.basename(xml_file)
+        root = ET.parse(xml_file).getroot()
+        sections = categories.setdefault(file_name.split('.')[1], [])
+        for element in elements:
+            element_text = None
+            for e in root.iter(element):
+                element_text = e.text
+            sections.append((file_name, element, element_text))
+
+    for category_name, sections in sorted(categories.items()):
+        category_folder = drive_loader.create_drive_folder(category_name, [CATEGORIES_FOLDER])
+        doc_text = category_docs.build_doc_text(sections)
+        doc_id, uploaded = load_text_to_drive(doc_text, category_name, category_folder,
+                                              suffix=category_docs.CATEGORY_DOC_SUFFIX, upload_cache=upload_cache)
+        cache.record(doc_id, category_name, category_docs.parse_doc_text(doc_text))
+        if not uploaded:
+            print 'Unchanged {}, ID: {}'.format(category_name + category_docs.CATEGORY_DOC_SUFFIX, doc_id)
+            continue
+        drive_loader.add_file_to_folders(doc_id, [ALL_FOLDER_ID])
+        drive_loader.set_property(doc_id, {category_docs.CATEGORY_DOC_PROPERTY: category_name})
+        if upload_cache is not None:
+            save_upload_cache(upload_cache)
+        print 'Uploaded {} with {} sections, ID: {}'.format(category_name + category_docs.CATEGORY_DOC_SUFFIX,
+                                                           len(sections), doc_id)
+    cache.save()
+
+
+@instrumentation.timed('stage.upload')
+def load_elements_to_drive(xml_files, elements, share_duplicates=False, category_layout=False,
+                           update_existing=False, workers=1):
+    '''Upload element text of each xml as docs in its layer folder
+
+    With share_duplicates, a text already uploaded for another layer links that
+    layer folder to the existing canonical doc instead of creating a copy. With
+    category_layout, each category gets one doc with a section per layer element.
+    With update_existing, existing docs whose text changed since the last upload
+    are updated in place. With workers above 1, layers are uploaded concurrently.
+    '''
+    import drive_loader
+    upload_cache = load_upload_cache() if update_existing else None
+    if category_layout:
+        load_elements_to_category_docs(xml_files, elements, upload_cache)
+        return
+    store = TextStore()
+    category_folders = {}
+    folder_lock = threading.Lock()
+    # Uploads of the same text wait for each other so it gets one canonical doc
+    text_locks = defaultdict(threading.Lock)
+
+    def upload_layer(xml_file):
         file_name = os.path.basename(xml_file)
         drive_name = file_name.split('.')[-2]
         category_name = file_name.split('.')[1]
@@ -156,14 +505,48 @@ def load_elements_to_drive(xml_files, elements):
         for element in elements:
             for e in root.iter(element):
                 element_text = e.text
-            if category_name not in category_folders:
-                category_folders[category_name] = drive_loader.create_drive_folder(category_name,
-                                                                                   [CATEGORIES_FOLDER])
+            with folder_lock:
+                if category_name not in category_folders:
+                    category_folders[category_name] = drive_loader.create_drive_folder(category_name,
+                                                                                       [CATEGORIES_FOLDER])
             layer_folder = drive_loader.create_drive_folder(drive_name, [category_folders[category_name]])
-            doc_id = load_text_to_drive(element_text, drive_name, layer_folder, suffix='_'+element)
-            drive_loader.add_file_to_folders(doc_id, [ALL_FOLDER_ID])
-            drive_loader.set_property(doc_id, {'metaSrcName': file_name})
-            print 'Uploaded {}, ID: {}'.format(drive_name+'_'+element, doc_id)
+            if share_duplicates and element_text:
+                with text_locks[(element, text_key(element_text))]:
+                    upload_element(file_name, drive_name, layer_folder, element, element_text)
+            else:
+                upload_element(file_name, drive_name, layer_folder, element, element_text)
+
+    def upload_element(file_name, drive_name, layer_folder, element, element_text):
+        doc_id = store.canonical_doc(element, element_text) if share_duplicates and element_text else None
+        if doc_id is not None:
+            layer_count = len(set(store.linked_xml_names(doc_id) + [file_name]))
+            drive_loader.add_file_to_folders(doc_id, [layer_folder],
+                                             body={'name': SHARED_DOC_NAME.format(layer_count, element),
+                                                   'properties': {SHARED_LAYERS_PROPERTY: str(layer_count)}})
+            store.link(doc_id, file_name)
+            instrumentation.count('upload.docs_linked')
+            print 'Linked {} to shared doc, ID: {}'.format(drive_name+'_'+element, doc_id)
+            return
+        doc_id, uploaded = load_text_to_drive(element_text, drive_name, layer_folder, suffix='_'+element,
+                                              upload_cache=upload_cache)
+        if share_duplicates and element_text:
+            store.add_canonical(element, element_text, doc_id, file_name)
+        if not uploaded:
+            # Already linked and named on the last upload; writing again would only bump modifiedTime
+            print 'Unchanged {}, ID: {}'.format(drive_name+'_'+element, doc_id)
+            return
+        drive_loader.add_file_to_folders(doc_id, [ALL_FOLDER_ID])
+        drive_loader.set_property(doc_id, {'metaSrcName': file_name})
+        if upload_cache is not None:
+            save_upload_cache(upload_cache)
+        print 'Uploaded {}, ID: {}'.format(drive_name+'_'+element, doc_id)
+
+    if workers > 1:
+        drive_loader.map_threads(upload_layer, xml_files, workers)
+    else:
+        for xml_file in xml_files:
+            upload_layer(xml_file)
+    store.save()
 
 
 def get_empty_element_xml(xml_files, elements):
@@ -182,23 +565,30 @@ def get_empty_element_xml(xml_files, elements):
     save_json('data/outputs/temp/empties.json', {'empties': empties})
 
 
-def get_working_spreadsheet_completed_ids():
-    scope = ['https://spreadsheets.google.com/feeds']
-    credentials = ServiceAccountCredentials.from_json_keyfile_name(r'CenterlineSchema-c1b9c8e23e52.json', scope)
-    gc = gspread.authorize(credentials)
-    # spreadsheet must be shared with the email in credentials
-    spreadSheet = gc.open_by_url("https://docs.google.com/spreadsheets/d/1tX3mlUZ3nWIoTKxjiKlYG9U3njIRnJHF956wzS428qw/edit#gid=1226201523")
-    # worksheets = spreadSheet.worksheets()
-    fieldWorkSheet = spreadSheet.worksheet('sheet.csv')
-    rows = fieldWorkSheet.get_all_values()
-    complete_ids = []
-    for row in rows:
-        if 'done' in row[1].lower():
-            complete_ids.append(row[3])
-    return complete_ids
+def get_output_xml_files(directory='data/outputs'):
+    xml_files = []
+    for root, dirs, files in os.walk(directory, topdown=True):
+        for name in files:
+            if name.endswith('.xml'):
+                xml_files.append(os.path.join(root, name))
+        break
+    return xml_files
+
+
+def get_working_spreadsheet_completed_ids(sheet=None):
+    '''frozenset of layer folder ids marked done on the assignment sheet'''
+    import assignment_sheet
+    sheet = sheet if sheet is not None else assignment_sheet.get_assignment_sheet()
+    return sheet.completed_ids()
+
+
+def in_folders(drive_file, folder_ids):
+    '''True when folder_ids is None or the file is in one of the folders'''
+    return folder_ids is None or not folder_ids.isdisjoint(drive_file.get('parents') or [])
 
 
 def get_feature_class_folders():
+    import drive_loader
     files = drive_loader.get_abstracts_in_directory(ALL_FOLDER_ID)
     parent_ids = {}
     for f in files:
@@ -214,6 +604,7 @@ def get_feature_class_folders():
 
 
 def add_full_name(fc_folder_json):
+    import drive_loader
     folders = load_json(fc_folder_json)
     folders.pop('upload_time_local')
     for fc_id in folders:
@@ -251,36 +642,67 @@ def count_xml_files(directory):
     print count
 
 
-def import_metadata(xmls, connections_json='connections.json'):
+def import_layer_metadata(xml, connections, catalogue=None, connections_json='connections.json'):
+    '''Import one xml into its SGID feature class, returning False on failure
+
+    Layers missing from a non-empty catalogue, even after relisting their
+    category, are skipped without importing.
+    '''
     import arcpy
+    feature_name = os.path.basename(xml).replace('.xml', '')
+    if catalogue is not None and len(catalogue) > 0:
+        catalogue_name = catalogue.find_listed(feature_name, connections_json)
+        if catalogue_name is None:
+            print 'not in SGID catalogue', feature_name
+            instrumentation.count('arcpy.import_skipped')
+            return False
+        feature_name = catalogue_name
+    category_name = feature_name.split('.')[1]
+    connection = connections[category_name]
+    print 'importing', feature_name
+    try:
+        with instrumentation.stage('arcpy.import'):
+            arcpy.MetadataImporter_conversion(xml, os.path.join(connection, feature_name))
+    except Exception as e:
+        print xml, e.message
+        instrumentation.count('arcpy.import_failures')
+        return False
+    return True
+
+
+@instrumentation.timed('stage.import')
+def import_metadata(xmls, connections_json='connections.json', catalogue=None):
     connections = load_json(connections_json, remove_update=True)
+    catalogue = catalogue if catalogue is not None else fc_catalogue.get_catalogue()
+    feature_names = [os.path.basename(xml).replace('.xml', '') for xml in xmls]
+    catalogue.refresh(categories=set(fc_catalogue.get_category(f) for f in feature_names),
+                      connections_json=connections_json)
     for xml in xmls:
-        feature_name = os.path.basename(xml).replace('.xml', '')
-        category_name = feature_name.split('.')[1]
-        connection = connections[category_name]
-        print 'importing', feature_name
-        try:
-            arcpy.MetadataImporter_conversion(xml, os.path.join(connection, feature_name))
-        except Exception as e:
-            print xml, e.message
+        with profiling.layer(os.path.basename(xml)):
+            import_layer_metadata(xml, connections, catalogue, connections_json)
 
 
 def check_category_and_update(past_update_time, category_name):
+    '''Apply changed docs folder by folder, advancing only the checkpoints of the category's folders'''
+    import drive_loader
     category_id = drive_loader.get_file_id_by_name_and_directory(category_name, CATEGORIES_FOLDER)
     feature_folder_ids = drive_loader.get_subfolder_ids(category_id)
     updated_xml = []
     for folder_id in feature_folder_ids:
-        updated_xml.extend(check_files_and_update(past_update_time, parent_folder=folder_id))
+        updated_xml.extend(check_files_and_update(past_update_time, parent_folder=folder_id,
+                                                  folder_ids=frozenset([folder_id])))
 
     return updated_xml
 
 
+@instrumentation.timed('stage.waf')
 def copy_gisimetadata_to_waf(waf_path, xml_files, excluded_xmls):
     paths = [xml for xml in xml_files if xml not in excluded_xmls]
     for path in paths:
         dst_path = os.path.join(waf_path, os.path.basename(path))
         print dst_path
-        shutil.copy(path, dst_path)
+        with instrumentation.stage('waf.copy'):
+            shutil.copy(path, dst_path)
 
 
 def print_updated(last_update_time):
@@ -290,10 +712,11 @@ def print_updated(last_update_time):
     print 'Total:', len(updated)
 
 
-def upload_last_exported_to_drive():
+def upload_last_exported_to_drive(share_duplicates=False, category_layout=False, update_existing=False, workers=1):
     # Load elements as google docs
     xml_files = load_json(LAST_GISI_OUTPUT)['output_files']
-    load_elements_to_drive(xml_files, ['purpose', 'abstract'])
+    load_elements_to_drive(xml_files, ['purpose', 'abstract'], share_duplicates, category_layout, update_existing,
+                           workers)
 
 
 if __name__ == '__main__':
@@ -307,75 +730,169 @@ if __name__ == '__main__':
                         help='Update metadata files with updated docs and import into SGID')
     parser.add_argument('--waf', action='store_true', dest='copy_to_waf',
                         help='Copy updated files to GIS Inventory web accessible folder')
+    parser.add_argument('--bundle', action='store_true', dest='bundle',
+                        help='With --waf, publish one compressed archive and index instead of separate files')
+    parser.add_argument('--rebuild_bundle', action='store_true', dest='rebuild_bundle',
+                        help='With --waf --bundle, rebuild the archive and index from every output xml')
     parser.add_argument('--date', action='store', dest='last_update',
                         help='Date string in ISO format YYYY-MM-DDTHH:MM:SS.UUU')
     parser.add_argument('--upload_export', action='store_true', dest='upload_export',
                         help='Upload abstract and purpose of last metadata export to drive')
+    parser.add_argument('--share_text', action='store_true', dest='share_text',
+                        help='With --upload_export, link layers with identical text to one shared doc')
+    parser.add_argument('--category_docs', action='store_true', dest='category_docs',
+                        help='With --upload_export, upload one sectioned doc per category instead of one doc per element')
+    parser.add_argument('--update_existing', action='store_true', dest='update_existing',
+                        help='With --upload_export, update existing docs in place when their text changed')
+    parser.add_argument('--pipeline', action='store_true', dest='pipeline',
+                        help='Run --update, --import and --waf as overlapping per-layer stages')
+    parser.add_argument('--fetch_workers', action='store', dest='fetch_workers', type=int, default=4,
+                        help='Concurrent doc downloads for --pipeline')
+    parser.add_argument('--adaptive', action='store_true', dest='adaptive',
+                        help='Tune Drive concurrency to rate limits for --pipeline and --upload_export')
+    parser.add_argument('--validate', action='store_true', dest='validate',
+                        help='Check every output xml against FGDC required fields and write a validation report')
+    parser.add_argument('--skip_validation', action='store_true', dest='skip_validation',
+                        help='Import and publish updated xml without validating it first')
+    parser.add_argument('--sheet', action='store_true', dest='sheet',
+                        help='With --update, --import and --waf, only sync layers marked done on the assignment sheet')
+    parser.add_argument('--plan', action='store_true', dest='plan',
+                        help='Show the work and estimated duration of --update, --import and --waf from local state only')
+    parser.add_argument('--audit', action='store_true', dest='audit_empty',
+                        help='List output xml files with empty abstract or purpose (local only, no Drive)')
+    parser.add_argument('--triage', action='store_true', dest='triage_comments',
+                        help='Reply to and mark docs with new #completed comments')
+    parser.add_argument('--history', action='store_true', dest='history',
+                        help='Record the changed output xml in the output history before and after the run')
+    parser.add_argument('--report', action='store', dest='report', nargs='?', const=RUN_REPORT,
+                        help='Record stage and Drive API timings and write a JSON run report')
+    parser.add_argument('--prometheus', action='store', dest='prometheus',
+                        help='Also write the run timings to this file in Prometheus text format')
+    parser.add_argument('--profile', action='store', dest='profile', nargs='?', const=profiling.PROFILE_DIRECTORY,
+                        help='Profile each stage and slow layers and write the profiles to this directory')
+    parser.add_argument('--profile_threshold', action='store', dest='profile_threshold', type=float,
+                        default=profiling.THRESHOLD_SECONDS,
+                        help='Seconds a layer must take for --profile to keep its own profile')
 
     args = parser.parse_args()
+    if args.report or args.prometheus:
+        instrumentation.enable()
+    if args.profile:
+        profiling.enable(args.profile, args.profile_threshold)
+    drive_limiter = None
+    if args.adaptive:
+        import drive_loader
+        drive_limiter = drive_loader.enable_adaptive()
+
+    # --sheet
+    completed_folder_ids = None
+    if args.sheet:
+        completed_folder_ids = get_working_spreadsheet_completed_ids()
+        print 'Layers done on the assignment sheet:', len(completed_folder_ids)
 
     past_update_time = None
     # --date
     if args.last_update:
         past_update_time = args.last_update
-    else:
-        past_update_time = load_json('update_config.json')['last_update']
+    elif args.list_updated or args.update_metadata or args.import_metadata or args.copy_to_waf or args.plan:
+        past_update_time = get_last_update(completed_folder_ids)
+
+    # --plan with --import --waf --bundle --pipeline
+    if args.plan:
+        import sync_plan
+        plan = sync_plan.plan_sync(past_update_time,
+                                   import_layers=args.import_metadata,
+                                   publish=args.copy_to_waf,
+                                   bundle=args.bundle,
+                                   fetch_workers=args.fetch_workers if args.pipeline else 1,
+                                   excluded_xmls=WAF_EXCLUDED_XMLS)
+        sync_plan.print_plan(plan)
+        sync_plan.write_plan(plan)
+        raise SystemExit(0)
+
+    # --history
+    if args.history:
+        import output_history
+        print 'Layers changed before this run:', len(output_history.record_before_run(date_time_run))
+
+    # --validate
+    if args.validate:
+        import metadata_validation
+        metadata_validation.validate_files(get_output_xml_files())
+
+    # --audit
+    if args.audit_empty:
+        get_empty_element_xml(get_output_xml_files(), ['abstract', 'purpose'])
+        print 'Empty elements saved to data/outputs/temp/empties.json'
 
     # --list
     if args.list_updated:
         print_updated(past_update_time)
 
+    # --triage
+    if args.triage_comments:
+        triage_comments()
+
     updated_xml = None
-    # --update --import
-    if args.update_metadata or args.import_metadata:
-        updated_xml = check_files_and_update(past_update_time)
+    # --pipeline with --update --import --waf
+    if args.pipeline and (args.update_metadata or args.import_metadata or args.copy_to_waf):
+        import pipeline
+        pipeline.run_sync_pipeline(past_update_time,
+                                   import_layers=args.import_metadata or args.copy_to_waf,
+                                   publish=args.copy_to_waf,
+                                   bundle=args.bundle,
+                                   validate=not args.skip_validation,
+                                   fetch_workers=drive_limiter.maximum if drive_limiter else args.fetch_workers,
+                                   folder_ids=completed_folder_ids,
+                                   rebuild_bundle=args.rebuild_bundle)
+
+    # --update --import --waf
+    elif args.update_metadata or args.import_metadata or args.copy_to_waf:
+        updated_xml = check_files_and_update(past_update_time, folder_ids=completed_folder_ids)
         print 'Total files updated:', len(updated_xml)
 
-    # --import
-    if args.import_metadata and len(updated_xml) > 0:
-        import_metadata(updated_xml)
+        # Leave invalid xml out of --import --waf
+        if (args.import_metadata or args.copy_to_waf) and updated_xml and not args.skip_validation:
+            import metadata_validation
+            updated_xml = metadata_validation.validate_files(updated_xml)
 
-    # --waf
-    if args.copy_to_waf:
-        updated_xml = check_files_and_update(past_update_time)
-        print 'Total files updated:', len(updated_xml)
-        import_metadata(updated_xml)
-
-        waf_path = r'J:\UtahSGID_Vector\UTM12_NAD83\Metadata'
-        excluded_xmls = [
-                "data/outputs/SGID10.GEOSCIENCE.Units_MoabSanRafael.xml",
-                "data/outputs/SGID10.GEOSCIENCE.Units_Nephi.xml",
-                "data/outputs/SGID10.GEOSCIENCE.Units_Price.xml",
-                "data/outputs/SGID10.HEALTH.HealthDistricts.xml",
-                "data/outputs/SGID10.HEALTH.HealthDistricts2015.xml",
-                "data/outputs/SGID10.PLANNING.UWC2008CherryStemRoads.xml",
-                "data/outputs/SGID10.PLANNING.WildernessProp_RedRock.xml",
-                "data/outputs/SGID10.PLANNING.WildernessProp_WashingtonCo.xml",
-                "data/outputs/SGID10.CADASTRE.Parcels.xml",
-                "data/outputs/SGID10.CADASTRE.Parcels_LIR.xml",
-                "data/outputs/SGID10.TRANSPORTATION.RoadsODM.xml"
-        ]
-
-        excluded_xmls = [os.path.basename(x) for x in excluded_xmls]
-        updated_xml = [x for x in updated_xml if os.path.basename(x) not in excluded_xmls]
-        copy_gisimetadata_to_waf(waf_path, updated_xml, excluded_xmls)
+        # --import --waf
+        if (args.import_metadata or args.copy_to_waf) and len(updated_xml) > 0:
+            import_metadata(updated_xml)
+
+        # --waf
+        if args.copy_to_waf:
+            updated_xml = [x for x in updated_xml if os.path.basename(x) not in WAF_EXCLUDED_XMLS]
+            if args.bundle:
+                import waf_bundle
+                waf_bundle.publish_bundle(WAF_PATH, updated_xml, WAF_EXCLUDED_XMLS, full=args.rebuild_bundle)
+            else:
+                copy_gisimetadata_to_waf(WAF_PATH, updated_xml, WAF_EXCLUDED_XMLS)
 
     # --upload_export
     if args.upload_export:
-        upload_last_exported_to_drive()
+        upload_last_exported_to_drive(args.share_text, args.category_docs, args.update_existing,
+                                      drive_limiter.maximum if drive_limiter else 1)
+
+    # --history
+    if args.history:
+        import output_history
+        print 'Layers changed since last recorded run:', len(output_history.record_outputs(run=date_time_run))
+
+    if drive_limiter is not None:
+        print 'Drive concurrency: {limit} at end, {qps:.2f} calls/s, {rate_limited} rate limited'.format(
+            **drive_limiter.summary())
+
+    if args.report:
+        instrumentation.write_report(args.report)
+        print 'Run report:', args.report
+    if args.prometheus:
+        instrumentation.write_prometheus(args.prometheus)
+    if args.profile:
+        print 'Profile summary:', profiling.finish()
 
     # updated_xml = check_category_and_update("2017-01-04T20:53:45.737000", 'WATER')
 
-    # complete_folder_ids = get_working_spreadsheet_completed_ids()
-    # # print len(complete_folder_ids)
-    #
-    # updated_xml = []
-    # for folder_id in complete_folder_ids:
-    #     updated_xml.extend(check_files_and_update(past_update_time, parent_folder=folder_id))
-    #
-    # print len(updated_xml)
-    # import_metadata(updated_xml)
-
     # Load elements as google docs
     # xml_files = load_json(LAST_GISI_OUTPUT)['output_files']
     # load_elements_to_drive(xml_files, ['purpose', 'abstract'])
@@ -1,22 +1,34 @@
 import os
 import re
 import json
-import arcpy
-import xml.etree.ElementTree as ET
-from xml.dom import minidom
+import instrumentation
+import profiling
+import fc_catalogue
+import metadata_writers
+import xml_backend
+from xml_backend import ET
 from datetime import datetime
 from time import strftime
 
 
 date_time_run = strftime("%Y%m%d_%H%M%S")
+EXPORT_REPORT = 'data/outputs/reports/export_{}.json'.format(date_time_run)
 
 
 EMPTY_TEMPLATE_TREE = r'templates/GISI-metadata-empty-machine.xml'
+LAYER_RULES = r'templates/layer_rules.json'
 
 
 DEFUALT_DISCLAIMER = '''There are no constraints or warranties with regard to the use of this dataset. Users are encouraged to attribute content to: State of Utah, SGID.This product is for informational purposes and may not have been prepared for, or be suitable for legal, engineering, or surveying purposes. Users of this information should review or consult the primary data and information sources to ascertain the usability of the information. AGRC provides these data in good faith and shall in no event be liable for any incorrect results, any lost profits and special, indirect or consequential damages to any party, arising out of or in connection with the use or the inability to use the data hereon or the services provided. AGRC provides these data and services as a convenience to the public. Further more, AGRC reserves the right to change or revise published data and/or these services at any time.'''
 
 
+# Source export sections BaseTranslator never reads, dropped while parsing
+PRUNED_SOURCE_TAGS = ('eainfo', 'Binary')
+
+
+DIGFORM_NETWORKR_PATH = xml_backend.compile_path('distinfo/stdorder/digform//networkr')
+
+
 DIGFORM_STRING = '''<digform><digtinfo><formname></formname></digtinfo><digtopt><onlinopt><computer><networka><networkr></networkr></networka></computer></onlinopt></digtopt></digform>'''
 
 
@@ -53,6 +65,75 @@ class FormName(object):
     WEB_MAP_VIEWER = 'Web Map Viewer'
 
 
+class LayerRules(object):
+    '''Per category and per layer overrides from templates/layer_rules.json
+
+    Each rule may set resources as [FormName attribute or form name, url] pairs,
+    an update frequency as an Update attribute or text, contact fields
+    (cntorg, cntper, cntvoice, addrtype, address, city, state, postal) and
+    keywords or placekeys to add. Layer rules override their category's rule.
+    A json_path given explicitly must exist; when the default file is missing
+    a warning is printed and no rules apply.
+    '''
+
+    CONTACT_FIELDS = ('cntorg', 'cntper', 'cntvoice', 'addrtype', 'address', 'city', 'state', 'postal')
+
+    def __init__(self, json_path=None):
+        self.categories = {}
+        self.layers = {}
+        if json_path is None:
+            json_path = LAYER_RULES
+            if not os.path.exists(json_path):
+                print 'Warning: no layer rules at {}, exporting without them'.format(json_path)
+                return
+        elif not os.path.exists(json_path):
+            raise IOError('Layer rules file {} not found'.format(json_path))
+        rules = load_json(json_path)
+        for category, rule in rules.get('categories', {}).items():
+            self.categories[category.upper()] = self._compile(rule)
+        for layer, rule in rules.get('layers', {}).items():
+            self.layers[layer.lower()] = self._compile(rule)
+
+    @staticmethod
+    def _compile(rule):
+        attributes = {}
+        if 'update' in rule:
+            attributes['update'] = getattr(Update, rule['update'], rule['update'])
+        for field, value in rule.get('contact', {}).items():
+            if field not in LayerRules.CONTACT_FIELDS:
+                raise ValueError('Unknown contact field {}'.format(field))
+            attributes[field] = value
+        resources = None
+        if 'resources' in rule:
+            resources = tuple((getattr(FormName, formname, formname), networkr)
+                              for formname, networkr in rule['resources'])
+        return {'attributes': attributes,
+                'resources': resources,
+                'keywords': tuple(rule.get('keywords', ())),
+                'placekeys': tuple(rule.get('placekeys', ()))}
+
+    def for_layer(self, layer_name):
+        '''Compiled rules that apply to layer_name, category first, or an empty list'''
+        rules = []
+        parts = layer_name.split('.')
+        if len(parts) > 1 and parts[1].upper() in self.categories:
+            rules.append(self.categories[parts[1].upper()])
+        if layer_name.lower() in self.layers:
+            rules.append(self.layers[layer_name.lower()])
+        return rules
+
+
+_layer_rules = None
+
+
+def get_layer_rules():
+    '''Rules shared by the process, loaded on first use'''
+    global _layer_rules
+    if _layer_rules is None:
+        _layer_rules = LayerRules()
+    return _layer_rules
+
+
 class GisiXml(object):
     '''Store the important elements of the GISI metadata document'''
 
@@ -150,6 +231,24 @@ class GisiXml(object):
             tk = ET.SubElement(place, 'placekey')
             tk.text = placekey
 
+    def fields(self):
+        '''Field values shared by every output format'''
+        values = dict((name, getattr(self, name)) for name in self.straight_writes)
+        values['keywords'] = list(self.keywords)
+        values['placekeys'] = list(self.placekeys)
+        values['resources'] = [tuple(resource) for resource in self.resource_locations]
+        return values
+
+    def write_outputs(self, writers):
+        '''Write each format in writers from the same fields, returning {format name: path}'''
+        fields = self.fields()
+        outputs = {}
+        for writer in writers:
+            with instrumentation.stage('export.write_' + writer.name):
+                outputs[writer.name] = writer.write(self, fields)
+        return outputs
+
+    @instrumentation.timed('export.write_fields_to_xml')
     def write_fields_to_xml(self):
         self._add_keyword_elements()
         self._add_placekey_elements()
@@ -164,40 +263,45 @@ class GisiXml(object):
 
         # self.template_tree.write(output_xml_path, method='html')
         with open(self.output_xml, 'wb') as pxml:
-            for line in self.prettify(self.template_tree.getroot()):
-                pxml.write(line.encode("UTF-8"))
+            pxml.write(self.prettify(self.template_tree.getroot()).encode("UTF-8"))
 
+    @instrumentation.timed('export.prettify')
     def prettify(self, root_element):
         '''Return a pretty-printed XML string for the Element.
         '''
-        rough_string = ET.tostring(root_element, 'utf-8')
-        reparsed = minidom.parseString(rough_string)
-        return reparsed.toprettyxml(indent="    ")
+        return xml_backend.pretty_string(root_element)
 
 
 class BaseTranslator(GisiXml):
-    '''Translation functions that set fields of GisiXml document'''
+    '''Translation functions that set fields of GisiXml document
 
-    all_translators = []
+    Layer rules are applied during setup; resources passed in take precedence over them.
+    '''
+
+    DEFAULT_RESOURCES = (
+        (FormName.DOWNLOADABLE_GDB,
+         'empty'),
+        (FormName.DOWNLOADABLE_SHAPEFILE,
+         'empty')
+    )
 
     def __init__(self,
                  sgid_xml,
-                 resources=(
-                     (FormName.DOWNLOADABLE_GDB,
-                      'empty'),
-                     (FormName.DOWNLOADABLE_SHAPEFILE,
-                      'empty')
-                 ),
-                 empty_template_tree=None):
+                 resources=None,
+                 empty_template_tree=None,
+                 layer_rules=None):
         if empty_template_tree is None:
             empty_template_tree = ET.parse(r'templates/GISI-metadata-empty-machine.xml')
 
         super(BaseTranslator, self).__init__(empty_template_tree)
         self.sgid_xml = sgid_xml
-        self.resource_locations = resources
+        self.resources = resources
+        self.resource_locations = resources or BaseTranslator.DEFAULT_RESOURCES
+        self.layer_rules = layer_rules if layer_rules is not None else get_layer_rules()
         self.name = None
         self.output_xml = None
         self.root = None
+        self.skipped_bytes = 0
         self.direct_reads = [
             'abstract',
             'purpose',
@@ -212,15 +316,17 @@ class BaseTranslator(GisiXml):
         ]
         self.setup()
 
+    @instrumentation.timed('export.translator_setup')
     def setup(self):
         self.set_name()
         self.output_xml = r'data/outputs/{}.xml'.format(self.name)
-        self.root = ET.parse(self.sgid_xml).getroot()
+        self.root, self.skipped_bytes = xml_backend.parse_pruned(self.sgid_xml, PRUNED_SOURCE_TAGS)
 
         self.set_direct_reads()
         self.set_citation_elements()
         self.set_time_period()
         self.set_keywords()
+        self.apply_layer_rules()
 
     def set_name(self):
         self.name = self.sgid_xml.split('\\')[-1].replace('.xml', '')
@@ -247,22 +353,25 @@ class BaseTranslator(GisiXml):
         for e in self.root.iter('themekey'):
             self.keywords.append(e.text)
 
+    def apply_layer_rules(self):
+        layer_name = self.name.replace('/', '\\').split('\\')[-1]
+        for rule in self.layer_rules.for_layer(layer_name):
+            for attribute, value in rule['attributes'].items():
+                setattr(self, attribute, value)
+            if rule['resources'] is not None and self.resources is None:
+                self.resource_locations = rule['resources']
+            self.keywords.extend(k for k in rule['keywords'] if k not in self.keywords)
+            self.placekeys.extend(k for k in rule['placekeys'] if k not in self.placekeys)
+
 
 class LakesTranslator(BaseTranslator):
+    '''Lakes resources now come from templates/layer_rules.json'''
 
-    def __init__(self,
-                 sgid_xml=r'data/SGID10.WATER.Lakes.xml',
-                 resources=(
-                     (FormName.DOWNLOADABLE_GDB,
-                      'ftp://ftp.agrc.utah.gov/UtahSGID_Vector/UTM12_NAD83/WATER/UnpackagedData/Lakes/_Statewide/Lakes_gdb.zip'),
-                     (FormName.DOWNLOADABLE_SHAPEFILE,
-                      'ftp://ftp.agrc.utah.gov/UtahSGID_Vector/UTM12_NAD83/WATER/UnpackagedData/Lakes/_Statewide/Lakes_shp.zip')
-                 )):
-        super(LakesTranslator, self).__init__(sgid_xml, resources)
-        BaseTranslator.all_translators.append(self)
-        self.setup()
+    def __init__(self, sgid_xml=r'data/SGID10.WATER.Lakes.xml'):
+        super(LakesTranslator, self).__init__(sgid_xml)
 
 
+@instrumentation.timed('stage.export')
 def export_sgid_metadata(output_directory,
                          workspace=r'Database Connections\Connection to sgid.agrc.utah.gov.sde',
                          feature_classes=None):
@@ -272,30 +381,24 @@ def export_sgid_metadata(output_directory,
     workspace = r'Database Connections\Connection to sgid.agrc.utah.gov.sde'
     for feature in feature_classes:
         print 'exporting {}'.format(feature)
-        arcpy.ExportMetadata_conversion(os.path.join(workspace, feature),
-                                        'C:\Program Files (x86)\ArcGIS\Desktop10.3\Metadata\Translator\ARCGIS2FGDC.xml',
-                                        os.path.join(output_directory, feature + '.xml'))
+        with profiling.layer(feature), instrumentation.stage('arcpy.export'):
+            arcpy.ExportMetadata_conversion(os.path.join(workspace, feature),
+                                            'C:\Program Files (x86)\ArcGIS\Desktop10.3\Metadata\Translator\ARCGIS2FGDC.xml',
+                                            os.path.join(output_directory, feature + '.xml'))
 
 
 def get_features_in_workspace(workspace=r'Database Connections\Connection to sgid.agrc.utah.gov.sde'):
-    arcpy.env.workspace = workspace
-    fcs = arcpy.ListFeatureClasses()
-    save_json(r'data/outputs/temp/fcs.json', {'featureclasses': fcs})
+    fc_catalogue.get_catalogue().refresh_workspace(workspace)
 
 
-def get_features_in_category(categories, json_featureclasses=r'data/outputs/temp/fcs.json'):
-    fcs = load_json(json_featureclasses)['featureclasses']
-    featurenames = []
-    for fc in fcs:
-        if fc.split('.')[1] in categories:
-            featurenames.append(fc)
-    return featurenames
+def get_features_in_category(categories, catalogue=None):
+    catalogue = catalogue if catalogue is not None else fc_catalogue.get_catalogue()
+    return catalogue.in_categories(categories)
 
 
-def get_categories(json_featureclasses=r'data/outputs/temp/fcs.json'):
-    fcs = load_json(json_featureclasses)['featureclasses']
-    category_names = [fc.split('.')[1] for fc in fcs]
-    return set(category_names)
+def get_categories(catalogue=None):
+    catalogue = catalogue if catalogue is not None else fc_catalogue.get_catalogue()
+    return catalogue.category_names()
 
 
 def load_json(json_path):
@@ -311,16 +414,28 @@ def save_json(json_path, properties):
         f_out.write(json.dumps(properties, sort_keys=True, indent=4))
 
 
-def create_gisi_metadata(metadata_xml_paths):
-    # # Setup translators and write out new xml
-    translators = []
-    output_xml_files = []
+@instrumentation.timed('stage.create_gisi')
+def create_gisi_metadata(metadata_xml_paths, formats=(metadata_writers.GisiWriter.name,)):
+    '''Parse each export once and write it in every output format
+
+    lastgisi_output.json lists the GISI xml written, with the other formats' paths kept apart.
+    '''
+    writers = metadata_writers.get_writers(formats)
+    # # Setup translators and write out new xml one layer at a time
+    output_files = dict((writer.name, []) for writer in writers)
+    skipped_bytes = {}
     for xml in metadata_xml_paths:
-        translators.append(BaseTranslator(xml))
-    for translator in translators:
-        translator.write_fields_to_xml()
-        output_xml_files.append(translator.output_xml)
-    save_json('data/outputs/temp/lastgisi_output.json', {'output_files': output_xml_files})
+        with profiling.layer(os.path.basename(xml)):
+            translator = BaseTranslator(xml)
+            outputs = translator.write_outputs(writers)
+        for name, path in outputs.items():
+            output_files[name].append(path)
+        skipped_bytes[translator.name] = translator.skipped_bytes
+        print '{} skipped {} bytes of {}'.format(translator.name, translator.skipped_bytes, PRUNED_SOURCE_TAGS)
+    gisi_files = output_files.pop(metadata_writers.GisiWriter.name, [])
+    save_json('data/outputs/temp/lastgisi_output.json', {'output_files': gisi_files,
+                                                         'format_files': output_files,
+                                                         'skipped_bytes': skipped_bytes})
 
 
 def get_empty_digform_layers(metadata_xml_directory):
@@ -332,13 +447,10 @@ def get_empty_digform_layers(metadata_xml_directory):
             if name.endswith('.xml'):
                 xml_files.append(os.path.join(root, name))
     for xml in xml_files:
-        element_tree = ET.parse(xml)
-        root = element_tree.getroot()
-        stdorder = root.find('distinfo').find('stdorder')
-        for digform in stdorder.findall('digform'):
-            for e in digform.iter('networkr'):
-                if e.text == 'empty':
-                    empty_xmls.append(xml)
+        root = ET.parse(xml).getroot()
+        for e in DIGFORM_NETWORKR_PATH(root):
+            if e.text == 'empty':
+                empty_xmls.append(xml)
 
     return set(empty_xmls)
 
@@ -346,11 +458,10 @@ def get_empty_digform_layers(metadata_xml_directory):
 def get_pretty_element(root_element):
     '''Return a pretty-printed XML string for the Element.
     '''
-    rough_string = ET.tostring(root_element, 'utf-8')
-    reparsed = minidom.parseString(rough_string)
-    return ET.fromstring(reparsed.toprettyxml(indent="    "))
+    return xml_backend.pretty_element(root_element)
 
 
+@instrumentation.timed('export.update_digform_elements')
 def update_digform_elements(xml_path, resource_locations):
     element_tree = ET.parse(xml_path)
     distinfo = element_tree.getroot().find('distinfo')
@@ -368,7 +479,7 @@ def update_digform_elements(xml_path, resource_locations):
         digform = get_pretty_element(digform)
         stdorder.insert(insert_i, digform)
         insert_i += 1
-    element_tree.write(xml_path, encoding='UTF-8')
+    xml_backend.write(element_tree, xml_path)
 
 
 def create_resource_locations(download_links):
@@ -384,11 +495,18 @@ def create_resource_locations(download_links):
      )
     return resources
 
-def create_metadata_from_featureclass(featurenames, output_directory):
+def create_metadata_from_featureclass(featurenames, output_directory, catalogue=None,
+                                      formats=(metadata_writers.GisiWriter.name,)):
+    catalogue = catalogue if catalogue is not None else fc_catalogue.get_catalogue()
+    if len(catalogue) > 0:
+        featurenames, missing = catalogue.resolve(featurenames)
+        for featurename in missing:
+            print 'not found', featurename
     export_sgid_metadata(output_directory, feature_classes=featurenames)
-    create_gisi_metadata([os.path.join(output_directory, f + '.xml') for f in featurenames])
+    create_gisi_metadata([os.path.join(output_directory, f + '.xml') for f in featurenames], formats)
 
 
+@instrumentation.timed('export.format_titles')
 def format_titles():
     xml_files = []
     for root, dirs, files in os.walk('data/outputs', topdown=True):
@@ -411,7 +529,7 @@ def format_titles():
             s = re.sub(r'(\s+)', r' ', s)
             print e.text, '\n', s
             e.text = s.strip()
-            element_tree.write(xml, encoding='UTF-8')
+            xml_backend.write(element_tree, xml)
 
 
 def update_digform_with_drive_links(feature_link_json):
@@ -457,25 +575,53 @@ def update_onlink_links():
         for e in root.iter('onlink'):
             e.text = 'https://gis.utah.gov/data/{}'.format(category_name.lower().strip())
             print category_name, e.text
-            element_tree.write(xml, encoding='UTF-8')
+            xml_backend.write(element_tree, xml)
 
 
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Export SGID metadata and translate it to GISI')
+    parser.add_argument('--report', action='store', dest='report', nargs='?', const=EXPORT_REPORT,
+                        help='Record stage timings and write a JSON run report')
+    parser.add_argument('--prometheus', action='store', dest='prometheus',
+                        help='Also write the run timings to this file in Prometheus text format')
+    parser.add_argument('--profile', action='store', dest='profile', nargs='?', const=profiling.PROFILE_DIRECTORY,
+                        help='Profile each stage and slow layers and write the profiles to this directory')
+    parser.add_argument('--profile_threshold', action='store', dest='profile_threshold', type=float,
+                        default=profiling.THRESHOLD_SECONDS,
+                        help='Seconds a layer must take for --profile to keep its own profile')
+    parser.add_argument('--formats', nargs='+', choices=sorted(metadata_writers.WRITERS),
+                        default=[metadata_writers.GisiWriter.name],
+                        help='Output formats written from each export')
+    parser.add_argument('--history', action='store_true', dest='history',
+                        help='Record the changed output xml in the output history before and after the run')
+    args = parser.parse_args()
+    if args.report or args.prometheus:
+        instrumentation.enable()
+    if args.profile:
+        profiling.enable(args.profile, args.profile_threshold)
 
     # update_onlink_links()
 
     feature_names = [
         'SGID10.TRANSPORTATION.Railroad_Mileposts'
     ]
-    export_features = []
-    for f in feature_names:
-        workspace = r'Database Connections\Connection to sgid.agrc.utah.gov.sde'
-        if not arcpy.Exists(os.path.join(workspace, f)):
-            print 'not found', f
-        else:
-            export_features.append(f)
-    
-    create_metadata_from_featureclass(export_features, 'data')
+    catalogue = fc_catalogue.get_catalogue()
+    catalogue.refresh(categories=set(fc_catalogue.get_category(f) for f in feature_names))
+
+    if args.history:
+        import output_history
+        print 'Layers changed before this run:', len(output_history.record_before_run(date_time_run))
+    create_metadata_from_featureclass(feature_names, 'data', catalogue, args.formats)
+    if args.history:
+        print 'Layers changed since last recorded run:', len(output_history.record_outputs(run=date_time_run))
+    if args.report:
+        instrumentation.write_report(args.report)
+        print 'Run report:', args.report
+    if args.prometheus:
+        instrumentation.write_prometheus(args.prometheus)
+    if args.profile:
+        print 'Profile summary:', profiling.finish()
 
 
     # catnames = get_categories()
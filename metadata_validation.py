@@ -0,0 +1,220 @@
+'''Check GISI output xml against FGDC CSDGM required fields before import or publication
+
+Each file is parsed and checked for the required elements and value rules
+below and, when lxml and an XSD are available, against the FGDC schema. The
+XSD is not shipped with this repository, so the schema check is skipped until
+one is placed at FGDC_SCHEMA; the report says whether it ran. The schema and
+element paths are compiled once per worker process and files are checked
+across a process pool.
+'''
+import os
+import json
+import multiprocessing
+from time import strftime
+import instrumentation
+import xml_backend
+
+
+VALIDATION_REPORT = 'data/outputs/reports/validation_{}.json'.format(strftime("%Y%m%d_%H%M%S"))
+# FGDC CSDGM XSD, e.g. fgdc-std-001-1998.xsd, not shipped; only used with lxml
+FGDC_SCHEMA = 'templates/fgdc-std-001-1998.xsd'
+
+
+# CSDGM mandatory elements. All are in the empty GISI template except themekey,
+# which the translator adds only for layers with theme keywords.
+REQUIRED_ELEMENTS = (
+    'idinfo/citation/citeinfo/origin',
+    'idinfo/citation/citeinfo/pubdate',
+    'idinfo/citation/citeinfo/title',
+    'idinfo/descript/abstract',
+    'idinfo/descript/purpose',
+    'idinfo/timeperd/timeinfo/sngdate/caldate',
+    'idinfo/timeperd/current',
+    'idinfo/status/progress',
+    'idinfo/status/update',
+    'idinfo/spdom/bounding/westbc',
+    'idinfo/spdom/bounding/eastbc',
+    'idinfo/spdom/bounding/northbc',
+    'idinfo/spdom/bounding/southbc',
+    'idinfo/keywords/theme/themekt',
+    'idinfo/keywords/theme/themekey',
+    'idinfo/accconst',
+    'idinfo/useconst',
+    'metainfo/metstdn'
+)
+
+
+# Required elements whose absence is only a warning, since layers without
+# keywords are still published
+OPTIONAL_ELEMENTS = (
+    'idinfo/keywords/theme/themekey',
+)
+
+
+# Required elements whose text GISI publication cannot do without. The others
+# are often left for editors to fill in, so empty ones are only warnings.
+REQUIRED_TEXT = (
+    'idinfo/citation/citeinfo/title',
+    'idinfo/citation/citeinfo/pubdate',
+    'idinfo/descript/abstract',
+    'idinfo/spdom/bounding/westbc',
+    'idinfo/spdom/bounding/eastbc',
+    'idinfo/spdom/bounding/northbc',
+    'idinfo/spdom/bounding/southbc',
+    'metainfo/metstdn'
+)
+
+
+PROGRESS_VALUES = ('Complete', 'In work', 'Planned')
+UPDATE_VALUES = ('Continually', 'Daily', 'Weekly', 'Monthly', 'Annually', 'Unknown', 'As needed', 'Irregular',
+                 'None planned')
+
+
+# Compiled in each worker process by _init_worker
+_required_paths = None
+_schema = None
+
+
+def _init_worker(schema_path=FGDC_SCHEMA):
+    global _required_paths, _schema
+    _required_paths = [(path, xml_backend.compile_path(path)) for path in REQUIRED_ELEMENTS]
+    _schema = None
+    if xml_backend.LXML and schema_path and os.path.exists(schema_path):
+        _schema = xml_backend.ET.XMLSchema(xml_backend.parse(schema_path))
+
+
+def _text(root, path):
+    elements = root.findall(path)
+    if not elements:
+        return None
+    return (elements[0].text or '').strip()
+
+
+def _check_bounding(root, errors):
+    bounds = {}
+    for name, limit in (('westbc', 180), ('eastbc', 180), ('northbc', 90), ('southbc', 90)):
+        text = _text(root, 'idinfo/spdom/bounding/' + name)
+        if not text:
+            continue
+        try:
+            bounds[name] = float(text)
+        except ValueError:
+            errors.append('{} is not a number: {}'.format(name, text))
+            continue
+        if abs(bounds[name]) > limit:
+            errors.append('{} out of range: {}'.format(name, text))
+    if 'westbc' in bounds and 'eastbc' in bounds and bounds['westbc'] > bounds['eastbc']:
+        errors.append('westbc is east of eastbc')
+    if 'northbc' in bounds and 'southbc' in bounds and bounds['southbc'] > bounds['northbc']:
+        errors.append('southbc is north of northbc')
+
+
+def _check_date(root, path, errors):
+    text = _text(root, path)
+    if text and text != 'Unknown' and not (text.isdigit() and len(text) in (4, 6, 8)):
+        errors.append('{} is not a YYYY, YYYYMM or YYYYMMDD date: {}'.format(path.split('/')[-1], text))
+
+
+def check_root(root):
+    '''Return (errors, warnings) for a parsed GISI document'''
+    errors = []
+    warnings = []
+    for path, find in _required_paths:
+        elements = find(root)
+        if not elements:
+            (warnings if path in OPTIONAL_ELEMENTS else errors).append('missing {}'.format(path))
+        elif not any((e.text or '').strip() not in ('', 'None') for e in elements):
+            (errors if path in REQUIRED_TEXT else warnings).append('empty {}'.format(path))
+    _check_bounding(root, errors)
+    _check_date(root, 'idinfo/citation/citeinfo/pubdate', errors)
+    _check_date(root, 'idinfo/timeperd/timeinfo/sngdate/caldate', errors)
+    progress = _text(root, 'idinfo/status/progress')
+    if progress and progress not in PROGRESS_VALUES:
+        errors.append('unknown progress: {}'.format(progress))
+    update = _text(root, 'idinfo/status/update')
+    if update and update not in UPDATE_VALUES:
+        errors.append('unknown update frequency: {}'.format(update))
+    return errors, warnings
+
+
+def validate_file(xml_path):
+    '''Return {'xml', 'valid', 'errors', 'warnings'} for one file'''
+    if _required_paths is None:
+        _init_worker()
+    try:
+        tree = xml_backend.parse(xml_path)
+    except Exception as e:
+        return {'xml': xml_path, 'valid': False, 'errors': ['not well formed: {}'.format(e)], 'warnings': []}
+    errors, warnings = check_root(tree.getroot())
+    if _schema is not None and not _schema.validate(tree):
+        errors.extend('schema line {}: {}'.format(error.line, error.message) for error in _schema.error_log)
+    return {'xml': xml_path, 'valid': not errors, 'errors': errors, 'warnings': warnings}
+
+
+class ValidationPool(object):
+    '''Worker processes that each compile the schema once and validate files on request'''
+
+    def __init__(self, processes=None, schema_path=FGDC_SCHEMA):
+        self.pool = multiprocessing.Pool(processes, _init_worker, (schema_path,))
+
+    def validate(self, xml_path):
+        return self.pool.apply(validate_file, (xml_path,))
+
+    def validate_all(self, xml_paths):
+        return self.pool.map(validate_file, xml_paths, chunksize=max(1, len(xml_paths) // 32))
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+
+def schema_status(schema_path=FGDC_SCHEMA):
+    '''Whether files are checked against the schema, and why not when they are not'''
+    if not schema_path:
+        return 'skipped: no schema configured'
+    if not xml_backend.LXML:
+        return 'skipped: lxml is not installed'
+    if not os.path.exists(schema_path):
+        return 'skipped: {} not found'.format(schema_path)
+    return 'checked against {}'.format(schema_path)
+
+
+def build_report(results, schema_path=FGDC_SCHEMA):
+    return {'checked': len(results),
+            'schema': schema_status(schema_path),
+            'invalid': len([r for r in results if not r['valid']]),
+            'with_warnings': len([r for r in results if r['warnings']]),
+            'backend': xml_backend.BACKEND,
+            'files': sorted(results, key=lambda r: r['xml'])}
+
+
+def write_report(report, json_path=VALIDATION_REPORT):
+    directory = os.path.dirname(json_path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(json_path, 'w') as f_out:
+        f_out.write(json.dumps(report, sort_keys=True, indent=4))
+
+
+@instrumentation.timed('stage.validate')
+def validate_files(xml_files, processes=None, schema_path=FGDC_SCHEMA, report_path=VALIDATION_REPORT):
+    '''Validate xml_files, write the report and return only the valid paths'''
+    xml_files = list(xml_files)
+    if processes == 1 or len(xml_files) < 2:
+        _init_worker(schema_path)
+        results = [validate_file(xml) for xml in xml_files]
+    else:
+        pool = ValidationPool(processes, schema_path)
+        try:
+            results = pool.validate_all(xml_files)
+        finally:
+            pool.close()
+    report = build_report(results, schema_path)
+    if report_path:
+        write_report(report, report_path)
+    for result in report['files']:
+        if not result['valid']:
+            instrumentation.count('validation.invalid')
+            print 'Invalid {}: {}'.format(result['xml'], '; '.join(result['errors']))
+    print 'Validated {} files, {} invalid, schema {}'.format(report['checked'], report['invalid'], report['schema'])
+    return [r['xml'] for r in results if r['valid']]
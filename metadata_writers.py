@@ -0,0 +1,266 @@
+'''Output formats written from one parsed translator
+
+Every writer gets the same fields dict from GisiXml.fields(), read once per
+layer, so each extra format only adds its own serialisation. Writers are
+chosen by name from WRITERS; GISI xml keeps its data/outputs location and the
+other formats get their own directory under data/outputs.
+'''
+import os
+import json
+import xml_backend
+import fc_catalogue
+from xml_backend import ET
+
+
+GMD = 'http://www.isotc211.org/2005/gmd'
+GCO = 'http://www.isotc211.org/2005/gco'
+GML = 'http://www.opengis.net/gml'
+NSMAP = {'gmd': GMD, 'gco': GCO, 'gml': GML}
+CODELISTS = 'http://www.isotc211.org/2005/resources/Codelist/gmxCodelists.xml'
+
+
+# GISI text -> ISO 19115 code list values
+PROGRESS_CODES = {
+    'Complete': 'completed',
+    'In work': 'onGoing',
+    'Planned': 'planned'
+}
+FREQUENCY_CODES = {
+    'Continually': 'continual',
+    'Daily': 'daily',
+    'Weekly': 'weekly',
+    'Monthly': 'monthly',
+    'Annually': 'annually',
+    'As needed': 'asNeeded',
+    'Irregular': 'irregular',
+    'None planned': 'notPlanned',
+    'Unknown': 'unknown'
+}
+# SGID category -> ISO 19115 MD_TopicCategoryCode, which MD_DataIdentification requires
+TOPIC_CATEGORIES = {
+    'BIOSCIENCE': 'biota',
+    'BOUNDARIES': 'boundaries',
+    'CADASTRE': 'planningCadastre',
+    'CULTURE': 'society',
+    'DEMOGRAPHIC': 'society',
+    'ECONOMY': 'economy',
+    'ELEVATION': 'elevation',
+    'ENERGY': 'utilitiesCommunication',
+    'ENVIRONMENT': 'environment',
+    'FARMING': 'farming',
+    'GEOSCIENCE': 'geoscientificInformation',
+    'HEALTH': 'health',
+    'HISTORY': 'society',
+    'INDICES': 'location',
+    'LOCATION': 'location',
+    'PLANNING': 'planningCadastre',
+    'POLITICAL': 'boundaries',
+    'RASTER': 'imageryBaseMapsEarthCover',
+    'RECREATION': 'society',
+    'SOCIETY': 'society',
+    'TRANSPORTATION': 'transportation',
+    'UTILITIES': 'utilitiesCommunication',
+    'WATER': 'inlandWaters'
+}
+DEFAULT_TOPIC_CATEGORY = 'location'
+
+
+def layer_name(translator):
+    return os.path.basename(translator.output_xml).replace('.xml', '')
+
+
+def topic_category(name):
+    '''ISO topic category of an SGID layer name such as SGID10.CADASTRE.PLSSPoint_GCDB'''
+    if name.count('.') < 2:
+        return DEFAULT_TOPIC_CATEGORY
+    return TOPIC_CATEGORIES.get(fc_catalogue.get_category(name).upper(), DEFAULT_TOPIC_CATEGORY)
+
+
+def iso_date(text):
+    '''YYYY, YYYYMM or YYYYMMDD as an xs:gYear, xs:gYearMonth or xs:date'''
+    if text and text.isdigit() and len(text) == 8:
+        return '{}-{}-{}'.format(text[:4], text[4:6], text[6:])
+    if text and text.isdigit() and len(text) == 6:
+        return '{}-{}'.format(text[:4], text[4:])
+    return text
+
+
+class Writer(object):
+    '''Write one format for a translator
+
+    Subclasses set name and extension and define serialize(translator, fields),
+    returning the file content, or override write entirely as GisiWriter does.
+    '''
+
+    name = None
+    extension = None
+
+    def __init__(self, directory=None):
+        self.directory = directory if directory is not None else os.path.join('data', 'outputs', self.name)
+
+    def output_path(self, translator):
+        return os.path.join(self.directory, layer_name(translator) + self.extension)
+
+    def write(self, translator, fields):
+        '''Write the format and return its path'''
+        path = self.output_path(translator)
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        with open(path, 'wb') as f_out:
+            f_out.write(self.serialize(translator, fields))
+        return path
+
+
+class GisiWriter(Writer):
+    '''GISI xml from the translator's template, as create_gisi_metadata always wrote'''
+
+    name = 'gisi'
+    extension = '.xml'
+
+    def write(self, translator, fields):
+        translator.write_fields_to_xml()
+        return translator.output_xml
+
+
+class IsoWriter(Writer):
+    '''ISO 19139 gmd:MD_Metadata with the same citation, contact, extent, keywords and resources'''
+
+    name = 'iso'
+    extension = '.xml'
+
+    @staticmethod
+    def _element(parent, path, text=None):
+        '''Add path, e.g. 'gmd:title/gco:CharacterString', under parent and return the last element'''
+        element = parent
+        for step in path.split('/'):
+            prefix, tag = step.split(':')
+            element = ET.SubElement(element, '{{{}}}{}'.format(NSMAP[prefix], tag))
+        if text is not None:
+            element.text = text
+        return element
+
+    def _string(self, parent, path, text):
+        if text:
+            self._element(parent, path + '/gco:CharacterString', text)
+
+    def _code(self, parent, path, code_list, value):
+        code = self._element(parent, '{}/gmd:{}'.format(path, code_list), value)
+        code.set('codeList', '{}#{}'.format(CODELISTS, code_list))
+        code.set('codeListValue', value)
+
+    def _contact(self, parent, path, fields):
+        party = self._element(parent, path + '/gmd:CI_ResponsibleParty')
+        self._string(party, 'gmd:individualName', fields['cntper'])
+        self._string(party, 'gmd:organisationName', fields['cntorg'])
+        contact = self._element(party, 'gmd:contactInfo/gmd:CI_Contact')
+        self._string(contact, 'gmd:phone/gmd:CI_Telephone/gmd:voice', fields['cntvoice'])
+        address = self._element(contact, 'gmd:address/gmd:CI_Address')
+        self._string(address, 'gmd:deliveryPoint', fields['address'])
+        self._string(address, 'gmd:city', fields['city'])
+        self._string(address, 'gmd:administrativeArea', fields['state'])
+        self._string(address, 'gmd:postalCode', fields['postal'])
+        self._code(party, 'gmd:role', 'CI_RoleCode', 'pointOfContact')
+
+    def _keywords(self, parent, keywords, keyword_type):
+        if not keywords:
+            return
+        group = self._element(parent, 'gmd:descriptiveKeywords/gmd:MD_Keywords')
+        for keyword in keywords:
+            self._string(group, 'gmd:keyword', keyword)
+        self._code(group, 'gmd:type', 'MD_KeywordTypeCode', keyword_type)
+
+    def build(self, translator, fields):
+        if xml_backend.LXML:
+            root = ET.Element('{{{}}}MD_Metadata'.format(GMD), nsmap=NSMAP)
+        else:
+            for prefix, uri in NSMAP.items():
+                ET.register_namespace(prefix, uri)
+            root = ET.Element('{{{}}}MD_Metadata'.format(GMD))
+        name = layer_name(translator)
+        self._string(root, 'gmd:fileIdentifier', name)
+        self._string(root, 'gmd:language', 'eng')
+        self._code(root, 'gmd:characterSet', 'MD_CharacterSetCode', 'utf8')
+        self._contact(root, 'gmd:contact', fields)
+        self._element(root, 'gmd:dateStamp/gco:Date', iso_date(fields['pubdate']))
+        self._string(root, 'gmd:metadataStandardName', 'ISO 19115:2003/19139')
+        self._string(root, 'gmd:metadataStandardVersion', '1.0')
+
+        identification = self._element(root, 'gmd:identificationInfo/gmd:MD_DataIdentification')
+        citation = self._element(identification, 'gmd:citation/gmd:CI_Citation')
+        self._string(citation, 'gmd:title', fields['title'] or name)
+        citation_date = self._element(citation, 'gmd:date/gmd:CI_Date')
+        self._element(citation_date, 'gmd:date/gco:Date', iso_date(fields['pubdate']))
+        self._code(citation_date, 'gmd:dateType', 'CI_DateTypeCode', 'publication')
+        originator = self._element(citation, 'gmd:citedResponsibleParty/gmd:CI_ResponsibleParty')
+        self._string(originator, 'gmd:organisationName', fields['origin'])
+        self._code(originator, 'gmd:role', 'CI_RoleCode', 'originator')
+        self._string(identification, 'gmd:abstract', fields['abstract'])
+        self._string(identification, 'gmd:purpose', fields['purpose'])
+        if fields['progress'] in PROGRESS_CODES:
+            self._code(identification, 'gmd:status', 'MD_ProgressCode', PROGRESS_CODES[fields['progress']])
+        self._contact(identification, 'gmd:pointOfContact', fields)
+        if fields['update'] in FREQUENCY_CODES:
+            self._code(identification, 'gmd:resourceMaintenance/gmd:MD_MaintenanceInformation/'
+                                       'gmd:maintenanceAndUpdateFrequency',
+                       'MD_MaintenanceFrequencyCode', FREQUENCY_CODES[fields['update']])
+        self._keywords(identification, fields['keywords'], 'theme')
+        self._keywords(identification, fields['placekeys'], 'place')
+        constraints = self._element(identification, 'gmd:resourceConstraints/gmd:MD_LegalConstraints')
+        self._string(constraints, 'gmd:useLimitation', fields['useconst'])
+        self._string(constraints, 'gmd:otherConstraints', fields['accconst'])
+        self._string(identification, 'gmd:language', 'eng')
+        self._code(identification, 'gmd:characterSet', 'MD_CharacterSetCode', 'utf8')
+        self._element(identification, 'gmd:topicCategory/gmd:MD_TopicCategoryCode', topic_category(name))
+
+        extent = self._element(identification, 'gmd:extent/gmd:EX_Extent')
+        if all(fields[bound] for bound in ('westbc', 'eastbc', 'southbc', 'northbc')):
+            box = self._element(extent, 'gmd:geographicElement/gmd:EX_GeographicBoundingBox')
+            self._element(box, 'gmd:westBoundLongitude/gco:Decimal', fields['westbc'])
+            self._element(box, 'gmd:eastBoundLongitude/gco:Decimal', fields['eastbc'])
+            self._element(box, 'gmd:southBoundLatitude/gco:Decimal', fields['southbc'])
+            self._element(box, 'gmd:northBoundLatitude/gco:Decimal', fields['northbc'])
+        if fields['caldate']:
+            instant = self._element(extent, 'gmd:temporalElement/gmd:EX_TemporalExtent/gmd:extent/gml:TimeInstant')
+            instant.set('{{{}}}id'.format(GML), 'caldate')
+            self._element(instant, 'gml:timePosition', iso_date(fields['caldate']))
+
+        transfer = self._element(root, 'gmd:distributionInfo/gmd:MD_Distribution/gmd:transferOptions/'
+                                       'gmd:MD_DigitalTransferOptions')
+        for formname, networkr in fields['resources']:
+            resource = self._element(transfer, 'gmd:onLine/gmd:CI_OnlineResource')
+            self._element(resource, 'gmd:linkage/gmd:URL', networkr)
+            self._string(resource, 'gmd:name', formname)
+        return root
+
+    def serialize(self, translator, fields):
+        return xml_backend.pretty_string(self.build(translator, fields)).encode('UTF-8')
+
+
+class JsonWriter(Writer):
+    '''Summary of the extracted fields for the open data portal'''
+
+    name = 'json'
+    extension = '.json'
+
+    def serialize(self, translator, fields):
+        summary = dict(fields)
+        summary['name'] = layer_name(translator)
+        summary['source'] = translator.sgid_xml
+        summary['resources'] = [{'formname': formname, 'url': networkr}
+                                for formname, networkr in fields['resources']]
+        return json.dumps(summary, sort_keys=True, indent=4)
+
+
+WRITERS = {
+    GisiWriter.name: GisiWriter,
+    IsoWriter.name: IsoWriter,
+    JsonWriter.name: JsonWriter
+}
+
+
+def get_writers(formats=(GisiWriter.name,)):
+    '''Writer instances for format names, in the order given'''
+    unknown = [f for f in formats if f not in WRITERS]
+    if unknown:
+        raise ValueError('Unknown output formats {}, choose from {}'.format(unknown, sorted(WRITERS)))
+    return [WRITERS[f]() for f in formats]
@@ -0,0 +1,249 @@
+'''Versioned history of the output xml, stored as compressed line deltas
+
+Each recorded run appends to the history only the layers whose xml changed
+since their last revision. A revision is stored as a zlib-compressed delta
+against the previous one: line ranges copied from it plus inserted lines.
+Every KEYFRAME_INTERVAL revisions, or when the delta would not be smaller,
+the full text is stored instead, so reading a layer at any run replays at most
+that many deltas. Revisions are appended to one pack file per layer and
+indexed in index.json.
+'''
+import os
+import json
+import zlib
+import difflib
+import hashlib
+import argparse
+from time import strftime
+import instrumentation
+
+
+HISTORY_DIRECTORY = 'data/outputs/history'
+KEYFRAME_INTERVAL = 20
+# Revision kinds
+KEYFRAME = 'k'
+DELTA = 'd'
+
+
+def encode_delta(old_lines, new_lines):
+    '''Ops turning old_lines into new_lines: [start, end] copies old lines, a string inserts text'''
+    ops = []
+    matcher = difflib.SequenceMatcher(None, old_lines, new_lines, autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j2 > j1:
+            # Bytes kept lossless through json as latin-1
+            ops.append(''.join(new_lines[j1:j2]).decode('latin-1'))
+    return ops
+
+
+def apply_delta(old_lines, ops):
+    parts = []
+    for op in ops:
+        if isinstance(op, list):
+            parts.extend(old_lines[op[0]:op[1]])
+        else:
+            parts.append(op.encode('latin-1'))
+    return ''.join(parts)
+
+
+class OutputHistory(object):
+
+    def __init__(self, directory=HISTORY_DIRECTORY, keyframe_interval=KEYFRAME_INTERVAL):
+        self.directory = directory
+        self.keyframe_interval = keyframe_interval
+        self.index_path = os.path.join(directory, 'index.json')
+        # [{'run', 'time', 'files', 'bytes', 'changed'}] in recording order
+        self.runs = []
+        # xml name -> [[run, offset, length, kind, sha1, size]] in recording order
+        self.layers = {}
+        # xml name -> (revision number, text) of the last revision read or written
+        self._latest = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, 'r') as json_file:
+                index = json.load(json_file)
+            self.runs = index['runs']
+            self.layers = index['layers']
+
+    def _pack_path(self, xml_name):
+        return os.path.join(self.directory, xml_name + '.pack')
+
+    def save(self):
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'w') as f_out:
+            f_out.write(json.dumps({'runs': self.runs, 'layers': self.layers}, sort_keys=True))
+        if os.path.exists(self.index_path):
+            # os.rename does not replace existing files on Windows
+            os.remove(self.index_path)
+        os.rename(temp_path, self.index_path)
+
+    def _read_record(self, xml_name, revision):
+        run, offset, length, kind, sha1, size = revision
+        with open(self._pack_path(xml_name), 'rb') as pack:
+            pack.seek(offset)
+            payload = zlib.decompress(pack.read(length))
+        return kind, payload
+
+    def _text_at(self, xml_name, number):
+        '''Text of revision number of xml_name, replayed from the keyframe before it'''
+        latest = self._latest.get(xml_name)
+        if latest is not None and latest[0] == number:
+            return latest[1]
+        revisions = self.layers[xml_name]
+        start = number
+        while revisions[start][3] != KEYFRAME:
+            start -= 1
+        text = None
+        for i in range(start, number + 1):
+            kind, payload = self._read_record(xml_name, revisions[i])
+            text = payload if kind == KEYFRAME else apply_delta(text.splitlines(True), json.loads(payload))
+        if number == len(revisions) - 1:
+            self._latest[xml_name] = (number, text)
+        return text
+
+    def _append(self, xml_name, run, text):
+        revisions = self.layers.setdefault(xml_name, [])
+        kind = KEYFRAME
+        payload = text
+        since_keyframe = 0
+        for revision in reversed(revisions):
+            if revision[3] == KEYFRAME:
+                break
+            since_keyframe += 1
+        if revisions and since_keyframe + 1 < self.keyframe_interval:
+            previous = self._text_at(xml_name, len(revisions) - 1)
+            delta = json.dumps(encode_delta(previous.splitlines(True), text.splitlines(True)))
+            if len(delta) < len(text):
+                kind = DELTA
+                payload = delta
+        record = zlib.compress(payload, 9)
+        pack_path = self._pack_path(xml_name)
+        offset = os.path.getsize(pack_path) if os.path.exists(pack_path) else 0
+        with open(pack_path, 'ab') as pack:
+            pack.write(record)
+        revisions.append([run, offset, len(record), kind, hashlib.sha1(text).hexdigest(), len(text)])
+        self._latest[xml_name] = (len(revisions) - 1, text)
+
+    @instrumentation.timed('history.record_run')
+    def record_run(self, xml_files, run=None):
+        '''Append a revision for each of xml_files that changed since its last one, returning the changed names'''
+        run = run or strftime("%Y%m%d_%H%M%S")
+        if any(r['run'] == run for r in self.runs):
+            raise ValueError('Run {} is already recorded'.format(run))
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        changed = []
+        total_bytes = 0
+        for xml_path in sorted(xml_files):
+            xml_name = os.path.basename(xml_path)
+            with open(xml_path, 'rb') as xml_file:
+                text = xml_file.read()
+            total_bytes += len(text)
+            revisions = self.layers.get(xml_name)
+            if revisions and revisions[-1][4] == hashlib.sha1(text).hexdigest():
+                continue
+            self._append(xml_name, run, text)
+            changed.append(xml_name)
+        instrumentation.count('history.revisions', len(changed))
+        self.runs.append({'run': run, 'time': strftime("%Y-%m-%dT%H:%M:%S"), 'files': len(xml_files),
+                          'bytes': total_bytes, 'changed': len(changed)})
+        self.save()
+        return changed
+
+    def get(self, xml_name, run=None):
+        '''Text of xml_name as of run, the latest run when None; None when the layer had no revision yet'''
+        revisions = self.layers.get(xml_name)
+        if not revisions:
+            return None
+        number = len(revisions) - 1
+        if run is not None:
+            run_order = dict((r['run'], i) for i, r in enumerate(self.runs))
+            if run not in run_order:
+                raise KeyError('Run {} is not recorded'.format(run))
+            while number >= 0 and run_order[revisions[number][0]] > run_order[run]:
+                number -= 1
+            if number < 0:
+                return None
+        return self._text_at(xml_name, number)
+
+    def restore(self, run, output_directory):
+        '''Write every layer as of run into output_directory, returning the number written'''
+        if not os.path.exists(output_directory):
+            os.makedirs(output_directory)
+        written = 0
+        for xml_name in sorted(self.layers):
+            text = self.get(xml_name, run)
+            if text is None:
+                continue
+            with open(os.path.join(output_directory, xml_name), 'wb') as f_out:
+                f_out.write(text)
+            written += 1
+        return written
+
+    def stats(self):
+        '''Stored bytes against full directory copies of every recorded run'''
+        stored = sum(os.path.getsize(self._pack_path(name)) for name in self.layers
+                     if os.path.exists(self._pack_path(name)))
+        copies = sum(r['bytes'] for r in self.runs)
+        revisions = [revision for layer in self.layers.values() for revision in layer]
+        return {'runs': len(self.runs),
+                'layers': len(self.layers),
+                'revisions': len(revisions),
+                'keyframes': len([r for r in revisions if r[3] == KEYFRAME]),
+                'stored_bytes': stored,
+                'copied_bytes': copies,
+                'saved_bytes': copies - stored,
+                'ratio': float(copies) / stored if stored else None}
+
+
+def record_outputs(directory='data/outputs', run=None, history=None):
+    '''Record the output xml of directory as a run'''
+    history = history if history is not None else OutputHistory()
+    names = os.listdir(directory) if os.path.exists(directory) else []
+    xml_files = [os.path.join(directory, name) for name in names if name.endswith('.xml')]
+    return history.record_run(xml_files, run)
+
+
+def record_before_run(run, directory='data/outputs', history=None):
+    '''Record the output xml as run_before, ahead of a run that overwrites it
+
+    Edits made to the xml since the last recorded run are kept even when the run replaces them.
+    '''
+    return record_outputs(directory, run + '_before', history)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Record and read versions of the output xml')
+    parser.add_argument('--record', action='store_true', dest='record',
+                        help='Record the changed xml in data/outputs as a new run')
+    parser.add_argument('--run', action='store', dest='run',
+                        help='Run id to record, read or restore; defaults to now or the latest run')
+    parser.add_argument('--get', action='store', dest='xml_name',
+                        help='Print one layer, e.g. SGID10.WATER.Lakes.xml, as of --run')
+    parser.add_argument('--restore', action='store', dest='restore_directory',
+                        help='Write every layer as of --run into this directory')
+    parser.add_argument('--runs', action='store_true', dest='list_runs',
+                        help='List recorded runs')
+    parser.add_argument('--stats', action='store_true', dest='stats',
+                        help='Show storage used and saved against full copies')
+
+    args = parser.parse_args()
+    output_history = OutputHistory()
+    if args.record:
+        changed_names = record_outputs(run=args.run, history=output_history)
+        print 'Recorded {} changed layers'.format(len(changed_names))
+    if args.xml_name:
+        print output_history.get(args.xml_name, args.run)
+    if args.restore_directory:
+        restore_run = args.run or output_history.runs[-1]['run']
+        print 'Restored {} layers as of {}'.format(output_history.restore(restore_run, args.restore_directory),
+                                                   restore_run)
+    if args.list_runs:
+        for recorded in output_history.runs:
+            print '{run}  {time}  {files} files, {changed} changed'.format(**recorded)
+    if args.stats:
+        for name, value in sorted(output_history.stats().items()):
+            print '{:<14} {}'.format(name, value)
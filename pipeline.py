@@ -0,0 +1,381 @@
+'''Run doc sync, arcpy import and WAF publication as overlapping per-layer stages
+
+Stages are connected by bounded queues, so one layer can be importing while
+the docs of the next are still downloading. Each stage handles a layer at
+most once per run.
+'''
+import os
+import Queue
+import threading
+from datetime import datetime
+from timeit import default_timer
+import instrumentation
+import profiling
+import sync_journal
+import fc_catalogue
+import metadata_validation
+import category_docs
+from drive_inventory import FileInventory
+from text_store import TextStore
+import metadata_conversion
+
+
+_STOP = object()
+
+
+class LayerWork(object):
+    '''Changed docs of one output xml moving through the pipeline'''
+
+    __slots__ = ('xml_path', 'docs', 'updates', 'linked', 'invalid', 'failed')
+
+    def __init__(self, xml_path):
+        self.xml_path = xml_path
+        self.docs = []
+        self.updates = []
+        # xml of other layers written through shared canonical docs, or merged in with their docs
+        self.linked = []
+        # xml that failed validation, left out of import and publication
+        self.invalid = []
+        # xml whose import failed, left out of publication
+        self.failed = []
+
+    @property
+    def key(self):
+        return self.xml_path
+
+    @property
+    def xml_paths(self):
+        return [p for p in [self.xml_path] + self.linked if p not in self.invalid and p not in self.failed]
+
+
+class Stage(object):
+    '''Worker threads applying func to items taken from a bounded queue
+
+    func returns the item to hand to the next stage, or None to drop it.
+    '''
+
+    def __init__(self, name, func, workers=1, queue_size=8):
+        self.name = name
+        self.func = func
+        self.workers = workers
+        self.queue = Queue.Queue(maxsize=queue_size)
+        self.next_stage = None
+        self.processed = 0
+        self.skipped = 0
+        self.errors = 0
+        self.busy_seconds = 0.0
+        self.started = None
+        self.finished = None
+        self._done_keys = set()
+        self._lock = threading.Lock()
+        self._running = workers
+        self._threads = []
+
+    def start(self):
+        self.started = default_timer()
+        for i in range(self.workers):
+            worker = threading.Thread(target=self._work, name='{}-{}'.format(self.name, i))
+            worker.daemon = True
+            worker.start()
+            self._threads.append(worker)
+
+    def close(self):
+        for i in range(self.workers):
+            self.queue.put(_STOP)
+
+    def join(self):
+        for worker in self._threads:
+            worker.join()
+
+    def _claim(self, key):
+        with self._lock:
+            if key in self._done_keys:
+                self.skipped += 1
+                return False
+            self._done_keys.add(key)
+            return True
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is _STOP:
+                break
+            if not self._claim(item.key):
+                continue
+            start = default_timer()
+            result = None
+            failed = False
+            try:
+                with instrumentation.stage('pipeline.' + self.name), profiling.layer(os.path.basename(item.key)):
+                    result = self.func(item)
+            except Exception as e:
+                print '{} failed for {}: {}'.format(self.name, item.key, e)
+                failed = True
+            with self._lock:
+                self.busy_seconds += default_timer() - start
+                if failed:
+                    self.errors += 1
+                else:
+                    self.processed += 1
+            if result is not None and self.next_stage is not None:
+                self.next_stage.queue.put(result)
+
+        with self._lock:
+            self._running -= 1
+            last_worker = self._running == 0
+        if last_worker:
+            self.finished = default_timer()
+            if self.next_stage is not None:
+                self.next_stage.close()
+
+    def summary(self):
+        wall_seconds = (self.finished or default_timer()) - self.started if self.started else 0.0
+        return {
+            'stage': self.name,
+            'workers': self.workers,
+            'processed': self.processed,
+            'skipped': self.skipped,
+            'errors': self.errors,
+            'busy_seconds': self.busy_seconds,
+            'wall_seconds': wall_seconds,
+            'per_second': self.processed / wall_seconds if wall_seconds else None
+        }
+
+
+class Pipeline(object):
+    '''Chain of stages, each feeding the next through its bounded queue'''
+
+    def __init__(self, stages):
+        self.stages = stages
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.next_stage = next_stage
+
+    def run(self, items):
+        for stage in self.stages:
+            stage.start()
+        for item in items:
+            self.stages[0].queue.put(item)
+        self.stages[0].close()
+        for stage in self.stages:
+            stage.join()
+        return [stage.summary() for stage in self.stages]
+
+
+def print_summary(summaries):
+    print '{:<10} {:>7} {:>7} {:>7} {:>9} {:>9} {:>9}'.format('stage', 'workers', 'layers', 'errors',
+                                                              'busy s', 'wall s', 'layers/s')
+    for s in summaries:
+        print '{:<10} {:>7} {:>7} {:>7} {:>9.2f} {:>9.2f} {:>9.2f}'.format(s['stage'], s['workers'],
+                                                                           s['processed'], s['errors'],
+                                                                           s['busy_seconds'], s['wall_seconds'],
+                                                                           s['per_second'] or 0)
+
+
+def list_changed_layers(past_update_time, parent_folder=metadata_conversion.ALL_FOLDER_ID, inventory=None,
+                        folder_ids=None, category_files=None, journal=None):
+    '''Group docs changed after past_update_time, and in folder_ids if given, by the output xml they edit
+
+    Category docs edit many layers, so they are appended to category_files instead. With a
+    journal, docs unchanged since their folders were last synced on their own are left out.
+    '''
+    import drive_loader
+    files = drive_loader.get_files_updated_after_in_directory(past_update_time, parent_folder)
+    instrumentation.count('sync.docs_listed', len(files))
+    layers = {}
+    ordered = []
+    for f in files:
+        if not metadata_conversion.in_folders(f, folder_ids):
+            continue
+        if folder_ids is not None and journal is not None and journal.is_synced(f, folder_ids):
+            continue
+        if inventory is not None and inventory.is_applied(f):
+            # Changed only by the mark of an earlier run
+            continue
+        if category_docs.is_category_doc(f):
+            if inventory is not None:
+                inventory.record(f)
+            if category_files is not None:
+                category_files.append(f)
+            continue
+        xml_path = metadata_conversion.get_doc_xml_path(f)
+        if inventory is not None:
+            inventory.record(f, xml_path)
+        if xml_path not in layers:
+            layers[xml_path] = LayerWork(xml_path)
+            ordered.append(layers[xml_path])
+        layers[xml_path].docs.append(f)
+    return ordered
+
+
+def merge_overlapping_layers(layers, store):
+    '''Merge work items whose xml overlap through shared canonical docs
+
+    A doc linked to other layers writes their xml too, so those may also be
+    the xml, or linked xml, of another item. Each xml then belongs to exactly
+    one item and is imported and published once per run.
+    '''
+    owners = {}
+    merged = []
+    for layer in layers:
+        for drive_file in layer.docs:
+            for linked_path in metadata_conversion.get_linked_xml_paths(drive_file, layer.xml_path, store):
+                if linked_path not in layer.linked:
+                    layer.linked.append(linked_path)
+        paths = [layer.xml_path] + layer.linked
+        targets = []
+        for xml_path in paths:
+            owner = owners.get(xml_path)
+            if owner is not None and owner not in targets:
+                targets.append(owner)
+        if not targets:
+            merged.append(layer)
+            for xml_path in paths:
+                owners[xml_path] = layer
+            continue
+        target = targets[0]
+        for other in targets[1:] + [layer]:
+            if other is not layer:
+                merged.remove(other)
+            target.docs.extend(other.docs)
+            for xml_path in [other.xml_path] + other.linked:
+                if xml_path != target.xml_path and xml_path not in target.linked:
+                    target.linked.append(xml_path)
+                owners[xml_path] = target
+    return merged
+
+
+def run_sync_pipeline(past_update_time,
+                      import_layers=False,
+                      publish=False,
+                      bundle=False,
+                      validate=True,
+                      fetch_workers=4,
+                      parent_folder=metadata_conversion.ALL_FOLDER_ID,
+                      connections_json='connections.json',
+                      folder_ids=None,
+                      rebuild_bundle=False):
+    '''Fetch changed docs, update xml, then optionally import and publish each layer
+
+    With bundle, published layers are collected and written to the WAF bundle once all stages finish;
+    with rebuild_bundle too, the bundle is rebuilt from every output xml.
+    With validate, layers are checked in a process pool before import and publication and invalid
+    xml is left out of both. With folder_ids, only docs in those layer folders are synced and
+    only those folders' update times advance.
+    '''
+    update_time = datetime.utcnow().isoformat()
+    journal = sync_journal.SyncJournal()
+    inventory = FileInventory()
+    store = TextStore()
+
+    def fetch(layer):
+        for drive_file in layer.docs:
+            print 'Updating: ', drive_file['name']
+            if metadata_conversion.resume_doc(drive_file, update_time, journal) is not None:
+                continue
+            xml_path, element_name, text = metadata_conversion.fetch_doc_update(drive_file, journal=journal,
+                                                                                store=store)
+            layer.updates.append((drive_file, xml_path, element_name, text))
+        return layer
+
+    def update(layer):
+        # A merged item holds docs of several xml, so each doc is written to its own
+        for drive_file, xml_path, element_name, text in layer.updates:
+            applied = metadata_conversion.apply_doc_update(drive_file, xml_path, element_name, text,
+                                                           update_time, journal=journal, store=store)
+            inventory.mark_applied(drive_file['id'], applied)
+        for xml_path in layer.xml_paths:
+            metadata_conversion.finish_xml_update(xml_path)
+        return layer
+
+    stages = [Stage('fetch', fetch, workers=fetch_workers),
+              Stage('update', update)]
+
+    validation_pool = None
+    validation_results = []
+    if validate and (import_layers or publish):
+        validation_pool = metadata_validation.ValidationPool()
+
+        def validate_layer(layer):
+            for xml_path in layer.xml_paths:
+                result = validation_pool.validate(xml_path)
+                validation_results.append(result)
+                if not result['valid']:
+                    print 'Invalid {}: {}'.format(xml_path, '; '.join(result['errors']))
+                    layer.invalid.append(xml_path)
+            return layer if layer.xml_paths else None
+
+        stages.append(Stage('validate', validate_layer, workers=2))
+
+    if import_layers:
+        connections = metadata_conversion.load_json(connections_json, remove_update=True)
+        catalogue = fc_catalogue.get_catalogue()
+
+        def import_layer(layer):
+            for xml_path in layer.xml_paths:
+                if not metadata_conversion.import_layer_metadata(xml_path, connections, catalogue,
+                                                                 connections_json):
+                    layer.failed.append(xml_path)
+            return layer if layer.xml_paths else None
+
+        stages.append(Stage('import', import_layer))
+
+    bundled_xml = []
+    if publish:
+        def publish_layer(layer):
+            for xml_path in layer.xml_paths:
+                if os.path.basename(xml_path) in metadata_conversion.WAF_EXCLUDED_XMLS:
+                    continue
+                if bundle:
+                    bundled_xml.append(xml_path)
+                else:
+                    metadata_conversion.copy_gisimetadata_to_waf(metadata_conversion.WAF_PATH,
+                                                                 [xml_path],
+                                                                 metadata_conversion.WAF_EXCLUDED_XMLS)
+            return layer
+
+        stages.append(Stage('publish', publish_layer))
+
+    category_files = []
+    layers = list_changed_layers(past_update_time, parent_folder, inventory, folder_ids, category_files, journal)
+    # Each category doc is exported once up front; its changed layers then go through the remaining stages
+    category_cache = category_docs.CategoryDocCache()
+    listed_paths = set(layer.xml_path for layer in layers)
+    for drive_file in category_files:
+        print 'Updating: ', drive_file['name']
+        xml_paths, applied = metadata_conversion.apply_category_doc(drive_file, update_time, category_cache,
+                                                                    journal=journal)
+        if applied:
+            inventory.mark_applied(drive_file['id'], applied)
+        for xml_path in xml_paths:
+            if xml_path not in listed_paths:
+                listed_paths.add(xml_path)
+                layers.append(LayerWork(xml_path))
+    category_cache.save()
+    inventory.save()
+    layers = merge_overlapping_layers(layers, store)
+    if import_layers:
+        catalogue.refresh(categories=set(fc_catalogue.get_category(os.path.basename(xml_path))
+                                         for layer in layers for xml_path in [layer.xml_path] + layer.linked),
+                          connections_json=connections_json)
+    print 'Layers with changed docs:', len(layers)
+    summaries = Pipeline(stages).run(layers)
+    print_summary(summaries)
+    if validation_pool is not None:
+        validation_pool.close()
+        metadata_validation.write_report(metadata_validation.build_report(validation_results))
+    if bundled_xml or (bundle and rebuild_bundle):
+        import waf_bundle
+        waf_bundle.publish_bundle(metadata_conversion.WAF_PATH, bundled_xml, metadata_conversion.WAF_EXCLUDED_XMLS,
+                                  full=rebuild_bundle)
+
+    if all(s['errors'] == 0 for s in summaries[:2]):
+        if folder_ids is not None:
+            print 'Only layers done on the assignment sheet synced, only their update times advanced'
+        # The time taken before listing, so docs edited during the run are listed again
+        journal.end_run(update_time, folder_ids)
+    else:
+        print 'Docs failed to sync, last update time not advanced'
+    journal.close()
+    inventory.save()
+    store.save()
+    return summaries
@@ -0,0 +1,295 @@
+'''Opt-in cProfile and memory capture per pipeline stage and per layer
+
+Disabled by default. enable() hooks into instrumentation so every stage.*,
+pipeline.* and daemon.pass operation runs under its own cProfile profiler,
+and layer() marks the work on one layer inside a stage. Profiles of layers
+over the time or memory threshold are kept separately; all layer profiles are
+merged into their stage. finish() writes the .prof files and a top-N summary to the
+run directory.
+
+cProfile records only the thread that enabled it. A capture opened on the
+main thread, such as stage.update or the whole pipeline run, leaves out the
+work of pipeline worker threads and of the Drive page prefetch thread; worker
+time shows up only in the pipeline.<stage> captures each worker opens itself.
+
+Memory is measured with tracemalloc where the interpreter has it (Python 3
+or the pytracemalloc build of 2.7); otherwise with the resident set size from
+psutil or /proc, which has no per-line detail.
+'''
+import os
+import re
+import json
+import pstats
+import cProfile
+import threading
+from StringIO import StringIO
+from time import strftime
+from timeit import default_timer
+import instrumentation
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+PROFILE_DIRECTORY = 'data/outputs/profiles/{}'.format(strftime("%Y%m%d_%H%M%S"))
+# Operations profiled as stages; other timed operations show up inside them
+STAGE_PREFIXES = ('stage.', 'pipeline.', 'daemon.pass')
+THRESHOLD_SECONDS = 5.0
+THRESHOLD_BYTES = 50 * 1024 * 1024
+TOP = 25
+
+
+def rss_bytes():
+    '''Resident set size of the process, or None where it cannot be read'''
+    if psutil is not None:
+        return psutil.Process(os.getpid()).memory_info().rss
+    try:
+        with open('/proc/self/statm', 'r') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (IOError, OSError, ValueError):
+        return None
+
+
+def _memory_now():
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[0]
+    return rss_bytes()
+
+
+def _file_name(name):
+    return re.sub(r'[^\w.-]+', '_', name)
+
+
+def _stats(profile):
+    try:
+        return pstats.Stats(profile)
+    except TypeError:
+        # Nothing was recorded
+        return None
+
+
+def top_functions(stats, top=TOP):
+    '''[{'function', 'calls', 'own_seconds', 'cumulative_seconds'}] by cumulative time'''
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:top]
+    return [{'function': '{}:{}({})'.format(*function),
+             'calls': calls,
+             'own_seconds': own_seconds,
+             'cumulative_seconds': cumulative_seconds}
+            for function, (primitive_calls, calls, own_seconds, cumulative_seconds, callers) in rows]
+
+
+class _Capture(object):
+    '''Profile a block on the current thread, pausing the capture it is nested in'''
+
+    def __init__(self, profiler, operation, layer=None):
+        self.profiler = profiler
+        self.operation = operation
+        self.layer = layer
+        self.children = []
+        self.profile = None
+        self.parent = None
+        self.start = None
+        self.memory_start = None
+        self.snapshot = None
+
+    def __enter__(self):
+        stack = self.profiler._stack()
+        if stack:
+            self.parent = stack[-1]
+            self.parent.profile.disable()
+        stack.append(self)
+        self.memory_start = _memory_now()
+        if self.layer is None and tracemalloc is not None and tracemalloc.is_tracing():
+            self.snapshot = tracemalloc.take_snapshot()
+        self.start = default_timer()
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.profile.disable()
+        seconds = default_timer() - self.start
+        memory_end = _memory_now()
+        memory_bytes = None
+        if memory_end is not None and self.memory_start is not None:
+            memory_bytes = memory_end - self.memory_start
+        allocations = None
+        if self.snapshot is not None:
+            statistics = tracemalloc.take_snapshot().compare_to(self.snapshot, 'lineno')
+            allocations = [str(statistic) for statistic in statistics[:self.profiler.top]]
+
+        stats = _stats(self.profile)
+        for child in self.children:
+            stats = child if stats is None else stats.add(child)
+        self.profiler._stack().pop()
+        if self.parent is not None:
+            if stats is not None:
+                self.parent.children.append(stats)
+            self.parent.profile.enable()
+
+        if self.layer is None:
+            self.profiler._add_stage(self.operation, stats, seconds, memory_bytes, allocations)
+        else:
+            self.profiler._add_layer(self.layer, self.operation, stats, seconds, memory_bytes)
+        return False
+
+
+class _NullCapture(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+_NULL_CAPTURE = _NullCapture()
+
+
+class Profiler(object):
+
+    def __init__(self, directory=PROFILE_DIRECTORY, threshold_seconds=THRESHOLD_SECONDS,
+                 threshold_bytes=THRESHOLD_BYTES, top=TOP):
+        self.directory = directory
+        self.threshold_seconds = threshold_seconds
+        self.threshold_bytes = threshold_bytes
+        self.top = top
+        # operation -> {'calls', 'seconds', 'memory_bytes', 'allocations', 'stats'}
+        self.stages = {}
+        # [{'layer', 'stage', 'seconds', 'memory_bytes', 'profile'}] for layers over a threshold
+        self.slow_layers = []
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self):
+        if not hasattr(self._local, 'captures'):
+            self._local.captures = []
+        return self._local.captures
+
+    def stage_capture(self, operation):
+        '''Capture for a stage operation, None for any other operation'''
+        if operation.startswith(STAGE_PREFIXES):
+            return _Capture(self, operation)
+        return None
+
+    def layer_capture(self, layer):
+        stack = self._stack()
+        operation = stack[-1].operation if stack else 'no stage'
+        return _Capture(self, operation, layer)
+
+    def _add_stage(self, operation, stats, seconds, memory_bytes, allocations):
+        with self._lock:
+            stage = self.stages.setdefault(operation, {'calls': 0, 'seconds': 0.0, 'memory_bytes': None,
+                                                       'allocations': None, 'stats': None})
+            stage['calls'] += 1
+            stage['seconds'] += seconds
+            if memory_bytes is not None:
+                stage['memory_bytes'] = max(stage['memory_bytes'], memory_bytes)
+            if allocations:
+                stage['allocations'] = allocations
+            if stats is not None:
+                stage['stats'] = stats if stage['stats'] is None else stage['stats'].add(stats)
+
+    def _add_layer(self, layer, operation, stats, seconds, memory_bytes):
+        if seconds < self.threshold_seconds and (memory_bytes is None or memory_bytes < self.threshold_bytes):
+            return
+        # Written now, as the stats are merged into the stage's afterwards
+        prof_path = None
+        if stats is not None:
+            prof_path = os.path.join(self._sub_directory('layers'),
+                                     '{}__{}.prof'.format(_file_name(layer), _file_name(operation)))
+            stats.dump_stats(prof_path)
+        with self._lock:
+            self.slow_layers.append({'layer': layer, 'stage': operation, 'seconds': seconds,
+                                     'memory_bytes': memory_bytes, 'profile': prof_path})
+
+    def _sub_directory(self, name):
+        path = os.path.join(self.directory, name)
+        with self._lock:
+            if not os.path.exists(path):
+                os.makedirs(path)
+        return path
+
+    def write(self):
+        '''Write stage and slow layer profiles and the summaries, returning the summary path'''
+        stages_directory = self._sub_directory('stages')
+        with self._lock:
+            stages = sorted(self.stages.items(), key=lambda item: item[1]['seconds'], reverse=True)
+            slow_layers = sorted(self.slow_layers, key=lambda layer: layer['seconds'], reverse=True)
+
+        summary = {'memory': 'tracemalloc' if tracemalloc is not None else 'rss' if rss_bytes() else None,
+                   'threshold_seconds': self.threshold_seconds,
+                   'stages': {},
+                   'slow_layers': []}
+        text = StringIO()
+        for operation, stage in stages:
+            prof_path = None
+            if stage['stats'] is not None:
+                prof_path = os.path.join(stages_directory, _file_name(operation) + '.prof')
+                stage['stats'].dump_stats(prof_path)
+            summary['stages'][operation] = {
+                'calls': stage['calls'],
+                'seconds': stage['seconds'],
+                'memory_bytes': stage['memory_bytes'],
+                'allocations': stage['allocations'],
+                'profile': prof_path,
+                'top': top_functions(stage['stats'], self.top) if stage['stats'] is not None else []
+            }
+            text.write('=== {} ({} calls, {:.2f} s, memory {})\n'.format(operation, stage['calls'], stage['seconds'],
+                                                                       stage['memory_bytes']))
+            for line in stage['allocations'] or []:
+                text.write('  {}\n'.format(line))
+            if stage['stats'] is not None:
+                stage['stats'].stream = text
+                stage['stats'].sort_stats('cumulative').print_stats(self.top)
+
+        for layer in slow_layers:
+            summary['slow_layers'].append(layer)
+            text.write('--- slow layer {} in {}: {:.2f} s, memory {}\n'.format(layer['layer'], layer['stage'],
+                                                                             layer['seconds'], layer['memory_bytes']))
+
+        with open(os.path.join(self.directory, 'summary.json'), 'w') as f_out:
+            f_out.write(json.dumps(summary, sort_keys=True, indent=4))
+        summary_path = os.path.join(self.directory, 'summary.txt')
+        with open(summary_path, 'w') as f_out:
+            f_out.write(text.getvalue())
+        return summary_path
+
+
+_profiler = None
+
+
+def enable(directory=PROFILE_DIRECTORY, threshold_seconds=THRESHOLD_SECONDS, threshold_bytes=THRESHOLD_BYTES,
+           top=TOP):
+    global _profiler
+    _profiler = Profiler(directory, threshold_seconds, threshold_bytes, top)
+    if tracemalloc is not None and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    instrumentation.set_profile_hook(_profiler.stage_capture)
+    return _profiler
+
+
+def layer(name):
+    '''Context manager marking the work on one layer; a no-op unless profiling'''
+    if _profiler is None:
+        return _NULL_CAPTURE
+    return _profiler.layer_capture(name)
+
+
+def finish():
+    '''Stop profiling and write the run directory, returning the summary path or None'''
+    global _profiler
+    if _profiler is None:
+        return None
+    instrumentation.set_profile_hook(None)
+    profiler, _profiler = _profiler, None
+    if tracemalloc is not None and tracemalloc.is_tracing():
+        tracemalloc.stop()
+    return profiler.write()
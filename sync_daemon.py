@@ -0,0 +1,258 @@
+'''Resident sync that keeps the Drive session and doc inventory warm
+
+Edits are applied when Drive posts a change notification to the local
+endpoint, or at the latest every poll interval. Send a notification by hand
+with --notify to exercise the endpoint without Drive.
+'''
+import os
+import json
+import uuid
+import urllib2
+import argparse
+import threading
+import BaseHTTPServer
+from time import time
+from datetime import datetime
+import instrumentation
+import category_docs
+import sync_journal
+import metadata_conversion
+from drive_inventory import FileInventory
+from text_store import TextStore
+
+
+DAEMON_STATE = 'data/outputs/temp/daemon_state.json'
+FOLDER_MIME_TYPE = 'application/vnd.google-apps.folder'
+
+
+# Drive watch channels expire; renew this long before they do
+WATCH_SECONDS = 3600
+RENEW_SECONDS = 300
+
+
+class NotificationHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    '''Receives Drive push notifications and wakes the daemon'''
+
+    def do_POST(self):
+        length = int(self.headers.getheader('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        self.server.sync_daemon.notify(self.headers.getheader('X-Goog-Channel-ID'),
+                                       self.headers.getheader('X-Goog-Resource-State'))
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SyncDaemon(object):
+
+    def __init__(self,
+                 parent_folder=metadata_conversion.ALL_FOLDER_ID,
+                 poll_interval=60,
+                 port=None,
+                 webhook_address=None,
+                 state_path=DAEMON_STATE,
+                 inventory=None):
+        self.parent_folder = parent_folder
+        self.poll_interval = poll_interval
+        self.port = port
+        self.webhook_address = webhook_address
+        self.state_path = state_path
+        self.inventory = inventory if inventory is not None else FileInventory()
+        self.journal = sync_journal.SyncJournal()
+        self.store = TextStore()
+        self.category_cache = category_docs.CategoryDocCache()
+        self.service = None
+        self.page_token = None
+        self.channel = None
+        self.server = None
+        self.wake = threading.Event()
+        self.stopped = False
+
+    def notify(self, channel_id, resource_state):
+        if self.channel is not None and channel_id != self.channel['id']:
+            instrumentation.count('daemon.notifications_ignored')
+            return
+        if resource_state == 'sync':
+            # Sent once when a channel is opened, not a change
+            return
+        instrumentation.count('daemon.notifications')
+        self.wake.set()
+
+    def load_state(self):
+        if os.path.exists(self.state_path):
+            with open(self.state_path, 'r') as json_file:
+                return json.load(json_file)
+        return {}
+
+    def save_state(self):
+        with open(self.state_path, 'w') as f_out:
+            f_out.write(json.dumps({'page_token': self.page_token, 'channel': self.channel},
+                                   sort_keys=True, indent=4))
+        self.inventory.save()
+        self.store.save()
+
+    def start(self):
+        '''Authenticate once, catch up if this is the first start, then listen'''
+        import drive_loader
+        self.service = drive_loader.setup_drive_service()
+        state = self.load_state()
+        self.page_token = state.get('page_token')
+        self.channel = state.get('channel')
+        if self.page_token is None:
+            # Take the token before catching up so nothing edited meanwhile is missed
+            self.page_token = drive_loader.get_start_page_token(self.service)
+            past_update_time = metadata_conversion.get_last_update()
+            print 'Catching up on docs updated after', past_update_time
+            # The daemon's journal, so the catch-up's compaction is not undone by a stale copy
+            metadata_conversion.check_files_and_update(past_update_time, self.parent_folder, service=self.service,
+                                                       journal=self.journal)
+            self.save_state()
+
+        if self.port:
+            self.server = BaseHTTPServer.HTTPServer(('', self.port), NotificationHandler)
+            self.server.sync_daemon = self
+            listener = threading.Thread(target=self.server.serve_forever, name='notifications')
+            listener.daemon = True
+            listener.start()
+            print 'Listening for notifications on port', self.port
+        if self.webhook_address:
+            self.renew_watch()
+
+    def renew_watch(self):
+        import drive_loader
+        if self.channel and self.channel['expiration'] / 1000.0 - time() > RENEW_SECONDS:
+            return
+        channel_id = str(uuid.uuid4())
+        expiration_ms = int((time() + WATCH_SECONDS) * 1000)
+        response = drive_loader.watch_changes(self.page_token, channel_id, self.webhook_address,
+                                              self.service, expiration_ms)
+        old_channel = self.channel
+        self.channel = {'id': channel_id,
+                        'resourceId': response['resourceId'],
+                        'expiration': int(response.get('expiration', expiration_ms))}
+        if old_channel:
+            try:
+                drive_loader.stop_channel(old_channel['id'], old_channel['resourceId'], self.service)
+            except Exception as e:
+                print 'Could not stop channel', old_channel['id'], e
+
+    def run_once(self):
+        '''Apply every doc change since the saved page token, returning the xml paths touched'''
+        import drive_loader
+        # Taken before listing and kept as the checkpoint, so edits made during the pass are not skipped
+        update_time = datetime.utcnow().isoformat()
+        changes, new_page_token = drive_loader.get_changes(self.page_token, self.service)
+        touched = set()
+        failed = False
+        for change in changes:
+            drive_file = change.get('file')
+            if change.get('removed') or drive_file is None or drive_file.get('trashed'):
+                self.inventory.remove(change['fileId'])
+                continue
+            if drive_file.get('mimeType') == FOLDER_MIME_TYPE:
+                continue
+            if self.parent_folder not in drive_file.get('parents', []):
+                continue
+            if self.inventory.is_applied(drive_file):
+                continue
+            try:
+                print 'Updating: ', drive_file['name']
+                if category_docs.is_category_doc(drive_file):
+                    # One export writes the changed sections of many layers
+                    xml_paths, applied = metadata_conversion.apply_category_doc(drive_file, update_time,
+                                                                                self.category_cache,
+                                                                                self.service, self.journal)
+                    self.inventory.record(drive_file)
+                    if applied:
+                        self.inventory.mark_applied(drive_file['id'], applied)
+                    touched.update(xml_paths)
+                    self.category_cache.save()
+                    continue
+                xml_path, element_name, text = metadata_conversion.fetch_doc_update(drive_file, self.service,
+                                                                                    self.journal, self.store)
+                self.inventory.record(drive_file, xml_path)
+                applied = metadata_conversion.apply_doc_update(drive_file, xml_path, element_name, text,
+                                                               update_time, self.service, self.journal,
+                                                               self.store)
+                self.inventory.mark_applied(drive_file['id'], applied)
+                touched.add(xml_path)
+                touched.update(metadata_conversion.get_linked_xml_paths(drive_file, xml_path, self.store))
+            except Exception as e:
+                print 'Update failed for {}: {}'.format(drive_file['name'], e)
+                failed = True
+
+        for xml_path in touched:
+            metadata_conversion.finish_xml_update(xml_path)
+        if not failed:
+            # Keep the old token after a failure so the next pass retries; applied docs are skipped
+            self.page_token = new_page_token
+        if touched and not failed:
+            self.journal.end_run(update_time)
+        self.save_state()
+        return touched
+
+    def serve_forever(self):
+        self.start()
+        try:
+            while not self.stopped:
+                if self.webhook_address:
+                    self.renew_watch()
+                try:
+                    with instrumentation.stage('daemon.pass'):
+                        touched = self.run_once()
+                    if touched:
+                        print 'Updated {} xml files'.format(len(touched))
+                except Exception as e:
+                    print 'Sync pass failed:', e
+                self.wake.wait(self.poll_interval)
+                self.wake.clear()
+        except KeyboardInterrupt:
+            pass
+        self.stop()
+
+    def stop(self):
+        import drive_loader
+        self.stopped = True
+        if self.server:
+            self.server.shutdown()
+        if self.channel:
+            try:
+                drive_loader.stop_channel(self.channel['id'], self.channel['resourceId'], self.service)
+            except Exception as e:
+                print 'Could not stop channel', self.channel['id'], e
+            self.channel = None
+        self.save_state()
+
+
+def send_fake_notification(url, channel_id=None, resource_state='change'):
+    '''POST a Drive style change notification, for testing the endpoint locally'''
+    request = urllib2.Request(url, data='', headers={'X-Goog-Channel-ID': channel_id or '',
+                                                    'X-Goog-Resource-State': resource_state,
+                                                    'X-Goog-Message-Number': '1'})
+    return urllib2.urlopen(request, timeout=10).getcode()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Keep metadata xml in sync with Drive docs')
+    parser.add_argument('--poll', action='store', dest='poll_interval', type=int, default=60,
+                        help='Seconds between change checks when no notification arrives')
+    parser.add_argument('--port', action='store', dest='port', type=int,
+                        help='Local port to receive Drive push notifications on')
+    parser.add_argument('--webhook', action='store', dest='webhook_address',
+                        help='Public https address that forwards to --port, registered with Drive')
+    parser.add_argument('--notify', action='store', dest='notify_url',
+                        help='Send a fake change notification to this url and exit')
+    parser.add_argument('--channel', action='store', dest='channel_id',
+                        help='Channel id for --notify')
+
+    args = parser.parse_args()
+
+    if args.notify_url:
+        print send_fake_notification(args.notify_url, args.channel_id)
+    else:
+        SyncDaemon(poll_interval=args.poll_interval,
+                   port=args.port,
+                   webhook_address=args.webhook_address).serve_forever()
@@ -0,0 +1,182 @@
+'''Append-only journal of doc sync progress
+
+Every doc fetched, applied to its xml and marked on Drive is appended as one
+JSON line when it happens, so a run that crashes halfway resumes where it
+stopped: applied docs are not fetched again and marked docs are skipped.
+Finishing a run compacts the journal into a small checkpoint holding the
+last update time. A run limited to some layer folders records its time per
+folder instead, so those folders resume from it while the others keep the
+last full run's time.
+'''
+import os
+import json
+import threading
+from time import strftime
+
+
+JOURNAL = 'data/outputs/temp/sync_journal.log'
+CHECKPOINT = 'data/outputs/temp/sync_checkpoint.json'
+
+
+FETCHED = 'fetched'
+APPLIED = 'applied'
+MARKED = 'marked'
+_STATE_ORDER = {FETCHED: 1, APPLIED: 2, MARKED: 3}
+
+
+class SyncJournal(object):
+
+    def __init__(self, journal_path=JOURNAL, checkpoint_path=CHECKPOINT):
+        self.journal_path = journal_path
+        self.checkpoint_path = checkpoint_path
+        self.last_update = None
+        # folder_id -> end time of the last run limited to folders including it
+        self.folder_updates = {}
+        # file_id -> {'state', 'modified', 'marked_modified', 'xml'}; a category doc's xml is a list
+        self.docs = {}
+        self._lock = threading.Lock()
+        self._journal = None
+
+        if os.path.exists(checkpoint_path):
+            with open(checkpoint_path, 'r') as json_file:
+                checkpoint = json.load(json_file)
+            self.last_update = checkpoint.get('last_update')
+            self.folder_updates = checkpoint.get('folder_updates') or {}
+        if os.path.exists(journal_path):
+            self._replay()
+
+    def _replay(self):
+        with open(self.journal_path, 'r') as journal:
+            for line in journal:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a torn final line from a crash mid-write
+                    continue
+                self._apply(entry)
+
+    def _apply(self, entry):
+        event = entry['event']
+        if event == 'end':
+            if entry.get('folders') is not None:
+                # Docs of other folders may still be unfinished, so they are kept
+                for folder_id in entry['folders']:
+                    self.folder_updates[folder_id] = entry['last_update']
+                return
+            self.last_update = entry['last_update']
+            self.docs.clear()
+            for folder_id, folder_update in self.folder_updates.items():
+                if folder_update <= self.last_update:
+                    del self.folder_updates[folder_id]
+            return
+        if event not in _STATE_ORDER:
+            return
+        doc = self.docs.get(entry['file_id'])
+        if doc is None or doc['modified'] != entry['modified']:
+            doc = self.docs[entry['file_id']] = {'modified': entry['modified'], 'state': None,
+                                                 'marked_modified': None, 'xml': None}
+        doc['state'] = event
+        if entry.get('xml'):
+            doc['xml'] = entry['xml']
+        if event == MARKED:
+            doc['marked_modified'] = entry.get('marked_modified')
+
+    def _append(self, entry):
+        with self._lock:
+            if self._journal is None:
+                directory = os.path.dirname(self.journal_path)
+                if directory and not os.path.exists(directory):
+                    os.makedirs(directory)
+                self._journal = open(self.journal_path, 'a')
+            self._journal.write(json.dumps(entry, sort_keys=True) + '\n')
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            self._apply(entry)
+
+    def record(self, event, drive_file, xml_path=None, marked_modified=None):
+        entry = {'event': event,
+                 'file_id': drive_file['id'],
+                 'modified': drive_file.get('modifiedTime'),
+                 'time': strftime("%Y-%m-%dT%H:%M:%S")}
+        if xml_path:
+            entry['xml'] = xml_path
+        if marked_modified:
+            entry['marked_modified'] = marked_modified
+        self._append(entry)
+
+    def state(self, drive_file):
+        '''Return the furthest step recorded for this version of the doc, or None'''
+        doc = self.docs.get(drive_file['id'])
+        if doc is None:
+            return None
+        modified = drive_file.get('modifiedTime')
+        if modified == doc['modified'] or (modified and modified == doc['marked_modified']):
+            return doc['state']
+        return None
+
+    def xml_path(self, drive_file):
+        doc = self.docs.get(drive_file['id'])
+        return doc['xml'] if doc else None
+
+    def last_update_for(self, folder_ids=None):
+        '''Oldest update time of folder_ids, each falling back to the last full run'''
+        if not folder_ids:
+            return self.last_update
+        times = [self.folder_updates.get(folder_id, self.last_update) for folder_id in folder_ids]
+        if None in times:
+            return None
+        return min(times)
+
+    def is_synced(self, drive_file, folder_ids):
+        '''True when the doc is unchanged since a limited run synced each of its folders in folder_ids'''
+        modified = drive_file.get('modifiedTime')
+        times = [self.folder_updates.get(parent) for parent in drive_file.get('parents') or []
+                 if parent in folder_ids]
+        if not modified or not times or None in times:
+            return False
+        return modified <= min(times)
+
+    def end_run(self, last_update, folder_ids=None):
+        '''Record a finished run and compact the journal into the checkpoint
+
+        With folder_ids, only those folders advance to last_update.
+        '''
+        entry = {'event': 'end', 'last_update': last_update, 'time': strftime("%Y-%m-%dT%H:%M:%S")}
+        if folder_ids is not None:
+            entry['folders'] = sorted(folder_ids)
+        self._append(entry)
+        self.compact()
+
+    def compact(self):
+        '''Write the checkpoint, then start the journal over from the unfinished docs'''
+        with self._lock:
+            temp_path = self.checkpoint_path + '.tmp'
+            with open(temp_path, 'w') as f_out:
+                f_out.write(json.dumps({'last_update': self.last_update,
+                                        'folder_updates': self.folder_updates,
+                                        'compacted': strftime("%Y_%m_%d %H:%M:%S")},
+                                       sort_keys=True, indent=4))
+                f_out.flush()
+                os.fsync(f_out.fileno())
+            if os.path.exists(self.checkpoint_path):
+                # os.rename does not replace existing files on Windows
+                os.remove(self.checkpoint_path)
+            os.rename(temp_path, self.checkpoint_path)
+
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            with open(self.journal_path, 'w') as journal:
+                for file_id, doc in sorted(self.docs.items()):
+                    entry = {'event': doc['state'], 'file_id': file_id, 'modified': doc['modified']}
+                    if doc['xml']:
+                        entry['xml'] = doc['xml']
+                    if doc['marked_modified']:
+                        entry['marked_modified'] = doc['marked_modified']
+                    journal.write(json.dumps(entry, sort_keys=True) + '\n')
+
+    def close(self):
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
@@ -0,0 +1,181 @@
+'''Work set and duration estimate for a sync run, from local state only
+
+Docs come from the local inventory, kept by listings and the sync daemon, and
+from the sync journal of an interrupted run. Layers are checked against the
+feature class catalogue and durations are priced with the mean latencies
+recorded in earlier run reports. Nothing here calls Drive or arcpy, so the
+plan is only as current as the inventory.
+
+Every sync marks the docs it lists as applied, so outside an interrupted run
+the docs to fetch are only those listed but not yet applied. Docs edited on
+Drive since the inventory was last saved are not counted; the plan reports
+the inventory's age so the estimate can be read with that in mind.
+'''
+import os
+import json
+from glob import glob
+from time import time, strftime
+import sync_journal
+import fc_catalogue
+from drive_inventory import FileInventory
+
+
+REPORTS_DIRECTORY = 'data/outputs/reports'
+PLAN_REPORT = 'data/outputs/reports/plan_{}.json'.format(strftime("%Y%m%d_%H%M%S"))
+
+
+# Recorded operation that prices one unit of each kind of work
+LIST_OPERATION = 'drive.list_page'
+FETCH_OPERATION = 'sync.fetch_doc'
+MARK_OPERATION = 'drive.set_property'
+XML_OPERATION = 'xml.update_element'
+IMPORT_OPERATION = 'arcpy.import'
+COPY_OPERATION = 'waf.copy'
+BUNDLE_OPERATION = 'stage.waf_bundle'
+
+
+def load_latencies(directory=REPORTS_DIRECTORY, max_reports=10):
+    '''Mean seconds per operation over the newest run reports, weighted by call count'''
+    totals = {}
+    counts = {}
+    reports = sorted(glob(os.path.join(directory, 'run_*.json')), key=os.path.getmtime)[-max_reports:]
+    for report_path in reports:
+        with open(report_path, 'r') as json_file:
+            operations = json.load(json_file).get('operations', {})
+        for operation, histogram in operations.items():
+            totals[operation] = totals.get(operation, 0.0) + histogram['total_seconds']
+            counts[operation] = counts.get(operation, 0) + histogram['count']
+    return dict((operation, totals[operation] / counts[operation]) for operation in totals if counts[operation])
+
+
+def pending_docs(past_update_time, inventory, journal):
+    '''Split known docs into (docs to fetch and apply, docs only needing their mark)
+
+    Each is a dict of file_id -> xml path, None when the xml is not known yet.
+    '''
+    to_fetch = {}
+    to_mark = {}
+    for file_id, record in inventory.files.items():
+        modified = record.get('modifiedTime')
+        if modified and modified > past_update_time and record.get('applied') != modified:
+            to_fetch[file_id] = record.get('xml_path')
+    for file_id, doc in journal.docs.items():
+        if doc['state'] == sync_journal.APPLIED:
+            to_fetch.pop(file_id, None)
+            to_mark[file_id] = doc['xml']
+        elif doc['state'] == sync_journal.FETCHED and file_id not in to_fetch:
+            to_fetch[file_id] = doc['xml']
+    return to_fetch, to_mark
+
+
+def _estimate(latencies, operation, units):
+    if units == 0:
+        return 0.0
+    if operation not in latencies:
+        return None
+    return latencies[operation] * units
+
+
+def plan_sync(past_update_time,
+              import_layers=False,
+              publish=False,
+              bundle=False,
+              fetch_workers=1,
+              excluded_xmls=(),
+              inventory=None,
+              journal=None,
+              catalogue=None,
+              latencies=None):
+    '''Return the docs, xml files, imports and publications a sync would do and how long they should take'''
+    inventory = inventory if inventory is not None else FileInventory()
+    journal = journal if journal is not None else sync_journal.SyncJournal()
+    catalogue = catalogue if catalogue is not None else fc_catalogue.get_catalogue()
+    latencies = latencies if latencies is not None else load_latencies()
+
+    to_fetch, to_mark = pending_docs(past_update_time, inventory, journal)
+    inventory_age = inventory.saved_seconds_ago(time())
+    xml_paths = set(p for p in to_fetch.values() + to_mark.values() if p)
+    unknown_xml = len([p for p in to_fetch.values() if not p])
+
+    imports = []
+    not_in_catalogue = []
+    if import_layers or publish:
+        for xml_path in sorted(xml_paths):
+            feature_name = os.path.basename(xml_path).replace('.xml', '')
+            if len(catalogue) > 0 and catalogue.find(feature_name) is None:
+                not_in_catalogue.append(feature_name)
+            else:
+                imports.append(xml_path)
+    published = []
+    if publish:
+        published = [p for p in sorted(xml_paths) if os.path.basename(p) not in excluded_xmls]
+
+    stage_seconds = {
+        'list': _estimate(latencies, LIST_OPERATION, 1),
+        'fetch': _estimate(latencies, FETCH_OPERATION, len(to_fetch)),
+        'update': _estimate(latencies, XML_OPERATION, len(to_fetch) + len(xml_paths)),
+        'mark': _estimate(latencies, MARK_OPERATION, len(to_fetch) + len(to_mark)),
+        'import': _estimate(latencies, IMPORT_OPERATION, len(imports)),
+        'publish': (_estimate(latencies, BUNDLE_OPERATION, 1 if published else 0) if bundle
+                    else _estimate(latencies, COPY_OPERATION, len(published)))
+    }
+    unpriced = sorted(name for name, seconds in stage_seconds.items() if seconds is None)
+    priced = dict((name, seconds or 0.0) for name, seconds in stage_seconds.items())
+    sequential_seconds = sum(priced.values())
+    # Pipelined stages overlap, so the slowest one bounds the run
+    pipeline_seconds = priced['list'] + max(priced['fetch'] / max(fetch_workers, 1),
+                                            priced['update'] + priced['mark'],
+                                            priced['import'],
+                                            priced['publish'])
+
+    return {
+        'past_update_time': past_update_time,
+        'inventory_docs': len(inventory),
+        'inventory_saved': inventory.saved,
+        'inventory_age_seconds': inventory_age,
+        'docs_to_fetch': len(to_fetch),
+        'docs_to_mark_only': len(to_mark),
+        'docs_without_known_xml': unknown_xml,
+        'xml_files': sorted(xml_paths),
+        'imports': len(imports),
+        'not_in_catalogue': not_in_catalogue,
+        'published': len(published),
+        'bundle': bundle,
+        'fetch_workers': fetch_workers,
+        'stage_seconds': stage_seconds,
+        'unpriced_stages': unpriced,
+        'sequential_seconds': sequential_seconds,
+        'pipeline_seconds': pipeline_seconds
+    }
+
+
+def print_plan(plan):
+    print 'Docs changed after', plan['past_update_time']
+    print '  inventory docs:  ', plan['inventory_docs']
+    if plan['inventory_saved'] is None:
+        print '  inventory never saved: run a sync or the daemon first, only the journal is counted'
+    else:
+        print '  inventory saved:  {} ({:.1f} hours ago)'.format(plan['inventory_saved'],
+                                                              plan['inventory_age_seconds'] / 3600.0)
+        print '  Drive edits since then are not counted below'
+    print '  known docs to fetch:', plan['docs_to_fetch'], '({} without a known xml)'.format(
+        plan['docs_without_known_xml'])
+    print '  docs to mark:    ', plan['docs_to_mark_only']
+    print '  xml rewritten:   ', len(plan['xml_files'])
+    print '  layers imported: ', plan['imports']
+    for feature_name in plan['not_in_catalogue']:
+        print '    not in catalogue:', feature_name
+    print '  files published: ', plan['published'], '(bundle)' if plan['bundle'] else ''
+    for name in ('list', 'fetch', 'update', 'mark', 'import', 'publish'):
+        seconds = plan['stage_seconds'][name]
+        print '  {:<8} {}'.format(name, 'no recorded latency' if seconds is None else '{:.1f} s'.format(seconds))
+    print 'Estimated sequential: {:.1f} s, pipelined with {} fetch workers: {:.1f} s'.format(
+        plan['sequential_seconds'], plan['fetch_workers'], plan['pipeline_seconds'])
+
+
+def write_plan(plan, json_path=PLAN_REPORT):
+    directory = os.path.dirname(json_path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(json_path, 'w') as f_out:
+        f_out.write(json.dumps(plan, sort_keys=True, indent=4))
@@ -0,0 +1,109 @@
+'''ISO 19139 and JSON output of the metadata writers
+
+Run from the repository root with: python -m unittest discover -s tests
+'''
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+import metadata_writers
+from metadata_writers import GMD, GCO
+from xml_backend import ET
+
+
+FIELDS = {
+    'title': 'PLSS Points GCDB',
+    'origin': 'AGRC',
+    'pubdate': '20170315',
+    'abstract': 'Public land survey corners.',
+    'purpose': 'Cadastral reference.',
+    'progress': 'Complete',
+    'update': 'As needed',
+    'useconst': 'None',
+    'accconst': 'None',
+    'cntper': 'Sean Fernandez',
+    'cntorg': 'AGRC',
+    'cntvoice': '801-538-3665',
+    'address': '1 State Office Building',
+    'city': 'Salt Lake City',
+    'state': 'Utah',
+    'postal': '84114',
+    'westbc': '-114.05',
+    'eastbc': '-109.04',
+    'southbc': '36.99',
+    'northbc': '42.00',
+    'caldate': '201703',
+    'keywords': ['cadastre', 'plss'],
+    'placekeys': ['Utah'],
+    'resources': [('Shapefile', 'ftp://ftp.agrc.utah.gov/PLSSPoint_GCDB.zip')]
+}
+
+
+class Translator(object):
+
+    def __init__(self, directory):
+        self.output_xml = os.path.join(directory, 'SGID10.CADASTRE.PLSSPoint_GCDB.xml')
+        self.sgid_xml = 'SGID10.CADASTRE.PLSSPoint_GCDB.xml'
+
+
+def gmd(path):
+    return '/'.join('{{{}}}{}'.format(GCO if step.startswith('gco:') else GMD, step.split(':')[1])
+                    for step in path.split('/'))
+
+
+class WriterOutputTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.translator = Translator(self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_iso_identification_has_mandatory_elements(self):
+        writer = metadata_writers.IsoWriter(os.path.join(self.directory, 'iso'))
+        path = writer.write(self.translator, FIELDS)
+        self.assertEqual(path, os.path.join(self.directory, 'iso', 'SGID10.CADASTRE.PLSSPoint_GCDB.xml'))
+        root = ET.parse(path).getroot()
+
+        self.assertEqual(root.tag, gmd('gmd:MD_Metadata'))
+        self.assertEqual(root.find(gmd('gmd:characterSet/gmd:MD_CharacterSetCode')).get('codeListValue'), 'utf8')
+        identification = root.find(gmd('gmd:identificationInfo/gmd:MD_DataIdentification'))
+        self.assertEqual(identification.find(gmd('gmd:citation/gmd:CI_Citation/gmd:title/gco:CharacterString')).text,
+                         'PLSS Points GCDB')
+        self.assertEqual(identification.find(gmd('gmd:topicCategory/gmd:MD_TopicCategoryCode')).text,
+                         'planningCadastre')
+        self.assertEqual(identification.find(gmd('gmd:characterSet/gmd:MD_CharacterSetCode')).get('codeListValue'),
+                         'utf8')
+        self.assertEqual(identification.find(gmd('gmd:status/gmd:MD_ProgressCode')).get('codeListValue'),
+                         'completed')
+        # topicCategory follows language and characterSet and precedes extent in the schema order
+        tags = [child.tag for child in identification]
+        self.assertLess(tags.index(gmd('gmd:language')), tags.index(gmd('gmd:characterSet')))
+        self.assertLess(tags.index(gmd('gmd:characterSet')), tags.index(gmd('gmd:topicCategory')))
+        self.assertLess(tags.index(gmd('gmd:topicCategory')), tags.index(gmd('gmd:extent')))
+
+    def test_topic_category_falls_back_for_unknown_names(self):
+        self.assertEqual(metadata_writers.topic_category('SGID10.WATER.Lakes'), 'inlandWaters')
+        self.assertEqual(metadata_writers.topic_category('Lakes'), metadata_writers.DEFAULT_TOPIC_CATEGORY)
+
+    def test_json_summary(self):
+        writer = metadata_writers.JsonWriter(os.path.join(self.directory, 'json'))
+        path = writer.write(self.translator, FIELDS)
+        with open(path, 'r') as json_file:
+            summary = json.load(json_file)
+        self.assertEqual(summary['name'], 'SGID10.CADASTRE.PLSSPoint_GCDB')
+        self.assertEqual(summary['source'], 'SGID10.CADASTRE.PLSSPoint_GCDB.xml')
+        self.assertEqual(summary['title'], 'PLSS Points GCDB')
+        self.assertEqual(summary['keywords'], ['cadastre', 'plss'])
+        self.assertEqual(summary['resources'], [{'formname': 'Shapefile',
+                                                 'url': 'ftp://ftp.agrc.utah.gov/PLSSPoint_GCDB.zip'}])
+
+
+if __name__ == '__main__':
+    unittest.main()
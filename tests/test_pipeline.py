@@ -0,0 +1,66 @@
+'''Pipeline work items share no xml, so each layer is imported and published once
+
+Run from the repository root with: python -m unittest discover -s tests
+'''
+import os
+import sys
+import unittest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+import pipeline
+
+
+def xml(name):
+    return os.path.join('data', 'outputs', name + '.xml')
+
+
+class LinkedStore(object):
+    '''Text store holding only the layers linked to each shared canonical doc'''
+
+    def __init__(self, links):
+        self.links = links
+
+    def linked_xml_names(self, doc_id):
+        return [name + '.xml' for name in self.links.get(doc_id, [])]
+
+
+def layer(name, *doc_ids):
+    work = pipeline.LayerWork(xml(name))
+    work.docs.extend({'id': doc_id} for doc_id in doc_ids)
+    return work
+
+
+class MergeOverlappingLayersTest(unittest.TestCase):
+
+    def test_linked_xml_of_one_item_joins_the_item_that_owns_it(self):
+        store = LinkedStore({'shared': ['Lakes', 'Streams']})
+        layers = [layer('Lakes', 'shared'), layer('Streams', 'streams-purpose'), layer('Springs', 'springs')]
+        merged = pipeline.merge_overlapping_layers(layers, store)
+
+        self.assertEqual([work.xml_path for work in merged], [xml('Lakes'), xml('Springs')])
+        self.assertEqual(merged[0].linked, [xml('Streams')])
+        self.assertEqual([doc['id'] for doc in merged[0].docs], ['shared', 'streams-purpose'])
+
+    def test_items_sharing_only_linked_xml_merge_transitively(self):
+        store = LinkedStore({'shared-1': ['Lakes', 'Ponds'], 'shared-2': ['Streams', 'Canals'],
+                             'shared-3': ['Springs', 'Ponds', 'Canals']})
+        layers = [layer('Lakes', 'shared-1'), layer('Streams', 'shared-2'), layer('Springs', 'shared-3')]
+        merged = pipeline.merge_overlapping_layers(layers, store)
+
+        self.assertEqual(len(merged), 1)
+        paths = [merged[0].xml_path] + merged[0].linked
+        self.assertEqual(sorted(paths), sorted(xml(name) for name in ('Lakes', 'Ponds', 'Streams', 'Canals',
+                                                                      'Springs')))
+        self.assertEqual(len(paths), len(set(paths)))
+        self.assertEqual(sorted(doc['id'] for doc in merged[0].docs), ['shared-1', 'shared-2', 'shared-3'])
+
+    def test_category_layer_without_docs_joins_an_item_linking_it(self):
+        store = LinkedStore({'shared': ['Lakes', 'Streams']})
+        merged = pipeline.merge_overlapping_layers([layer('Lakes', 'shared'), layer('Streams')], store)
+        self.assertEqual(len(merged), 1)
+        self.assertEqual(merged[0].linked, [xml('Streams')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+'''Startup budget of the local-only metadata_conversion commands
+
+Run from the repository root with: python -m unittest discover -s tests
+'''
+import os
+import sys
+import json
+import shutil
+import tempfile
+import unittest
+import subprocess
+from timeit import default_timer
+
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BUDGET_SECONDS = 0.2
+HEAVY_MODULES = ('drive_loader', 'gspread', 'arcpy')
+# Runs the script as __main__ and prints which heavy modules it loaded
+RUN_SCRIPT = '''
+import sys, json, runpy
+sys.path.insert(0, {repo!r})
+sys.argv = [{script!r}] + {args!r}
+try:
+    runpy.run_path({script!r}, run_name='__main__')
+except SystemExit:
+    pass
+sys.stderr.write(json.dumps([name for name in {heavy!r} if name in sys.modules]))
+'''
+
+
+class StartupTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.directory, 'data', 'outputs', 'temp'))
+        shutil.copy(os.path.join(REPO, 'templates', 'GISI-metadata-empty-machine.xml'),
+                    os.path.join(self.directory, 'data', 'outputs', 'SGID10.WATER.Lakes.xml'))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def run_command(self, args):
+        '''Seconds taken by the command and the heavy modules it loaded'''
+        script = os.path.join(REPO, 'metadata_conversion.py')
+        code = RUN_SCRIPT.format(repo=REPO, script=script, args=args, heavy=HEAVY_MODULES)
+        start = default_timer()
+        process = subprocess.Popen([sys.executable, '-c', code], cwd=self.directory,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = process.communicate()
+        seconds = default_timer() - start
+        self.assertEqual(process.returncode, 0, err)
+        return seconds, json.loads(err.splitlines()[-1])
+
+    def assert_light(self, args):
+        # The best of three runs, so one slow start on a busy machine does not fail the test
+        runs = [self.run_command(args) for i in range(3)]
+        self.assertEqual(runs[0][1], [])
+        self.assertLess(min(seconds for seconds, loaded in runs), BUDGET_SECONDS)
+
+    def test_help(self):
+        self.assert_light(['--help'])
+
+    def test_audit(self):
+        self.assert_light(['--audit'])
+        with open(os.path.join(self.directory, 'data', 'outputs', 'temp', 'empties.json')) as json_file:
+            self.assertIn('empties', json.load(json_file))
+
+
+if __name__ == '__main__':
+    unittest.main()
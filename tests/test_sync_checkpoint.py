@@ -0,0 +1,100 @@
+'''A sync run's checkpoint is the time its listing started
+
+Run from the repository root with: python -m unittest discover -s tests
+'''
+import os
+import sys
+import types
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+import sync_journal
+import metadata_conversion
+
+
+LAYER_XML = '<metadata><idinfo><descript><abstract>{}</abstract></descript></idinfo></metadata>'
+
+
+def drive_time():
+    return datetime.utcnow().isoformat()[:23] + 'Z'
+
+
+class EditDuringRunTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.directory, 'data', 'outputs', 'temp'))
+        os.chdir(self.directory)
+        for name in ('SGID10.WATER.Lakes', 'SGID10.WATER.Streams'):
+            with open(os.path.join('data', 'outputs', name + '.xml'), 'w') as f_out:
+                f_out.write(LAYER_XML.format('Old'))
+        self.docs = {
+            'doc-a': {'id': 'doc-a', 'name': 'Lakes_abstract', 'modifiedTime': '2017-01-10T00:00:00.000Z',
+                      'parents': ['all'], 'properties': {'metaSrcName': 'SGID10.WATER.Lakes.xml'}},
+            'doc-b': {'id': 'doc-b', 'name': 'Streams_abstract', 'modifiedTime': '2017-01-10T00:00:00.000Z',
+                      'parents': ['all'], 'properties': {'metaSrcName': 'SGID10.WATER.Streams.xml'}}}
+        self.fetched = []
+        self.edit_during_fetch = None
+        self.drive_loader = sys.modules.get('drive_loader')
+        module = types.ModuleType('drive_loader')
+        module.iter_files_updated_after_in_directory = lambda date, parent_id, service=None: [
+            dict(doc) for doc in self.docs.values() if doc['modifiedTime'] > date]
+        module.get_doc_as_string = self.get_doc_as_string
+        module.set_property = self.set_property
+        sys.modules['drive_loader'] = module
+
+    def tearDown(self):
+        if self.drive_loader is None:
+            del sys.modules['drive_loader']
+        else:
+            sys.modules['drive_loader'] = self.drive_loader
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def get_doc_as_string(self, file_id, service=None):
+        self.fetched.append(file_id)
+        if self.edit_during_fetch:
+            # An editor saves the other doc after the listing, while this run is still going
+            self.docs[self.edit_during_fetch]['modifiedTime'] = drive_time()
+            self.edit_during_fetch = None
+        return 'Text of ' + file_id
+
+    def set_property(self, file_id, properties, service=None, fields=None):
+        self.docs[file_id]['modifiedTime'] = drive_time()
+        return {'name': file_id, 'modifiedTime': self.docs[file_id]['modifiedTime']}
+
+    def last_update(self):
+        journal = sync_journal.SyncJournal()
+        journal.close()
+        return journal.last_update
+
+    def test_own_marks_are_not_synced_again(self):
+        started = datetime.utcnow().isoformat()
+        metadata_conversion.check_files_and_update('2017-01-01T00:00:00', parent_folder='all')
+        self.assertEqual(sorted(self.fetched), ['doc-a', 'doc-b'])
+        # The checkpoint precedes the marks, which the next run lists but skips
+        self.assertLessEqual(started, self.last_update())
+        self.assertTrue(all(doc['modifiedTime'] > self.last_update() for doc in self.docs.values()))
+
+        del self.fetched[:]
+        self.assertEqual(metadata_conversion.check_files_and_update(self.last_update(), parent_folder='all'), [])
+        self.assertEqual(self.fetched, [])
+
+    def test_doc_edited_during_a_run_is_synced_by_the_next(self):
+        self.docs['doc-b']['modifiedTime'] = '2016-12-01T00:00:00.000Z'
+        self.edit_during_fetch = 'doc-b'
+        metadata_conversion.check_files_and_update('2017-01-01T00:00:00', parent_folder='all')
+        self.assertEqual(self.fetched, ['doc-a'])
+
+        del self.fetched[:]
+        metadata_conversion.check_files_and_update(self.last_update(), parent_folder='all')
+        self.assertEqual(self.fetched, ['doc-b'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,127 @@
+'''The daemon's notification endpoint, driven by --notify as Drive would, and its sync pass
+
+Run from the repository root with: python -m unittest discover -s tests
+'''
+import os
+import sys
+import types
+import shutil
+import tempfile
+import unittest
+import threading
+import subprocess
+import BaseHTTPServer
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+import sync_daemon
+import category_docs
+from xml_backend import ET
+
+
+class NotifyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.directory, 'data', 'outputs', 'temp'))
+        os.chdir(self.directory)
+        self.daemon = sync_daemon.SyncDaemon(port=0)
+        self.daemon.channel = {'id': 'channel-1', 'resourceId': 'resource-1', 'expiration': 0}
+        self.server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), sync_daemon.NotificationHandler)
+        self.server.sync_daemon = self.daemon
+        listener = threading.Thread(target=self.server.serve_forever)
+        listener.daemon = True
+        listener.start()
+        self.url = 'http://127.0.0.1:{}/'.format(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def test_change_wakes_daemon(self):
+        self.assertEqual(sync_daemon.send_fake_notification(self.url, 'channel-1'), 200)
+        self.assertTrue(self.daemon.wake.is_set())
+
+    def test_other_channel_ignored(self):
+        self.assertEqual(sync_daemon.send_fake_notification(self.url, 'channel-2'), 200)
+        self.assertFalse(self.daemon.wake.is_set())
+
+    def test_sync_message_ignored(self):
+        sync_daemon.send_fake_notification(self.url, 'channel-1', resource_state='sync')
+        self.assertFalse(self.daemon.wake.is_set())
+
+    def test_notify_command(self):
+        output = subprocess.check_output([sys.executable, os.path.join(REPO, 'sync_daemon.py'),
+                                          '--notify', self.url, '--channel', 'channel-1'], cwd=REPO)
+        self.assertEqual(output.strip(), '200')
+        self.assertTrue(self.daemon.wake.is_set())
+
+
+LAYER_XML = '<metadata><idinfo><descript><abstract>{}</abstract></descript></idinfo></metadata>'
+
+
+class RunOnceTest(unittest.TestCase):
+    '''One pass over Drive changes that include a category doc, with drive_loader faked'''
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.directory, 'data', 'outputs', 'temp'))
+        os.chdir(self.directory)
+        for name in ('SGID10.WATER.Lakes', 'SGID10.WATER.Streams', 'SGID10.WATER.Springs'):
+            with open(os.path.join('data', 'outputs', name + '.xml'), 'w') as f_out:
+                f_out.write(LAYER_XML.format('Old'))
+        self.changes = [
+            {'fileId': 'category-doc',
+             'file': {'id': 'category-doc', 'name': 'WATER_metadata', 'modifiedTime': '2017-02-01T00:00:00.000Z',
+                      'parents': ['all'], 'properties': {category_docs.CATEGORY_DOC_PROPERTY: 'WATER'}}},
+            {'fileId': 'layer-doc',
+             'file': {'id': 'layer-doc', 'name': 'Springs_abstract', 'modifiedTime': '2017-02-01T00:00:00.000Z',
+                      'parents': ['all'], 'properties': {'metaSrcName': 'SGID10.WATER.Springs.xml'}}}]
+        self.texts = {
+            'category-doc': category_docs.build_doc_text([('SGID10.WATER.Lakes.xml', 'abstract', 'Lakes text'),
+                                                          ('SGID10.WATER.Streams.xml', 'abstract', 'Streams text')]),
+            'layer-doc': 'Springs text'}
+        self.drive_loader = sys.modules.get('drive_loader')
+        module = types.ModuleType('drive_loader')
+        module.get_changes = lambda page_token, service=None: (self.changes, 'token-2')
+        module.get_doc_as_string = lambda file_id, service=None: self.texts[file_id]
+        module.set_property = lambda file_id, properties, service=None, fields=None: {
+            'name': file_id, 'modifiedTime': '2017-02-01T00:00:01.000Z'}
+        sys.modules['drive_loader'] = module
+        self.daemon = sync_daemon.SyncDaemon(parent_folder='all')
+        self.daemon.page_token = 'token-1'
+
+    def tearDown(self):
+        self.daemon.journal.close()
+        if self.drive_loader is None:
+            del sys.modules['drive_loader']
+        else:
+            sys.modules['drive_loader'] = self.drive_loader
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def abstract(self, name):
+        return ET.parse(os.path.join('data', 'outputs', name + '.xml')).getroot().find('idinfo/descript/abstract').text
+
+    def test_category_doc_change_is_applied_and_token_advances(self):
+        touched = self.daemon.run_once()
+        self.assertEqual(touched, set(os.path.join('data', 'outputs', name + '.xml')
+                                      for name in ('SGID10.WATER.Lakes', 'SGID10.WATER.Streams',
+                                                   'SGID10.WATER.Springs')))
+        self.assertEqual(self.abstract('SGID10.WATER.Lakes'), 'Lakes text')
+        self.assertEqual(self.abstract('SGID10.WATER.Streams'), 'Streams text')
+        self.assertEqual(self.abstract('SGID10.WATER.Springs'), 'Springs text')
+        self.assertEqual(self.daemon.page_token, 'token-2')
+
+        # The change from our own mark is skipped on the next pass
+        for change in self.changes:
+            change['file']['modifiedTime'] = '2017-02-01T00:00:01.000Z'
+        self.assertEqual(self.daemon.run_once(), set())
+
+
+if __name__ == '__main__':
+    unittest.main()
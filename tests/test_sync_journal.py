@@ -0,0 +1,104 @@
+'''Sync journal checkpoints per layer folder and resumed category docs
+
+Run from the repository root with: python -m unittest discover -s tests
+'''
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+import sync_journal
+import metadata_conversion
+
+
+class FolderCheckpointTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal_path = os.path.join(self.directory, 'sync_journal.log')
+        self.checkpoint_path = os.path.join(self.directory, 'sync_checkpoint.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def open_journal(self):
+        return sync_journal.SyncJournal(self.journal_path, self.checkpoint_path)
+
+    def test_limited_run_advances_only_its_folders(self):
+        journal = self.open_journal()
+        journal.end_run('2017-01-01T00:00:00')
+        journal.end_run('2017-02-01T00:00:00', ['folder-a'])
+        journal.close()
+
+        journal = self.open_journal()
+        self.assertEqual(journal.last_update, '2017-01-01T00:00:00')
+        self.assertEqual(journal.last_update_for(['folder-a']), '2017-02-01T00:00:00')
+        self.assertEqual(journal.last_update_for(['folder-a', 'folder-b']), '2017-01-01T00:00:00')
+        self.assertEqual(journal.last_update_for(), '2017-01-01T00:00:00')
+
+        synced = {'id': 'doc-1', 'parents': ['folder-a'], 'modifiedTime': '2017-01-15T00:00:00.000Z'}
+        edited = {'id': 'doc-2', 'parents': ['folder-a'], 'modifiedTime': '2017-02-15T00:00:00.000Z'}
+        other = {'id': 'doc-3', 'parents': ['folder-b'], 'modifiedTime': '2017-01-15T00:00:00.000Z'}
+        self.assertTrue(journal.is_synced(synced, frozenset(['folder-a', 'folder-b'])))
+        self.assertFalse(journal.is_synced(edited, frozenset(['folder-a', 'folder-b'])))
+        self.assertFalse(journal.is_synced(other, frozenset(['folder-a', 'folder-b'])))
+        journal.close()
+
+    def test_full_run_supersedes_older_folder_times(self):
+        journal = self.open_journal()
+        journal.record(sync_journal.MARKED, {'id': 'doc-1', 'modifiedTime': '2017-01-15T00:00:00.000Z'})
+        journal.end_run('2017-02-01T00:00:00', ['folder-a'])
+        self.assertEqual(journal.state({'id': 'doc-1', 'modifiedTime': '2017-01-15T00:00:00.000Z'}),
+                         sync_journal.MARKED)
+        journal.end_run('2017-03-01T00:00:00')
+        journal.close()
+
+        journal = self.open_journal()
+        self.assertEqual(journal.folder_updates, {})
+        self.assertEqual(journal.last_update_for(['folder-a']), '2017-03-01T00:00:00')
+        journal.close()
+
+
+class CategoryResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.journal = sync_journal.SyncJournal(os.path.join(self.directory, 'sync_journal.log'),
+                                                os.path.join(self.directory, 'sync_checkpoint.json'))
+        self.marked = []
+        self.mark_updated = metadata_conversion.mark_updated
+        metadata_conversion.mark_updated = lambda file_id, update_time, service=None: (
+            self.marked.append(file_id) or {'modifiedTime': '2017-02-01T00:00:01.000Z'})
+        self.doc = {'id': 'category-doc', 'modifiedTime': '2017-02-01T00:00:00.000Z'}
+        self.paths = ['data/outputs/SGID10.WATER.Lakes.xml', 'data/outputs/SGID10.WATER.Streams.xml']
+
+    def tearDown(self):
+        metadata_conversion.mark_updated = self.mark_updated
+        self.journal.close()
+        shutil.rmtree(self.directory)
+
+    def test_applied_doc_returns_its_paths_when_marked_on_resume(self):
+        self.journal.record(sync_journal.APPLIED, self.doc, self.paths)
+        xml_paths, applied = metadata_conversion.apply_category_doc(self.doc, '2017-02-01T00:00:00', None,
+                                                                    journal=self.journal)
+        self.assertEqual(xml_paths, self.paths)
+        self.assertEqual(applied, '2017-02-01T00:00:01.000Z')
+        self.assertEqual(self.marked, ['category-doc'])
+
+    def test_marked_doc_returns_its_paths(self):
+        self.journal.record(sync_journal.MARKED, self.doc, self.paths, '2017-02-01T00:00:01.000Z')
+        self.journal.compact()
+        journal = sync_journal.SyncJournal(self.journal.journal_path, self.journal.checkpoint_path)
+        xml_paths, applied = metadata_conversion.apply_category_doc(self.doc, '2017-02-01T00:00:00', None,
+                                                                    journal=journal)
+        journal.close()
+        self.assertEqual(xml_paths, self.paths)
+        self.assertIsNone(applied)
+        self.assertEqual(self.marked, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+'''Comment triage retries replies that failed on an earlier run
+
+Run from the repository root with: python -m unittest discover -s tests
+'''
+import os
+import sys
+import types
+import shutil
+import tempfile
+import unittest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+import metadata_conversion
+
+
+class FakeDrive(object):
+    '''Stands in for drive_loader: one doc with a #completed comment, replies failing while fail is set'''
+
+    def __init__(self):
+        self.fail = True
+        self.listed = [{'id': 'doc-1', 'name': 'Lakes_abstract'}]
+        self.replied = []
+
+    def module(self):
+        module = types.ModuleType('drive_loader')
+        module.batch_set_properties = lambda file_ids, property_dict, service=None: []
+        module.iter_files_updated_after_in_directory = lambda date, parent_id, service=None: list(self.listed)
+        module.get_file_comments = lambda file_id, start_modified_time=None: [
+            {'id': 'comment-1', 'content': '#completed'}]
+        module.batch_comment_replies = self.batch_comment_replies
+        return module
+
+    def batch_comment_replies(self, replies, message, property_dict=None, service=None):
+        if self.fail:
+            return list(replies), []
+        self.replied.extend(replies)
+        return [], []
+
+
+class TriageRetryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.directory, 'comment_cache.json')
+        self.drive = FakeDrive()
+        self.drive_loader = sys.modules.get('drive_loader')
+        sys.modules['drive_loader'] = self.drive.module()
+
+    def tearDown(self):
+        if self.drive_loader is None:
+            del sys.modules['drive_loader']
+        else:
+            sys.modules['drive_loader'] = self.drive_loader
+        shutil.rmtree(self.directory)
+
+    def test_failed_reply_is_retried_when_the_doc_is_not_listed_again(self):
+        self.assertEqual(metadata_conversion.triage_comments(cache_path=self.cache_path), [])
+
+        # The doc is unchanged since the last triage, so the listing no longer returns it
+        self.drive.listed = []
+        self.drive.fail = False
+        self.assertEqual(metadata_conversion.triage_comments(cache_path=self.cache_path),
+                         [('doc-1', 'comment-1')])
+        self.assertEqual(self.drive.replied, [('doc-1', 'comment-1')])
+
+        # Replied once; nothing is left to retry
+        self.assertEqual(metadata_conversion.triage_comments(cache_path=self.cache_path), [])
+        self.assertEqual(self.drive.replied, [('doc-1', 'comment-1')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+'''The WAF bundle and its harvest index keep the whole catalogue across incremental runs
+
+Run from the repository root with: python -m unittest discover -s tests
+'''
+import os
+import sys
+import shutil
+import zipfile
+import tempfile
+import unittest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+import waf_bundle
+
+
+class IncrementalPublishTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.outputs = os.path.join(self.directory, 'outputs')
+        self.staging = os.path.join(self.outputs, 'waf_bundle')
+        self.waf = os.path.join(self.directory, 'waf')
+        os.makedirs(self.outputs)
+        os.makedirs(self.waf)
+        for name in ('SGID10.WATER.Lakes', 'SGID10.WATER.Streams', 'SGID10.WATER.Springs'):
+            self.write(name, 'Old')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, text):
+        path = os.path.join(self.outputs, name + '.xml')
+        with open(path, 'w') as f_out:
+            f_out.write('<metadata><abstract>{}</abstract></metadata>'.format(text))
+        return path
+
+    def publish(self, xml_files, full=False):
+        return waf_bundle.publish_bundle(self.waf, xml_files, ['SGID10.WATER.Springs.xml'], self.staging,
+                                         full=full, catalogue_directory=self.outputs)
+
+    def published(self):
+        index = waf_bundle.load_index(os.path.join(self.waf, waf_bundle.INDEX_NAME))
+        with zipfile.ZipFile(os.path.join(self.waf, waf_bundle.BUNDLE_NAME), 'r') as bundle:
+            self.assertEqual(sorted(bundle.namelist()), sorted(index))
+        return index
+
+    def test_incremental_run_keeps_earlier_entries(self):
+        lakes = os.path.join(self.outputs, 'SGID10.WATER.Lakes.xml')
+        # The first run seeds the bundle from the catalogue, less the excluded layers
+        self.assertEqual(self.publish([lakes]), ['SGID10.WATER.Lakes.xml', 'SGID10.WATER.Streams.xml'])
+        first = self.published()
+        self.assertEqual(sorted(first), ['SGID10.WATER.Lakes.xml', 'SGID10.WATER.Streams.xml'])
+
+        streams = self.write('SGID10.WATER.Streams', 'New')
+        self.assertEqual(self.publish([streams]), ['SGID10.WATER.Streams.xml'])
+        second = self.published()
+        self.assertEqual(sorted(second), ['SGID10.WATER.Lakes.xml', 'SGID10.WATER.Streams.xml'])
+        self.assertEqual(second['SGID10.WATER.Lakes.xml'], first['SGID10.WATER.Lakes.xml'])
+        self.assertNotEqual(second['SGID10.WATER.Streams.xml']['sha1'], first['SGID10.WATER.Streams.xml']['sha1'])
+
+    def test_full_rebuild_drops_layers_gone_from_the_catalogue(self):
+        self.publish([])
+        os.remove(os.path.join(self.outputs, 'SGID10.WATER.Streams.xml'))
+        self.publish([], full=True)
+        self.assertEqual(sorted(self.published()), ['SGID10.WATER.Lakes.xml'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+'''Queued tasks advance only the sync checkpoints of their own folders
+
+Run from the repository root with: python -m unittest discover -s tests
+'''
+import os
+import sys
+import types
+import shutil
+import tempfile
+import unittest
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+import sync_journal
+import work_queue
+from xml_backend import ET
+
+
+LAYER_XML = '<metadata><idinfo><descript><abstract>{}</abstract></descript></idinfo></metadata>'
+LAST_UPDATE = '2017-01-01T00:00:00'
+
+
+class OutOfOrderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.directory = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.directory, 'data', 'outputs', 'temp'))
+        os.chdir(self.directory)
+        for name in ('SGID10.WATER.Lakes', 'SGID10.WATER.Streams'):
+            with open(os.path.join('data', 'outputs', name + '.xml'), 'w') as f_out:
+                f_out.write(LAYER_XML.format('Old'))
+        journal = sync_journal.SyncJournal()
+        journal.end_run(LAST_UPDATE)
+        journal.close()
+
+        self.docs = [
+            {'id': 'doc-a', 'name': 'Lakes_abstract', 'modifiedTime': '2017-01-10T00:00:00.000Z',
+             'parents': ['folder-a'], 'properties': {'metaSrcName': 'SGID10.WATER.Lakes.xml'}},
+            {'id': 'doc-b', 'name': 'Streams_abstract', 'modifiedTime': '2017-01-10T00:00:00.000Z',
+             'parents': ['folder-b'], 'properties': {'metaSrcName': 'SGID10.WATER.Streams.xml'}}]
+        self.drive_loader = sys.modules.get('drive_loader')
+        module = types.ModuleType('drive_loader')
+        module.iter_files_updated_after_in_directory = lambda date, parent_id, service=None: [
+            dict(doc) for doc in self.docs if parent_id in doc['parents'] and doc['modifiedTime'] > date]
+        module.get_doc_as_string = lambda file_id, service=None: 'Text of ' + file_id
+        module.set_property = lambda file_id, properties, service=None, fields=None: {
+            'name': file_id, 'modifiedTime': '2017-01-20T00:00:00.000Z'}
+        sys.modules['drive_loader'] = module
+        self.db_path = os.path.join(self.directory, 'queue.sqlite')
+
+    def tearDown(self):
+        if self.drive_loader is None:
+            del sys.modules['drive_loader']
+        else:
+            sys.modules['drive_loader'] = self.drive_loader
+        os.chdir(self.cwd)
+        shutil.rmtree(self.directory)
+
+    def abstract(self, name):
+        return ET.parse(os.path.join('data', 'outputs', name + '.xml')).getroot().find('idinfo/descript/abstract').text
+
+    def test_later_task_does_not_advance_the_folders_of_an_earlier_one(self):
+        queue = work_queue.WorkQueue(self.db_path)
+        queue.set_setting('past_update_time', LAST_UPDATE)
+        queue.enqueue(work_queue.FOLDER, ['folder-a', 'folder-b'])
+        # Another host holds folder-a and finishes it after this host finishes folder-b
+        self.assertEqual(queue.claim('host-2'), ('folder-a', work_queue.FOLDER))
+        queue.close()
+
+        self.assertEqual(work_queue.run_worker(self.db_path, 'host-1'), 1)
+        self.assertEqual(self.abstract('SGID10.WATER.Streams'), 'Text of doc-b')
+        journal = sync_journal.SyncJournal()
+        self.assertEqual(journal.last_update, LAST_UPDATE)
+        self.assertEqual(sorted(journal.folder_updates), ['folder-b'])
+        self.assertEqual(journal.last_update_for(['folder-a']), LAST_UPDATE)
+        journal.close()
+
+        work_queue.process_task('folder-a', work_queue.FOLDER, LAST_UPDATE, False)
+        self.assertEqual(self.abstract('SGID10.WATER.Lakes'), 'Text of doc-a')
+        journal = sync_journal.SyncJournal()
+        self.assertEqual(journal.last_update, LAST_UPDATE)
+        self.assertEqual(sorted(journal.folder_updates), ['folder-a', 'folder-b'])
+        journal.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
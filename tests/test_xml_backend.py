@@ -0,0 +1,93 @@
+'''Output of the lxml and stdlib XML backends is equivalent
+
+The backend is chosen at import, so each one runs in its own interpreter with
+METADATA_XML_BACKEND set. Outputs are compared in xml_backend.canonical form,
+which ignores indentation whitespace.
+'''
+import os
+import sys
+import json
+import unittest
+import subprocess
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+import xml_backend
+import export_benchmark
+
+try:
+    import lxml
+except ImportError:
+    lxml = None
+
+
+TEMPLATE = os.path.join(REPO, 'templates', 'GISI-metadata-template-STATE-2017.xml')
+# Pretty prints and writes the template with edited text, printing both outputs as JSON
+OUTPUT_SCRIPT = '''
+import sys, json, tempfile, os
+sys.path.insert(0, {repo!r})
+import xml_backend
+from xml_backend import ET
+tree = xml_backend.parse({template!r})
+for e in tree.getroot().iter('title'):
+    e.text = u'Lakes \\xe9 & <Reservoirs>'
+handle, path = tempfile.mkstemp(suffix='.xml')
+os.close(handle)
+xml_backend.write(tree, path)
+with open(path, 'rb') as f_in:
+    written = f_in.read().decode('utf-8')
+os.remove(path)
+pretty = xml_backend.pretty_string(tree.getroot())
+indented = xml_backend.tostring(xml_backend.pretty_element(ET.fromstring(xml_backend.tostring(tree.getroot()))))
+print(json.dumps({{'backend': xml_backend.BACKEND, 'pretty': pretty, 'written': written,
+                  'indented': indented.decode('utf-8')}}))
+'''
+
+
+def run_backend(backend):
+    env = dict(os.environ)
+    env['METADATA_XML_BACKEND'] = backend
+    output = subprocess.check_output([sys.executable, '-c', OUTPUT_SCRIPT.format(repo=REPO, template=TEMPLATE)],
+                                     env=env)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def canonical(text):
+    return xml_backend.canonical(xml_backend.fromstring(text.encode('utf-8')))
+
+
+@unittest.skipIf(lxml is None, 'lxml is not installed')
+class BackendEquivalenceTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.outputs = dict((backend, run_backend(backend)) for backend in ('lxml', 'stdlib'))
+
+    def test_backends_selected(self):
+        self.assertEqual(self.outputs['lxml']['backend'], 'lxml')
+        self.assertEqual(self.outputs['stdlib']['backend'], 'stdlib')
+
+    def test_pretty_string(self):
+        lxml_output, stdlib_output = self.outputs['lxml']['pretty'], self.outputs['stdlib']['pretty']
+        self.assertTrue(lxml_output.startswith(xml_backend.XML_DECLARATION))
+        self.assertTrue(stdlib_output.startswith(xml_backend.XML_DECLARATION))
+        self.assertEqual(canonical(lxml_output), canonical(stdlib_output))
+        self.assertIn(u'Lakes \xe9 &amp; &lt;Reservoirs&gt;', lxml_output)
+
+    def test_write(self):
+        self.assertEqual(canonical(self.outputs['lxml']['written']), canonical(self.outputs['stdlib']['written']))
+
+    def test_pretty_element(self):
+        self.assertEqual(canonical(self.outputs['lxml']['indented']), canonical(self.outputs['stdlib']['indented']))
+
+    def test_export_sizes(self):
+        '''The full translation of each synthetic size, parcels included, gives the same xml'''
+        for size_name in sorted(export_benchmark.SIZES):
+            lxml_result = export_benchmark.run_size_isolated(size_name, 'lxml')
+            stdlib_result = export_benchmark.run_size_isolated(size_name, 'stdlib')
+            self.assertEqual(lxml_result['backend'], 'lxml')
+            self.assertEqual(lxml_result['output_digest'], stdlib_result['output_digest'], size_name)
+
+
+if __name__ == '__main__':
+    unittest.main()
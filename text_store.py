@@ -0,0 +1,98 @@
+'''Content-addressed store of element text
+
+Texts are keyed by the sha1 of their whitespace-normalised body. During a run
+each doc version is downloaded once, however many times it is listed, and
+identical texts are held once. The registry, saved between runs, maps each
+element text to one canonical doc, so an upload can link a layer to the
+canonical doc instead of creating a duplicate. A canonical doc then edits
+every layer linked to it.
+'''
+import os
+import json
+import hashlib
+import threading
+from time import strftime
+import instrumentation
+
+
+TEXT_STORE = 'data/outputs/temp/text_store.json'
+
+
+def text_key(text):
+    normalised = ' '.join((text or '').split())
+    if isinstance(normalised, unicode):
+        normalised = normalised.encode('utf-8')
+    return hashlib.sha1(normalised).hexdigest()
+
+
+class TextStore(object):
+
+    def __init__(self, json_path=TEXT_STORE):
+        self.json_path = json_path
+        # element name -> {text key: canonical doc id}
+        self.canonical = {}
+        # canonical doc id -> output xml names of every layer it edits
+        self.links = {}
+        # per run caches: (doc id, modifiedTime) -> text key, text key -> text
+        self._doc_keys = {}
+        self._texts = {}
+        self._lock = threading.Lock()
+        if os.path.exists(json_path):
+            with open(json_path, 'r') as json_file:
+                registry = json.load(json_file)
+            self.canonical = registry.get('canonical', {})
+            self.links = registry.get('links', {})
+
+    def get_text(self, drive_file, fetch):
+        '''Text of this doc version, calling fetch(file_id) only the first time it is seen'''
+        doc_version = (drive_file['id'], drive_file.get('modifiedTime'))
+        with self._lock:
+            key = self._doc_keys.get(doc_version)
+            if key is not None:
+                instrumentation.count('text_store.doc_hits')
+                return self._texts[key]
+        text = fetch(drive_file['id'])
+        key = text_key(text)
+        with self._lock:
+            if key in self._texts:
+                instrumentation.count('text_store.text_hits')
+            else:
+                self._texts[key] = text
+            self._doc_keys[doc_version] = key
+            return self._texts[key]
+
+    def canonical_doc(self, element_name, text):
+        return self.canonical.get(element_name, {}).get(text_key(text))
+
+    def add_canonical(self, element_name, text, doc_id, xml_name):
+        with self._lock:
+            self.canonical.setdefault(element_name, {})[text_key(text)] = doc_id
+            self.links[doc_id] = [xml_name]
+
+    def rekey(self, element_name, text, doc_id):
+        '''Point the registry at the edited text of a canonical doc'''
+        with self._lock:
+            texts = self.canonical.setdefault(element_name, {})
+            for key, canonical_id in texts.items():
+                if canonical_id == doc_id:
+                    del texts[key]
+            texts[text_key(text)] = doc_id
+
+    def link(self, doc_id, xml_name):
+        with self._lock:
+            names = self.links.setdefault(doc_id, [])
+            if xml_name not in names:
+                names.append(xml_name)
+
+    def linked_xml_names(self, doc_id):
+        return list(self.links.get(doc_id, []))
+
+    def save(self):
+        directory = os.path.dirname(self.json_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with self._lock:
+            content = json.dumps({'canonical': self.canonical, 'links': self.links,
+                                  'saved': strftime("%Y_%m_%d %H:%M:%S")}, sort_keys=True, indent=4)
+        with open(self.json_path, 'w') as f_out:
+            f_out.write(content)
@@ -0,0 +1,181 @@
+'''Publish GISI metadata to the WAF as one compressed bundle with a harvest index
+
+The bundle is kept in a local staging directory and updated incrementally:
+members whose content hash is unchanged are left alone, new members are
+appended and changed members replaced. Each publish then copies just the
+bundle and its index to the WAF. A new bundle is seeded from every output xml,
+so the harvest index always lists the whole catalogue and not only the layers
+changed since the bundle was started.
+
+The incremental update saves work on the local archive only. Whenever any
+member changes, the whole archive is copied to the share. The share gets two
+file writes instead of one per layer, but the bytes copied are the
+compressed size of the whole catalogue, not only the changed layers.
+'''
+import os
+import shutil
+import hashlib
+import zipfile
+from collections import Counter
+from time import strftime, gmtime
+import instrumentation
+import xml_backend
+from xml_backend import ET
+
+
+STAGING_DIRECTORY = 'data/outputs/waf_bundle'
+OUTPUT_DIRECTORY = 'data/outputs'
+BUNDLE_NAME = 'SGID_GISI_metadata.zip'
+INDEX_NAME = 'SGID_GISI_metadata_index.xml'
+WAF_URL = 'ftp://ftp.agrc.utah.gov/UtahSGID_Vector/UTM12_NAD83/Metadata/'
+
+
+def file_sha1(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def catalogue_xml_files(directory=OUTPUT_DIRECTORY):
+    '''Every output xml, which a new bundle starts from'''
+    if not os.path.exists(directory):
+        return []
+    return sorted(os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.xml'))
+
+
+def load_index(index_path):
+    '''Return {member name: {'sha1', 'lastmod', 'size'}} from a bundle index'''
+    members = {}
+    if not os.path.exists(index_path):
+        return members
+    for member in xml_backend.parse(index_path).getroot().iter('member'):
+        members[member.find('name').text] = {'sha1': member.find('sha1').text,
+                                             'lastmod': member.find('lastmod').text,
+                                             'size': int(member.find('size').text)}
+    return members
+
+
+def write_index(index_path, members, bundle_url):
+    '''Write a sitemap style listing of every member with its hash and modification time'''
+    root = ET.Element('bundle')
+    root.set('href', bundle_url)
+    root.set('updated', strftime('%Y-%m-%dT%H:%M:%SZ', gmtime()))
+    for name in sorted(members):
+        member = ET.SubElement(root, 'member')
+        for field, value in (('name', name),
+                             ('sha1', members[name]['sha1']),
+                             ('lastmod', members[name]['lastmod']),
+                             ('size', str(members[name]['size']))):
+            ET.SubElement(member, field).text = value
+    xml_backend.write(ET.ElementTree(root), index_path)
+
+
+def reconcile(bundle_path, members):
+    '''Make members match the archive, returning True when the archive has duplicate entries
+
+    The index can be missing, or behind the archive after a crash between
+    updating one and writing the other. Members only in the archive are
+    indexed from its content, as are duplicated members. Index entries with
+    no member are dropped, so their files are added again.
+    '''
+    if not os.path.exists(bundle_path):
+        members.clear()
+        return False
+    with zipfile.ZipFile(bundle_path, 'r') as bundle:
+        names = [info.filename for info in bundle.infolist()]
+        duplicates = set(name for name, count in Counter(names).items() if count > 1)
+        for name in (set(names) - set(members)) | duplicates:
+            # getinfo and read return the last entry of a duplicated name
+            info = bundle.getinfo(name)
+            members[name] = {'sha1': hashlib.sha1(bundle.read(name)).hexdigest(),
+                             'lastmod': '{:04d}-{:02d}-{:02d}T{:02d}:{:02d}:{:02d}Z'.format(*info.date_time),
+                             'size': info.file_size}
+    for name in set(members) - set(names):
+        del members[name]
+    return bool(duplicates)
+
+
+def update_bundle(bundle_path, members, xml_files):
+    '''Add or replace changed xml_files in the bundle and members index
+
+    Returns the changed names and whether the archive was rewritten to repair
+    it; either means the bundle must be published again.
+    '''
+    repair = reconcile(bundle_path, members)
+    changed = {}
+    for path in xml_files:
+        name = os.path.basename(path)
+        sha1 = file_sha1(path)
+        if name not in members or members[name]['sha1'] != sha1:
+            changed[name] = (path, sha1)
+    if not changed and not repair:
+        return [], False
+
+    replaced = [name for name in changed if name in members]
+    if replaced or repair or not os.path.exists(bundle_path):
+        # Zip members cannot be replaced in place, so copy the unchanged ones into a new archive
+        temp_path = bundle_path + '.tmp'
+        with zipfile.ZipFile(temp_path, 'w', zipfile.ZIP_DEFLATED) as new_bundle:
+            if os.path.exists(bundle_path):
+                with zipfile.ZipFile(bundle_path, 'r') as old_bundle:
+                    for name in sorted(set(info.filename for info in old_bundle.infolist())):
+                        if name not in changed:
+                            new_bundle.writestr(old_bundle.getinfo(name), old_bundle.read(name))
+            for name, (path, sha1) in sorted(changed.items()):
+                new_bundle.write(path, name)
+        if os.path.exists(bundle_path):
+            os.remove(bundle_path)
+        os.rename(temp_path, bundle_path)
+    else:
+        with zipfile.ZipFile(bundle_path, 'a', zipfile.ZIP_DEFLATED) as bundle:
+            for name, (path, sha1) in sorted(changed.items()):
+                bundle.write(path, name)
+
+    for name, (path, sha1) in changed.items():
+        members[name] = {'sha1': sha1,
+                         'lastmod': strftime('%Y-%m-%dT%H:%M:%SZ', gmtime(os.path.getmtime(path))),
+                         'size': os.path.getsize(path)}
+    return sorted(changed), repair
+
+
+@instrumentation.timed('stage.waf_bundle')
+def publish_bundle(waf_path, xml_files, excluded_xmls, staging_directory=STAGING_DIRECTORY, waf_url=WAF_URL,
+                   full=False, catalogue_directory=OUTPUT_DIRECTORY):
+    '''Update the staged bundle with xml_files and copy bundle and index to the WAF
+
+    When no bundle is staged yet, every xml in catalogue_directory is added
+    too. With full, the staged bundle is dropped and rebuilt that way, which
+    also removes layers no longer in the catalogue. Returns the names of the
+    members that changed; nothing is copied when none did.
+    '''
+    if not os.path.exists(staging_directory):
+        os.makedirs(staging_directory)
+    bundle_path = os.path.join(staging_directory, BUNDLE_NAME)
+    index_path = os.path.join(staging_directory, INDEX_NAME)
+    if full:
+        for path in (bundle_path, index_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    xml_files = list(xml_files)
+    if not os.path.exists(bundle_path):
+        names = set(os.path.basename(xml) for xml in xml_files)
+        xml_files.extend(xml for xml in catalogue_xml_files(catalogue_directory)
+                         if os.path.basename(xml) not in names)
+    paths = [xml for xml in xml_files if os.path.basename(xml) not in excluded_xmls]
+    members = load_index(index_path)
+    changed, repaired = update_bundle(bundle_path, members, paths)
+    print 'Bundle members changed: {} of {}'.format(len(changed), len(members))
+    if repaired:
+        print 'Bundle rewritten to drop duplicate members'
+    if not changed and not repaired:
+        return changed
+
+    write_index(index_path, members, waf_url + BUNDLE_NAME)
+    for path in (bundle_path, index_path):
+        dst_path = os.path.join(waf_path, os.path.basename(path))
+        print dst_path
+        shutil.copy(path, dst_path)
+    return changed
@@ -0,0 +1,249 @@
+'''Shared SQLite work queue for splitting a catalogue refresh across hosts
+
+Tasks are categories or layer folders. A worker claims one under a
+time-limited lease, renews the lease while it works and records completion.
+A lease that runs out, because its host died or hung, is claimed again by the
+next worker, up to MAX_ATTEMPTS times, after which the task is failed. A
+worker that finds its lease taken over stops before importing or completing.
+Each task advances only the sync checkpoints of its own layer folders, so
+edits in folders other hosts still hold, or that were never queued, are not
+skipped by later runs.
+'''
+import os
+import socket
+import sqlite3
+import argparse
+import threading
+from time import time
+import metadata_conversion
+
+
+LEASE_SECONDS = 30 * 60
+MAX_ATTEMPTS = 3
+
+
+CATEGORY = 'category'
+FOLDER = 'folder'
+
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tasks (
+    key TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    owner TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    finished REAL,
+    error TEXT
+);
+CREATE TABLE IF NOT EXISTS settings (
+    name TEXT PRIMARY KEY,
+    value TEXT
+);
+'''
+
+
+class LeaseLost(Exception):
+    '''The task's lease ran out and may now be held by another worker'''
+
+
+def default_worker_id():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+class WorkQueue(object):
+
+    def __init__(self, db_path, lease_seconds=LEASE_SECONDS):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        # autocommit mode, transactions are opened explicitly where needed
+        self.connection = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+        self.connection.executescript(SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def set_setting(self, name, value):
+        self.connection.execute('INSERT OR REPLACE INTO settings (name, value) VALUES (?, ?)', (name, value))
+
+    def get_setting(self, name):
+        row = self.connection.execute('SELECT value FROM settings WHERE name = ?', (name,)).fetchone()
+        return row[0] if row else None
+
+    def enqueue(self, kind, keys, reset=False):
+        '''Add tasks, leaving existing ones alone unless reset is True'''
+        verb = 'INSERT OR REPLACE' if reset else 'INSERT OR IGNORE'
+        self.connection.executemany('{} INTO tasks (key, kind) VALUES (?, ?)'.format(verb),
+                                    [(key, kind) for key in keys])
+
+    def claim(self, worker_id):
+        '''Lease the next pending or abandoned task, returning (key, kind) or None'''
+        now = time()
+        cursor = self.connection.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            # Leases that ran out on the last attempt will not be claimed again
+            cursor.execute('''UPDATE tasks SET status = 'failed', lease_expires = NULL,
+                              error = COALESCE(error, 'lease expired on attempt ' || attempts)
+                              WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?''',
+                           (now, MAX_ATTEMPTS))
+            row = cursor.execute('''SELECT key, kind FROM tasks
+                                    WHERE attempts < ?
+                                      AND (status = 'pending' OR (status = 'leased' AND lease_expires < ?))
+                                    ORDER BY rowid LIMIT 1''', (MAX_ATTEMPTS, now)).fetchone()
+            if row is not None:
+                cursor.execute('''UPDATE tasks SET status = 'leased', owner = ?, lease_expires = ?,
+                                  attempts = attempts + 1 WHERE key = ?''',
+                               (worker_id, now + self.lease_seconds, row[0]))
+            cursor.execute('COMMIT')
+        except Exception:
+            cursor.execute('ROLLBACK')
+            raise
+        return tuple(row) if row else None
+
+    def renew(self, key, worker_id):
+        '''Extend a lease, returning False if the task is no longer ours'''
+        cursor = self.connection.execute('''UPDATE tasks SET lease_expires = ?
+                                            WHERE key = ? AND owner = ? AND status = 'leased' ''',
+                                         (time() + self.lease_seconds, key, worker_id))
+        return cursor.rowcount == 1
+
+    def complete(self, key, worker_id):
+        self.connection.execute('''UPDATE tasks SET status = 'done', finished = ?, error = NULL
+                                   WHERE key = ? AND owner = ?''', (time(), key, worker_id))
+
+    def fail(self, key, worker_id, error):
+        '''Release a task for retry, or mark it failed once it has used its attempts'''
+        self.connection.execute('''UPDATE tasks SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END,
+                                   error = ?, lease_expires = NULL WHERE key = ? AND owner = ?''',
+                                (MAX_ATTEMPTS, str(error), key, worker_id))
+
+    def counts(self):
+        rows = self.connection.execute('SELECT status, COUNT(*) FROM tasks GROUP BY status').fetchall()
+        return dict(rows)
+
+    def failures(self):
+        return self.connection.execute("SELECT key, error FROM tasks WHERE status = 'failed'").fetchall()
+
+
+class LeaseKeeper(object):
+    '''Renews a lease from a background thread while the task runs'''
+
+    def __init__(self, db_path, key, worker_id, lease_seconds):
+        self.db_path = db_path
+        self.key = key
+        self.worker_id = worker_id
+        self.interval = lease_seconds / 3.0
+        self.lease_seconds = lease_seconds
+        self.stopped = threading.Event()
+        self.lost = False
+        self.thread = threading.Thread(target=self._renew, name='lease-' + key)
+        self.thread.daemon = True
+
+    def _renew(self):
+        # sqlite connections cannot be shared between threads
+        queue = WorkQueue(self.db_path, self.lease_seconds)
+        try:
+            while not self.stopped.wait(self.interval):
+                if not queue.renew(self.key, self.worker_id):
+                    self.lost = True
+                    print 'Lost lease on', self.key
+                    break
+        finally:
+            queue.close()
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stopped.set()
+        self.thread.join()
+        return False
+
+
+def process_task(key, kind, past_update_time, import_layers, keeper=None):
+    if kind == CATEGORY:
+        updated_xml = metadata_conversion.check_category_and_update(past_update_time, key)
+    else:
+        updated_xml = metadata_conversion.check_files_and_update(past_update_time, parent_folder=key,
+                                                                 folder_ids=frozenset([key]))
+    print '{} {}: {} files updated'.format(kind, key, len(updated_xml))
+    if keeper is not None and keeper.lost:
+        raise LeaseLost(key)
+    if import_layers and updated_xml:
+        metadata_conversion.import_metadata(updated_xml)
+    return updated_xml
+
+
+def run_worker(db_path, worker_id=None, import_layers=False, lease_seconds=LEASE_SECONDS):
+    '''Claim and process tasks until none are left, returning the number completed'''
+    worker_id = worker_id or default_worker_id()
+    queue = WorkQueue(db_path, lease_seconds)
+    past_update_time = queue.get_setting('past_update_time')
+    completed = 0
+    try:
+        while True:
+            task = queue.claim(worker_id)
+            if task is None:
+                break
+            key, kind = task
+            print worker_id, 'claimed', kind, key
+            try:
+                with LeaseKeeper(db_path, key, worker_id, lease_seconds) as keeper:
+                    process_task(key, kind, past_update_time, import_layers, keeper)
+                    if keeper.lost or not queue.renew(key, worker_id):
+                        raise LeaseLost(key)
+            except LeaseLost:
+                print 'Lost lease on {}, leaving it to the worker that holds it'.format(key)
+            except Exception as e:
+                print 'Task {} failed: {}'.format(key, e)
+                queue.fail(key, worker_id, e)
+            else:
+                queue.complete(key, worker_id)
+                completed += 1
+    finally:
+        queue.close()
+    return completed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Split metadata sync and import across workers')
+    parser.add_argument('db', help='Shared SQLite queue file')
+    parser.add_argument('--categories', nargs='+', dest='categories',
+                        help='Enqueue SGID categories')
+    parser.add_argument('--folders', nargs='+', dest='folders',
+                        help='Enqueue layer folder ids')
+    parser.add_argument('--reset', action='store_true', dest='reset',
+                        help='Requeue tasks that already exist, including finished ones')
+    parser.add_argument('--date', action='store', dest='last_update',
+                        help='Date string in ISO format YYYY-MM-DDTHH:MM:SS.UUU shared by all workers')
+    parser.add_argument('--work', action='store_true', dest='work',
+                        help='Claim and process tasks until the queue is empty')
+    parser.add_argument('--import', action='store_true', dest='import_metadata',
+                        help='Import updated metadata into SGID after each task')
+    parser.add_argument('--lease', action='store', dest='lease_seconds', type=int, default=LEASE_SECONDS,
+                        help='Seconds a claimed task is held before another worker may take it')
+
+    args = parser.parse_args()
+    queue = WorkQueue(args.db, args.lease_seconds)
+
+    if args.categories or args.folders:
+        past_update_time = args.last_update or metadata_conversion.get_last_update()
+        queue.set_setting('past_update_time', past_update_time)
+        if args.categories:
+            queue.enqueue(CATEGORY, args.categories, args.reset)
+        if args.folders:
+            queue.enqueue(FOLDER, args.folders, args.reset)
+
+    if args.work:
+        queue.close()
+        print 'Completed tasks:', run_worker(args.db, import_layers=args.import_metadata,
+                                             lease_seconds=args.lease_seconds)
+        queue = WorkQueue(args.db, args.lease_seconds)
+
+    print 'Queue:', queue.counts()
+    for key, error in queue.failures():
+        print 'Failed:', key, error
+    queue.close()
@@ -0,0 +1,154 @@
+'''XML parsing, editing and serialization through lxml when installed, else the stdlib
+
+Set METADATA_XML_BACKEND=stdlib to force xml.etree even when lxml is available.
+Both backends expose the same ElementTree API as ET, so callers only use the
+helpers here where the two differ: pretty printing, writing and compiled paths.
+'''
+import os
+import re
+import copy
+
+LXML = False
+if os.environ.get('METADATA_XML_BACKEND', 'lxml') != 'stdlib':
+    try:
+        from lxml import etree as ET
+        LXML = True
+    except ImportError:
+        pass
+if not LXML:
+    import xml.etree.ElementTree as ET
+    from xml.dom import minidom
+
+
+BACKEND = 'lxml' if LXML else 'stdlib'
+INDENT = '    '
+XML_DECLARATION = u'<?xml version="1.0" ?>\n'
+
+
+# Characters not allowed in XML 1.0 documents
+INVALID_XML_CHARACTERS = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+
+if LXML:
+    # ArcGIS thumbnails can exceed libxml2's default 10MB text node limit
+    _PARSER = ET.XMLParser(huge_tree=True)
+
+
+def parse(source):
+    if LXML:
+        return ET.parse(source, _PARSER)
+    return ET.parse(source)
+
+
+def _iterparse(source, events):
+    if LXML:
+        return ET.iterparse(source, events=events, huge_tree=True)
+    return ET.iterparse(source, events=events)
+
+
+def parse_pruned(source, pruned_tags):
+    '''Parse source incrementally, discarding pruned_tags subtrees as they are read
+
+    Elements inside a pruned subtree are detached as soon as they end, so memory
+    stays flat however large the subtree is. Returns (root, skipped_bytes) where
+    skipped_bytes approximates the serialized size of everything discarded.
+    '''
+    root = None
+    stack = []
+    pruning = 0
+    skipped_bytes = 0
+    for event, element in _iterparse(source, ('start', 'end')):
+        if event == 'start':
+            if root is None:
+                root = element
+            if pruning or element.tag in pruned_tags:
+                pruning += 1
+            stack.append(element)
+            continue
+
+        stack.pop()
+        if pruning:
+            pruning -= 1
+            # children were already detached, so only this element's own markup is left
+            skipped_bytes += 2 * len(element.tag) + 5 + len(element.text or '') + len(element.tail or '')
+            for name, value in element.attrib.items():
+                skipped_bytes += len(name) + len(value) + 4
+            if stack:
+                stack[-1].remove(element)
+
+    return root, skipped_bytes
+
+
+def fromstring(text):
+    return ET.fromstring(text)
+
+
+def tostring(element):
+    '''Return UTF-8 encoded bytes for the Element'''
+    return ET.tostring(element, encoding='utf-8')
+
+
+def write(element_tree, xml_path):
+    element_tree.write(xml_path, encoding='UTF-8', xml_declaration=True)
+
+
+def clean_text(text):
+    '''Remove characters that cannot be stored in an XML document'''
+    if text is None:
+        return None
+    return INVALID_XML_CHARACTERS.sub(u'', text)
+
+
+def _indent(element):
+    if hasattr(ET, 'indent'):
+        ET.indent(element, space=INDENT)
+        return element
+    # lxml < 4.5 has no indent(), reparse its two space pretty print instead
+    return ET.fromstring(ET.tostring(element, pretty_print=True))
+
+
+def pretty_string(element):
+    '''Return a pretty-printed XML unicode string for the Element
+
+    With lxml the element's whitespace is reindented in place.
+    '''
+    if LXML:
+        return XML_DECLARATION + ET.tostring(_indent(element), encoding='unicode')
+    reparsed = minidom.parseString(ET.tostring(element, 'utf-8'))
+    return reparsed.toprettyxml(indent=INDENT)
+
+
+def pretty_element(element):
+    '''Return an indented copy of the Element for insertion into another tree'''
+    if LXML:
+        # _indent works in place, so indent a copy as the stdlib branch does
+        return _indent(copy.deepcopy(element))
+    reparsed = minidom.parseString(ET.tostring(element, 'utf-8'))
+    return ET.fromstring(reparsed.toprettyxml(indent=INDENT).encode('utf-8'))
+
+
+def compile_path(path):
+    '''Compile an ElementPath/XPath expression once and return a function(element) -> list
+
+    Use the subset both understand: child steps, // and [tag] predicates.
+    '''
+    if LXML:
+        return ET.XPath(path)
+    return lambda element: element.findall(path)
+
+
+def canonical(element):
+    '''Return a whitespace-insensitive form of the Element for comparing backends'''
+    parts = []
+
+    def walk(e):
+        parts.append(u'<{}{}>'.format(e.tag, u''.join(u' {}="{}"'.format(k, v) for k, v in sorted(e.attrib.items()))))
+        parts.append((e.text or u'').strip())
+        for child in e:
+            if isinstance(child.tag, basestring):
+                walk(child)
+            parts.append((child.tail or u'').strip())
+        parts.append(u'</{}>'.format(e.tag))
+
+    walk(element)
+    return u''.join(parts)